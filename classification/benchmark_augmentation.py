@@ -0,0 +1,99 @@
+# --------------------------------------------------------
+# InternVL
+# Copyright (c) 2023 OpenGVLab
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+"""Throughput of the training input pipeline, per-sample transforms in the
+dataloader workers (default) vs uint8 crops + batched device augmentation (AUG.DEVICE).
+
+python benchmark_augmentation.py --cfg configs/intern_vit_6b_1k_224.yaml --workers 4
+"""
+
+import argparse
+import io
+import time
+
+import numpy as np
+import torch
+from config import get_config
+from dataset.build import build_transform, build_transform_for_linear_probe
+from dataset.device_aug import build_device_augmentation, build_uint8_transform
+from PIL import Image
+
+
+class SyntheticJPEGDataset(torch.utils.data.Dataset):
+    """ImageNet-sized random JPEGs, decoded in __getitem__ like the real datasets."""
+
+    def __init__(self, num_images, transform, size=(500, 375)):
+        rng = np.random.default_rng(0)
+        self.images = []
+        for _ in range(num_images):
+            # smooth random images, compressing like natural images
+            img = rng.integers(0, 256, (size[1] // 8, size[0] // 8, 3), dtype=np.uint8)
+            img = Image.fromarray(img).resize(size, Image.BICUBIC)
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=90)
+            self.images.append(buffer.getvalue())
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        img = Image.open(io.BytesIO(self.images[index])).convert('RGB')
+        return self.transform(img), 0
+
+
+def run(data_loader, device, device_aug, epochs):
+    num_images = 0
+    start = None
+    for epoch in range(epochs + 1):
+        if epoch == 1:
+            # the first epoch warms up the workers
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+        for samples, _ in data_loader:
+            samples = samples.to(device, non_blocking=True)
+            if device_aug is not None:
+                samples = device_aug(samples)
+            if epoch > 0:
+                num_images += samples.shape[0]
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return num_images / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser('Input pipeline throughput benchmark')
+    parser.add_argument('--cfg', type=str, required=True, metavar='FILE', help='path to config file')
+    parser.add_argument('--opts', help="Modify config options by adding 'KEY VALUE' pairs. ", default=None, nargs='+')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--num-images', type=int, default=512)
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    config = get_config(args)
+    device = torch.device(args.device)
+
+    if config.DATA.TRANSFORM == 'build_transform_for_linear_probe':
+        transform = build_transform_for_linear_probe(True, config)
+    else:
+        transform = build_transform(True, config)
+    config.defrost()
+    config.AUG.DEVICE = True
+    config.freeze()
+    device_aug = build_device_augmentation(config).to(device)
+    paths = [('workers', transform, None), ('device', build_uint8_transform(config), device_aug)]
+
+    for name, transform, aug in paths:
+        dataset = SyntheticJPEGDataset(args.num_images, transform)
+        data_loader = torch.utils.data.DataLoader(
+            dataset, batch_size=args.batch_size, num_workers=args.workers,
+            pin_memory=device.type == 'cuda', drop_last=True, persistent_workers=args.workers > 0)
+        print(f'{name}: {run(data_loader, device, aug, args.epochs):.1f} images/s')
+
+
+if __name__ == '__main__':
+    main()
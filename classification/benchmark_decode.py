@@ -0,0 +1,97 @@
+# --------------------------------------------------------
+# InternVL
+# Copyright (c) 2023 OpenGVLab
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+"""Decode + transform time of JPEG images at full resolution vs with DATA.REDUCED_DECODE,
+and the difference of the resulting evaluation inputs.
+
+python benchmark_decode.py --cfg configs/intern_vit_6b_1k_224.yaml --image-dir /path/to/imagenet/val/n01440764
+
+The difference of the inputs does not tell the accuracy change, which has not been measured
+(hence the option is off by default). The accuracy check is the evaluation itself, with and
+without the option:
+python main.py --eval --cfg ... --resume ... --opts DATA.REDUCED_DECODE True
+"""
+
+import argparse
+import glob
+import io
+import os
+import time
+
+import numpy as np
+import torch
+from config import get_config
+from dataset.build import (build_min_size_fn, build_transform,
+                           build_transform_for_linear_probe)
+from dataset.cached_image_folder import pil_loader
+from PIL import Image
+
+
+def synthetic_jpegs(num_images, size=(1024, 768)):
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(num_images):
+        # smooth random images, compressing like natural images
+        img = rng.integers(0, 256, (size[1] // 8, size[0] // 8, 3), dtype=np.uint8)
+        img = Image.fromarray(img).resize(size, Image.BICUBIC)
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def run(images, transform, min_size_fn, repeats):
+    outputs = []
+    start = time.time()
+    for _ in range(repeats):
+        outputs = [transform(pil_loader(data, min_size_fn)) for data in images]
+    return (time.time() - start) / (repeats * len(images)), outputs
+
+
+def main():
+    parser = argparse.ArgumentParser('Reduced-resolution decode benchmark')
+    parser.add_argument('--cfg', type=str, required=True, metavar='FILE', help='path to config file')
+    parser.add_argument('--opts', help="Modify config options by adding 'KEY VALUE' pairs. ", default=None, nargs='+')
+    parser.add_argument('--image-dir', type=str, default=None, help='JPEG images, synthetic ones if not set')
+    parser.add_argument('--num-images', type=int, default=200)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    config = get_config(args)
+
+    if args.image_dir is not None:
+        paths = sorted(glob.glob(os.path.join(args.image_dir, '**', '*.JPEG'), recursive=True) +
+                       glob.glob(os.path.join(args.image_dir, '**', '*.jpg'), recursive=True))
+        images = []
+        for path in paths[:args.num_images]:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+    else:
+        images = synthetic_jpegs(args.num_images)
+
+    config.defrost()
+    config.DATA.REDUCED_DECODE = True
+    config.freeze()
+    for is_train in [False, True]:
+        if config.DATA.TRANSFORM == 'build_transform_for_linear_probe':
+            transform = build_transform_for_linear_probe(is_train, config)
+        else:
+            transform = build_transform(is_train, config)
+        min_size_fn = build_min_size_fn(is_train, config)
+        full_time, full = run(images, transform, None, args.repeats)
+        reduced_time, reduced = run(images, transform, min_size_fn, args.repeats)
+        split = 'train' if is_train else 'val'
+        print(f'{split}: full decode {full_time * 1000:.2f} ms/image, '
+              f'reduced decode {reduced_time * 1000:.2f} ms/image ({full_time / reduced_time:.2f}x)')
+        if not is_train:
+            # deterministic transforms, compare the normalized inputs
+            diff = torch.stack(full) - torch.stack(reduced)
+            mse = diff.pow(2).mean().item()
+            value_range = (torch.stack(full).max() - torch.stack(full).min()).item()
+            print(f'{split}: mean abs diff {diff.abs().mean().item():.4f}, '
+                  f'PSNR {10 * np.log10(value_range ** 2 / max(mse, 1e-12)):.2f} dB')
+
+
+if __name__ == '__main__':
+    main()
@@ -41,6 +41,11 @@ _C.DATA.NUM_WORKERS = 8
 _C.DATA.IMG_ON_MEMORY = False
 # Name of the build_transform function
 _C.DATA.TRANSFORM = 'build_transform'
+# Decode JPEG images at the smallest DCT scale (1/2, 1/4 or 1/8) that the transforms
+# do not upsample, the model inputs keep their resolution but not their exact pixels
+# (41 dB PSNR on synthetic images). Off by default: its effect on top-1 has not been measured,
+# compare main.py --eval with and without it on the checkpoint before enabling it
+_C.DATA.REDUCED_DECODE = False
 
 # -----------------------------------------------------------------------------
 # Model settings
@@ -82,6 +87,10 @@ _C.MODEL.INTERN_VIT_6B.FREEZE_VIT = True
 _C.MODEL.INTERN_VIT_6B.PRETRAINED = None
 _C.MODEL.INTERN_VIT_6B.CLS_TARGET = 'cls_patch_concat'
 _C.MODEL.INTERN_VIT_6B.HEAD_NORM_TYPE = 'bn'
+# Index of the block whose output is used for classification, later blocks are skipped
+_C.MODEL.INTERN_VIT_6B.OUT_INDEX = -1
+# Do not build the blocks after OUT_INDEX, nor load their weights
+_C.MODEL.INTERN_VIT_6B.PRUNE_UNUSED_BLOCKS = False
 
 # -----------------------------------------------------------------------------
 # Training settings
@@ -133,6 +142,8 @@ _C.TRAIN.OPTIMIZER.DCN_LR_MUL = None
 _C.TRAIN.EMA = CN()
 _C.TRAIN.EMA.ENABLE = False
 _C.TRAIN.EMA.DECAY = 0.9998
+# update the EMA every UPDATE_INTERVAL steps (EMADeepspeed only)
+_C.TRAIN.EMA.UPDATE_INTERVAL = 1
 
 # LR_LAYER_DECAY
 _C.TRAIN.LR_LAYER_DECAY = False
@@ -171,6 +182,9 @@ _C.AUG.MIXUP_MODE = 'batch'
 _C.AUG.RANDOM_RESIZED_CROP = False
 _C.AUG.MEAN = (0.485, 0.456, 0.406)
 _C.AUG.STD = (0.229, 0.224, 0.225)
+# Decode and crop training images to uint8 in the dataloader workers, then apply color jitter,
+# normalization and random erasing batched on the device (see dataset/device_aug.py)
+_C.AUG.DEVICE = False
 
 # -----------------------------------------------------------------------------
 # Testing settings
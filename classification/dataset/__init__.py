@@ -5,3 +5,4 @@
 # --------------------------------------------------------
 
 from .build import build_loader, build_loader2
+from .device_aug import build_device_augmentation
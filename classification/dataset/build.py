@@ -4,7 +4,9 @@
 # Licensed under The MIT License [see LICENSE for details]
 # --------------------------------------------------------
 
+import math
 import os
+from functools import partial
 
 import numpy as np
 import torch
@@ -13,7 +15,8 @@ from timm.data import Mixup, create_transform
 from torchvision import transforms
 from torchvision.datasets import ImageFolder
 
-from .cached_image_folder import ImageCephDataset
+from .cached_image_folder import ImageCephDataset, pil_loader
+from .device_aug import build_uint8_transform
 from .samplers import NodeDistributedSampler, SubsetRandomSampler
 
 try:
@@ -197,13 +200,17 @@ def build_loader2(config):
 
 
 def build_dataset(split, config):
-    if config.DATA.TRANSFORM == 'build_transform':
+    if split == 'train' and config.AUG.DEVICE:
+        transform = build_uint8_transform(config)
+    elif config.DATA.TRANSFORM == 'build_transform':
         transform = build_transform(split == 'train', config)
     elif config.DATA.TRANSFORM == 'build_transform_for_linear_probe':
         transform = build_transform_for_linear_probe(split == 'train', config)
     else:
         raise NotImplementedError
     print(split, transform)
+    min_size_fn = build_min_size_fn(split == 'train', config)
+    loader = partial(pil_loader, min_size_fn=min_size_fn)
     dataset = None
     nb_classes = None
     prefix = split
@@ -212,10 +219,11 @@ def build_dataset(split, config):
             root = os.path.join(config.DATA.DATA_PATH, 'train')
             dataset = ImageCephDataset(root, 'train',
                                        transform=transform,
-                                       on_memory=config.DATA.IMG_ON_MEMORY)
+                                       on_memory=config.DATA.IMG_ON_MEMORY,
+                                       min_size_fn=min_size_fn)
         elif prefix == 'val':
             root = os.path.join(config.DATA.DATA_PATH, 'val')
-            dataset = ImageCephDataset(root, 'val', transform=transform)
+            dataset = ImageCephDataset(root, 'val', transform=transform, min_size_fn=min_size_fn)
         nb_classes = 1000
     elif config.DATA.DATASET == 'imagenet22K':
         if prefix == 'train':
@@ -223,11 +231,12 @@ def build_dataset(split, config):
                 root = config.DATA.DATA_PATH
                 dataset = ImageCephDataset(root, 'train',
                                            transform=transform,
-                                           on_memory=config.DATA.IMG_ON_MEMORY)
+                                           on_memory=config.DATA.IMG_ON_MEMORY,
+                                           min_size_fn=min_size_fn)
             nb_classes = 21841
         elif prefix == 'val':
             root = os.path.join(config.DATA.DATA_PATH, 'val')
-            dataset = ImageCephDataset(root, 'val', transform=transform)
+            dataset = ImageCephDataset(root, 'val', transform=transform, min_size_fn=min_size_fn)
             nb_classes = 1000
     elif config.DATA.DATASET == 'imagenetv2':
         from .imagenetv2 import ImageNetV2Dataset
@@ -242,19 +251,19 @@ def build_dataset(split, config):
         if prefix == 'train' and not config.EVAL_MODE:
             print(f'Only test split available for {config.DATA.DATASET}')
         else:
-            dataset = ImageFolder(root=config.DATA.DATA_PATH, transform=transform)
+            dataset = ImageFolder(root=config.DATA.DATA_PATH, transform=transform, loader=loader)
             nb_classes = 1000
     elif config.DATA.DATASET == 'imagenet_a':
         if prefix == 'train' and not config.EVAL_MODE:
             print(f'Only test split available for {config.DATA.DATASET}')
         else:
-            dataset = ImageFolder(root=config.DATA.DATA_PATH, transform=transform)
+            dataset = ImageFolder(root=config.DATA.DATA_PATH, transform=transform, loader=loader)
             nb_classes = 1000  # actual number of classes is 200
     elif config.DATA.DATASET == 'imagenet_r':
         if prefix == 'train' and not config.EVAL_MODE:
             print(f'Only test split available for {config.DATA.DATASET}')
         else:
-            dataset = ImageFolder(root=config.DATA.DATA_PATH, transform=transform)
+            dataset = ImageFolder(root=config.DATA.DATA_PATH, transform=transform, loader=loader)
             nb_classes = 1000  # actual number of classes is 200
     else:
         raise NotImplementedError(
@@ -263,6 +272,39 @@ def build_dataset(split, config):
     return dataset, nb_classes
 
 
+def _short_side_size(orig_size, size):
+    # Resize(size): the shorter side becomes size
+    scale = size / min(orig_size)
+    return math.ceil(orig_size[0] * scale), math.ceil(orig_size[1] * scale)
+
+
+def _crop_area_size(orig_size, size, min_crop_area):
+    # RandomResizedCrop: the smallest crop, min_crop_area of the image, must not be smaller than size x size
+    scale = min(size / math.sqrt(min_crop_area * orig_size[0] * orig_size[1]), 1.)
+    return math.ceil(orig_size[0] * scale), math.ceil(orig_size[1] * scale)
+
+
+def _fixed_size(orig_size, size):
+    return size, size
+
+
+def build_min_size_fn(is_train, config):
+    """Returns the function mapping the (width, height) of an image to the smallest
+    decoded size which the transforms of build_transform(_for_linear_probe) do not
+    upsample, used to decode JPEG images at reduced resolution (DATA.REDUCED_DECODE),
+    or None."""
+    size = config.DATA.IMG_SIZE
+    if not config.DATA.REDUCED_DECODE or size <= 32:
+        return None
+    if is_train or (config.DATA.TRANSFORM == 'build_transform' and not config.TEST.CROP
+                    and config.AUG.RANDOM_RESIZED_CROP):
+        # scale=(0.08, 1.0) and ratio=(3/4, 4/3): a side of the crop is at least sqrt(0.08 * 3/4) of the image's
+        return partial(_crop_area_size, size=size, min_crop_area=0.08 * 3 / 4)
+    if config.DATA.TRANSFORM == 'build_transform_for_linear_probe' or config.TEST.CROP:
+        return partial(_short_side_size, size=size)
+    return partial(_fixed_size, size=size)
+
+
 def build_transform_for_linear_probe(is_train, config):
     # linear probe: weak augmentation
     if is_train:
@@ -11,7 +11,7 @@ import math
 import os
 import os.path as osp
 import re
-import time
+import threading
 from abc import abstractmethod
 
 import mmcv
@@ -20,8 +20,8 @@ import torch.distributed as dist
 import torch.utils.data as data
 from mmcv.fileio import FileClient
 from PIL import Image
-from tqdm import tqdm, trange
 
+from .shared_cache import NodeSharedCache, node_info
 from .zipreader import ZipReader, is_zip_path
 
 _logger = logging.getLogger(__name__)
@@ -140,32 +140,33 @@ class DatasetFolder(data.Dataset):
         self.target_transform = target_transform
 
         self.cache_mode = cache_mode
+        self.cache = None
         if self.cache_mode != 'no':
             self.init_cache()
 
     def init_cache(self):
+        """Cache the image bytes in a shared memory arena per node.
+
+        'full' caches all the images, 'part' the ones read by the ranks of the
+        node (index % world_size, see the sampler of build_loader).
+        """
         assert self.cache_mode in ['part', 'full']
         n_sample = len(self.samples)
-        global_rank = dist.get_rank()
+        _, local_size, node_rank, _ = node_info()
         world_size = dist.get_world_size()
 
-        samples_bytes = [None for _ in range(n_sample)]
-        start_time = time.time()
-        for index in range(n_sample):
-            if index % (n_sample // 10) == 0:
-                t = time.time() - start_time
-                print(
-                    f'global_rank {dist.get_rank()} cached {index}/{n_sample} takes {t:.2f}s per block'
-                )
-                start_time = time.time()
-            path, target = self.samples[index]
-            if self.cache_mode == 'full':
-                samples_bytes[index] = (ZipReader.read(path), target)
-            elif self.cache_mode == 'part' and index % world_size == global_rank:
-                samples_bytes[index] = (ZipReader.read(path), target)
-            else:
-                samples_bytes[index] = (path, target)
-        self.samples = samples_bytes
+        if self.cache_mode == 'full':
+            indices = list(range(n_sample))
+        else:
+            indices = [index for index in range(n_sample)
+                       if index % world_size // local_size == node_rank]
+        self.cache = NodeSharedCache(f'{self.root}-{self.cache_mode}', n_sample, indices,
+                                     lambda index: _read_bytes(self.samples[index][0]))
+
+    def _load(self, index):
+        path, target = self.samples[index]
+        data = self.cache.get(index) if self.cache is not None else None
+        return self.loader(path if data is None else data), target
 
     def __getitem__(self, index):
         """
@@ -174,8 +175,7 @@ class DatasetFolder(data.Dataset):
         Returns:
             tuple: (sample, target) where target is class_index of the target class.
         """
-        path, target = self.samples[index]
-        sample = self.loader(path)
+        sample, target = self._load(index)
         if self.transform is not None:
             sample = self.transform(sample)
         if self.target_transform is not None:
@@ -203,10 +203,24 @@ class DatasetFolder(data.Dataset):
         return fmt_str
 
 
+def _read_bytes(path):
+    if is_zip_path(path):
+        return ZipReader.read(path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
 IMG_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif']
 
 
-def pil_loader(path):
+def _draft(img, min_size_fn):
+    # JPEG only: DCT scaling to the smallest 1/2, 1/4 or 1/8 scale at least min_size_fn(img.size)
+    if min_size_fn is not None and img.format == 'JPEG':
+        img.draft('RGB', tuple(min_size_fn(img.size)))
+    return img
+
+
+def pil_loader(path, min_size_fn=None):
     # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
     if isinstance(path, bytes):
         img = Image.open(io.BytesIO(path))
@@ -215,10 +229,10 @@ def pil_loader(path):
         img = Image.open(io.BytesIO(data))
     else:
         with open(path, 'rb') as f:
-            img = Image.open(f)
+            img = _draft(Image.open(f), min_size_fn)
             return img.convert('RGB')
 
-    return img.convert('RGB')
+    return _draft(img, min_size_fn).convert('RGB')
 
 
 def accimage_loader(path):
@@ -284,8 +298,7 @@ class CachedImageFolder(DatasetFolder):
         Returns:
             tuple: (image, target) where target is class_index of the target class.
         """
-        path, target = self.samples[index]
-        image = self.loader(path)
+        image, target = self._load(index)
         if self.transform is not None:
             img = self.transform(image)
         else:
@@ -304,7 +317,8 @@ class ImageCephDataset(data.Dataset):
                  parser=None,
                  transform=None,
                  target_transform=None,
-                 on_memory=False):
+                 on_memory=False,
+                 min_size_fn=None):
         if '22k' in root:
             # Imagenet 22k
             annotation_root = 'meta_data/'
@@ -315,7 +329,8 @@ class ImageCephDataset(data.Dataset):
             parser = ParserCephImage(root=root,
                                      split=split,
                                      annotation_root=annotation_root,
-                                     on_memory=on_memory)
+                                     on_memory=on_memory,
+                                     min_size_fn=min_size_fn)
         self.parser = parser
         self.transform = transform
         self.target_transform = target_transform
@@ -368,11 +383,14 @@ class ParserCephImage(Parser):
                  split,
                  annotation_root,
                  on_memory=False,
+                 min_size_fn=None,
                  **kwargs):
         super().__init__()
 
         self.file_client = None
         self.kwargs = kwargs
+        # reduced-resolution decode of JPEG images, see build_min_size_fn
+        self.min_size_fn = min_size_fn
 
         self.root = root  # dataset:s3://imagenet22k
         if '22k' in root:
@@ -392,11 +410,7 @@ class ParserCephImage(Parser):
         self._consecutive_errors = 0
         self.on_memory = on_memory
         if on_memory:
-            self.holder = {}
-            if local_rank is None:
-                local_rank = int(os.environ.get('LOCAL_RANK', 0))
-            if local_size is None:
-                local_size = int(os.environ.get('LOCAL_SIZE', 1))
+            local_rank, local_size, _, _ = node_info(local_rank, local_size)
             self.local_rank = local_rank
             self.local_size = local_size
             self.rank = int(os.environ['RANK'])
@@ -409,48 +423,38 @@ class ParserCephImage(Parser):
             self.total_size_parts = self.num_samples * self.num_replicas // self.num_parts
             self.load_onto_memory_v2()
 
-    def load_onto_memory(self):
-        print('Loading images onto memory...', self.local_rank,
-              self.local_size)
-        if self.file_client is None:
-            self.file_client = FileClient(self.io_backend, **self.kwargs)
-        for index in trange(len(self.samples)):
-            if index % self.local_size != self.local_rank:
-                continue
-            path, _ = self.samples[index].split(' ')
-            path = osp.join(self.root, path)
-            img_bytes = self.file_client.get(path)
-            self.holder[path] = img_bytes
-
-        print('Loading complete!')
-
-    def load_onto_memory_v2(self):
-        # print("Loading images onto memory...", self.local_rank, self.local_size)
+    def _node_indices(self):
+        """Indices read by the NodeDistributedSampler of all the local ranks of this node."""
         t = torch.Generator()
         t.manual_seed(0)
-        indices = torch.randperm(len(self.samples), generator=t).tolist()
-        # indices = range(len(self.samples))
-        indices = [i for i in indices if i % self.num_parts == self.local_rank]
-        # add extra samples to make it evenly divisible
-        indices += indices[:(self.total_size_parts - len(indices))]
-        assert len(indices) == self.total_size_parts
-
-        # subsample
-        indices = indices[self.rank // self.num_parts:self.
-                          total_size_parts:self.num_replicas // self.num_parts]
-        assert len(indices) == self.num_samples
+        permutation = torch.randperm(len(self.samples), generator=t).tolist()
+        node_indices = set()
+        for local_rank in range(self.num_parts):
+            indices = [i for i in permutation if i % self.num_parts == local_rank]
+            # add extra samples to make it evenly divisible
+            indices += indices[:(self.total_size_parts - len(indices))]
+            assert len(indices) == self.total_size_parts
+
+            # subsample
+            indices = indices[self.rank // self.num_parts:self.
+                              total_size_parts:self.num_replicas // self.num_parts]
+            assert len(indices) == self.num_samples
+            node_indices.update(indices)
+        return sorted(node_indices)
 
-        if self.file_client is None:
-            self.file_client = FileClient(self.io_backend, **self.kwargs)
-        for index in tqdm(indices):
-            if index % self.local_size != self.local_rank:
-                continue
-            path, _ = self.samples[index].split(' ')
-            path = osp.join(self.root, path)
-            img_bytes = self.file_client.get(path)
+    def load_onto_memory_v2(self):
+        """Load the images of the node into a shared memory arena (see NodeSharedCache),
+        read by all the local ranks, instead of one dict per process."""
+        clients = threading.local()
 
-            self.holder[path] = img_bytes
+        def read(index):
+            if not hasattr(clients, 'file_client'):
+                clients.file_client = FileClient(self.io_backend, **self.kwargs)
+            path, _ = self.samples[index].split(' ')
+            return clients.file_client.get(osp.join(self.root, path))
 
+        self.holder = NodeSharedCache(self.root, len(self.samples), self._node_indices(), read,
+                                      local_rank=self.local_rank, local_size=self.local_size)
         print('Loading complete!')
 
     def __getitem__(self, index):
@@ -461,12 +465,15 @@ class ParserCephImage(Parser):
         filepath = osp.join(self.root, filepath)
 
         try:
-            if self.on_memory:
-                img_bytes = self.holder[filepath]
+            if self.on_memory and index in self.holder:
+                img_bytes = self.holder.get(index)
             else:
                 # pass
                 img_bytes = self.file_client.get(filepath)
-            img = mmcv.imfrombytes(img_bytes)[:, :, ::-1]
+            if self.min_size_fn is not None:
+                img = pil_loader(img_bytes, self.min_size_fn)
+            else:
+                img = Image.fromarray(mmcv.imfrombytes(img_bytes)[:, :, ::-1])
         except Exception as e:
             _logger.warning(
                 f'Skipped sample (index {index}, file {filepath}). {str(e)}')
@@ -477,7 +484,6 @@ class ParserCephImage(Parser):
                 raise e
         self._consecutive_errors = 0
 
-        img = Image.fromarray(img)
         try:
             if self.class_to_idx is not None:
                 target = self.class_to_idx[target]
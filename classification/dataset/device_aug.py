@@ -0,0 +1,141 @@
+# --------------------------------------------------------
+# InternVL
+# Copyright (c) 2023 OpenGVLab
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import math
+
+import torch
+import torch.nn as nn
+from timm.data import create_transform
+from torchvision import transforms
+
+
+def build_uint8_transform(config):
+    """Training transform of the workers with AUG.DEVICE: decode, random resized
+    crop, flip and AUG.AUTO_AUGMENT, returning uint8 CHW tensors (4x less data
+    to collate and copy). The color jitter, normalization and random erasing
+    are left to DeviceAugmentation."""
+    if config.DATA.TRANSFORM == 'build_transform_for_linear_probe':
+        return transforms.Compose([
+            transforms.RandomResizedCrop(config.DATA.IMG_SIZE, interpolation=transforms.InterpolationMode.BICUBIC),
+            transforms.RandomHorizontalFlip(),
+            transforms.PILToTensor(),
+        ])
+    # the PIL part of build_transform, with the same crop, flip and auto augment
+    primary, secondary, _ = create_transform(
+        input_size=config.DATA.IMG_SIZE,
+        is_training=True,
+        color_jitter=None,
+        auto_augment=config.AUG.AUTO_AUGMENT if config.AUG.AUTO_AUGMENT != 'none' else None,
+        interpolation=config.DATA.INTERPOLATION,
+        separate=True,
+    )
+    primary = list(primary.transforms)
+    if config.DATA.IMG_SIZE <= 32:
+        primary[0] = transforms.RandomCrop(config.DATA.IMG_SIZE, padding=4)
+    return transforms.Compose(primary + list(secondary.transforms) + [transforms.PILToTensor()])
+
+
+def build_device_augmentation(config):
+    """Returns the batched augmentation applied to the uint8 training batches, or None without AUG.DEVICE."""
+    if not config.AUG.DEVICE:
+        return None
+    if config.DATA.TRANSFORM == 'build_transform_for_linear_probe':
+        # weak augmentation
+        return DeviceAugmentation(config.AUG.MEAN, config.AUG.STD)
+    # like timm's create_transform, the color jitter is not applied with auto augment
+    color_jitter = config.AUG.COLOR_JITTER if config.AUG.AUTO_AUGMENT == 'none' else 0.
+    return DeviceAugmentation(config.AUG.MEAN, config.AUG.STD,
+                              color_jitter=color_jitter,
+                              re_prob=config.AUG.REPROB,
+                              re_mode=config.AUG.REMODE,
+                              re_count=config.AUG.RECOUNT)
+
+
+class DeviceAugmentation(nn.Module):
+    """Batched color jitter, normalization and random erasing of uint8 images.
+
+    Every operation is vectorized over the batch with per-sample random
+    parameters, so it runs on the GPU after the host to device copy (or on
+    CPU tensors, e.g. in tests). Mixup/cutmix are applied afterwards by
+    timm's ``Mixup``, which is batched already. RandAugment (AUG.AUTO_AUGMENT)
+    stays in the workers, see build_uint8_transform.
+
+    Args:
+        mean, std: Normalization of the [0, 1] images.
+        color_jitter (float): Brightness, contrast and saturation jitter, like timm's ``ColorJitter``.
+        re_prob (float): Probability of random erasing.
+        re_mode (str): Random erasing fill, 'pixel' (per-pixel normal), 'rand' (per-channel normal) or 'const' (0).
+        re_count (int): Maximum number of erased rectangles per image.
+    """
+
+    def __init__(self, mean, std, color_jitter=0., re_prob=0., re_mode='pixel', re_count=1):
+        super().__init__()
+        self.register_buffer('mean', torch.tensor(mean).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('std', torch.tensor(std).view(1, -1, 1, 1), persistent=False)
+        self.color_jitter = color_jitter
+        self.re_prob = re_prob
+        self.re_mode = re_mode
+        self.re_count = re_count
+
+    def _factors(self, batch_size, device):
+        low = max(0., 1. - self.color_jitter)
+        high = 1. + self.color_jitter
+        return torch.empty(batch_size, 1, 1, 1, device=device).uniform_(low, high)
+
+    def jitter(self, x):
+        b = x.shape[0]
+        gray_weights = x.new_tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)
+        # brightness
+        x = (x * self._factors(b, x.device)).clamp_(0, 1)
+        # contrast, blend with the mean gray level
+        gray_mean = (x * gray_weights).sum(1, keepdim=True).mean((2, 3), keepdim=True)
+        x = torch.lerp(gray_mean, x, self._factors(b, x.device)).clamp_(0, 1)
+        # saturation, blend with the gray image
+        gray = (x * gray_weights).sum(1, keepdim=True)
+        x = torch.lerp(gray, x, self._factors(b, x.device)).clamp_(0, 1)
+        return x
+
+    def erase(self, x, min_area=0.02, max_area=1 / 3, min_aspect=0.3, attempts=10):
+        b, c, h, w = x.shape
+        device = x.device
+        rows = torch.arange(h, device=device).view(1, h, 1)
+        cols = torch.arange(w, device=device).view(1, 1, w)
+        mask = torch.zeros(b, h, w, dtype=torch.bool, device=device)
+        count = torch.randint(1, self.re_count + 1, (b,), device=device) if self.re_count > 1 \
+            else torch.ones(b, dtype=torch.long, device=device)
+        apply = torch.rand(b, device=device) < self.re_prob
+        log_aspect = math.log(min_aspect), math.log(1 / min_aspect)
+        for i in range(self.re_count):
+            # like timm's RandomErasing, try rectangles until one fits, all attempts at once
+            area = torch.empty(b, attempts, device=device).uniform_(min_area, max_area) * h * w / count[:, None]
+            aspect = torch.exp(torch.empty(b, attempts, device=device).uniform_(*log_aspect))
+            rect_h = torch.sqrt(area * aspect).round().long()
+            rect_w = torch.sqrt(area / aspect).round().long()
+            fits = (rect_h < h) & (rect_w < w)
+            first = fits.float().argmax(1, keepdim=True)
+            rect_h = rect_h.gather(1, first).view(b, 1, 1)
+            rect_w = rect_w.gather(1, first).view(b, 1, 1)
+            top = (torch.rand(b, 1, 1, device=device) * (h - rect_h + 1).clamp(min=1)).long()
+            left = (torch.rand(b, 1, 1, device=device) * (w - rect_w + 1).clamp(min=1)).long()
+            valid = (apply & fits.any(1) & (i < count)).view(b, 1, 1)
+            mask |= valid & (rows >= top) & (rows < top + rect_h) & (cols >= left) & (cols < left + rect_w)
+        if self.re_mode == 'pixel':
+            fill = torch.randn_like(x)
+        elif self.re_mode == 'rand':
+            fill = torch.randn(b, c, 1, 1, dtype=x.dtype, device=device).expand_as(x)
+        else:
+            fill = torch.zeros_like(x)
+        return torch.where(mask[:, None], fill, x)
+
+    @torch.no_grad()
+    def forward(self, images):
+        x = images.float().div_(255)
+        if self.color_jitter > 0:
+            x = self.jitter(x)
+        x = (x - self.mean) / self.std
+        if self.re_prob > 0:
+            x = self.erase(x)
+        return x
@@ -0,0 +1,136 @@
+# --------------------------------------------------------
+# InternVL
+# Copyright (c) 2023 OpenGVLab
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+import atexit
+import datetime
+import hashlib
+import os
+import os.path as osp
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch.distributed as dist
+from tqdm import tqdm
+
+# time given to the local ranks 0 to build the caches of their nodes
+BUILD_TIMEOUT = datetime.timedelta(hours=12)
+
+
+def node_info(local_rank=None, local_size=None):
+    """Returns (local_rank, local_size, node_rank, num_nodes) of the current process,
+    assuming consecutive global ranks on each node.
+
+    The local rank and size default to LOCAL_RANK and LOCAL_SIZE (set by the
+    SLURM launcher of main.py) or LOCAL_WORLD_SIZE (set by torchrun and
+    torch.distributed.launch). Raises if they cannot be determined in a
+    multi-process job, instead of letting each process assume its own node.
+    """
+    if dist.is_available() and dist.is_initialized():
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    else:
+        rank, world_size = None, 1
+    if local_rank is None:
+        local_rank = os.environ.get('LOCAL_RANK')
+    if local_size is None:
+        local_size = os.environ.get('LOCAL_SIZE', os.environ.get('LOCAL_WORLD_SIZE'))
+    if world_size == 1:
+        local_rank = 0 if local_rank is None else local_rank
+        local_size = 1 if local_size is None else local_size
+    if local_rank is None or local_size is None:
+        raise RuntimeError('Cannot determine the local rank and the number of processes per node, '
+                           'set LOCAL_RANK and LOCAL_SIZE (or use torchrun, which sets LOCAL_WORLD_SIZE)')
+    local_rank, local_size = int(local_rank), int(local_size)
+    if rank is None:
+        rank, world_size = local_rank, local_size
+    if world_size % local_size != 0 or rank % local_size != local_rank:
+        raise RuntimeError(f'Rank {rank} / {world_size} is inconsistent with local rank {local_rank} / {local_size}')
+    return local_rank, local_size, rank // local_size, world_size // local_size
+
+
+class NodeSharedCache(object):
+    """Raw bytes of (a subset of) the samples of a dataset, shared by all the
+    processes of a node.
+
+    The local rank 0 of each node reads the samples with a thread pool into a
+    single file under ``cache_dir`` (``/dev/shm`` by default, i.e. shared
+    memory) with an offset index, and all the local ranks and their
+    dataloader workers map it read-only, so that the node holds one copy of
+    the data instead of one per process.
+
+    Args:
+        key (str): Identifies the dataset and the subset, e.g. root and split.
+        num_samples (int): Length of the dataset.
+        indices (list[int]): Indices of the samples cached on this node.
+        read_fn (callable): Returns the bytes of a sample given its index.
+        cache_dir (str): Directory of the cache files.
+        num_threads (int): Number of reading threads.
+        local_rank (int, optional): Local rank of the process, see node_info.
+        local_size (int, optional): Number of processes per node, see node_info.
+    """
+
+    def __init__(self, key, num_samples, indices, read_fn, cache_dir='/dev/shm', num_threads=32,
+                 local_rank=None, local_size=None):
+        local_rank, _, node_rank, _ = node_info(local_rank, local_size)
+        # scoped to the job, files are removed at exit by the process that wrote them
+        job_id = os.environ.get('SLURM_JOB_ID', os.environ.get('MASTER_PORT', '0'))
+        digest = hashlib.sha1(f'{key}-{num_samples}-{len(indices)}-{job_id}'.encode()).hexdigest()[:16]
+        self.prefix = osp.join(cache_dir, f'internvl_cache_{digest}_node{node_rank}')
+        if local_rank == 0:
+            self._build(num_samples, indices, read_fn, num_threads)
+            atexit.register(self._remove)
+        self._wait(local_rank)
+
+        self.slots = np.load(self.prefix + '_slots.npy')
+        self.offsets = np.load(self.prefix + '_offsets.npy')
+        self.data = np.memmap(self.prefix + '.bin', dtype=np.uint8, mode='r') \
+            if self.offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def _build(self, num_samples, indices, read_fn, num_threads):
+        slots = np.full(num_samples, -1, dtype=np.int64)
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        start_time = time.time()
+        with open(self.prefix + '.bin.tmp', 'wb') as f, ThreadPoolExecutor(num_threads) as executor:
+            # map keeps the order of indices
+            for slot, (index, data) in enumerate(
+                    tqdm(zip(indices, executor.map(read_fn, indices)), total=len(indices),
+                         desc='Caching images in shared memory')):
+                f.write(data)
+                slots[index] = slot
+                offsets[slot + 1] = offsets[slot] + len(data)
+        np.save(self.prefix + '_slots.npy', slots)
+        np.save(self.prefix + '_offsets.npy', offsets)
+        # the data file is renamed last, it marks the cache as complete
+        os.replace(self.prefix + '.bin.tmp', self.prefix + '.bin')
+        print(f'cached {len(indices)} images ({offsets[-1] / 2 ** 30:.2f} GiB) '
+              f'in {time.time() - start_time:.2f}s to {self.prefix}')
+
+    def _wait(self, local_rank):
+        if dist.is_available() and dist.is_initialized():
+            # the build may take longer than the timeout of the NCCL group used for training,
+            # so the processes wait for it on a gloo group with a timeout of its own
+            group = dist.new_group(backend='gloo', timeout=BUILD_TIMEOUT)
+            dist.barrier(group=group)
+            dist.destroy_process_group(group)
+        elif local_rank != 0:
+            while not osp.exists(self.prefix + '.bin'):
+                time.sleep(1)
+
+    def _remove(self):
+        # processes which mapped the files keep their pages until they exit
+        for suffix in ['.bin', '_slots.npy', '_offsets.npy']:
+            if osp.exists(self.prefix + suffix):
+                os.remove(self.prefix + suffix)
+
+    def __contains__(self, index):
+        return self.slots[index] >= 0
+
+    def get(self, index):
+        """Returns the bytes of sample `index`, or None if it is not cached on this node."""
+        slot = self.slots[index]
+        if slot < 0:
+            return None
+        return self.data[self.offsets[slot]:self.offsets[slot + 1]].tobytes()
@@ -4,31 +4,147 @@
 # Licensed under The MIT License [see LICENSE for details]
 # --------------------------------------------------------
 
+import hashlib
 import io
 import os
+import os.path as osp
+import struct
+import threading
 import zipfile
+import zlib
 
 import numpy as np
 from PIL import Image, ImageFile
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# parsed central directories are cached here, keyed by the path, size and mtime of the zip
+ZIP_INDEX_CACHE_DIR = os.environ.get('ZIP_INDEX_CACHE_DIR',
+                                     osp.join(osp.expanduser('~'), '.cache', 'internvl', 'zip_index'))
+
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_LOCAL_HEADER_SIGNATURE = b'PK\003\004'
+
 
 def is_zip_path(img_or_path):
     """judge if this is a zip path."""
     return '.zip@' in img_or_path
 
 
+class ZipIndex(object):
+    """Sorted name -> (header offset, compressed size, size, compression) index
+    of the members of a zip file."""
+
+    def __init__(self, names, header_offsets, compress_sizes, file_sizes, compress_types):
+        self.names = names
+        self.header_offsets = header_offsets
+        self.compress_sizes = compress_sizes
+        self.file_sizes = file_sizes
+        self.compress_types = compress_types
+
+    @classmethod
+    def from_zipfile(cls, zip_path):
+        with zipfile.ZipFile(zip_path, 'r') as zfile:
+            infos = sorted(zfile.infolist(), key=lambda info: info.filename.encode('utf-8'))
+        return cls(np.array([info.filename.encode('utf-8') for info in infos], dtype=bytes),
+                   np.array([info.header_offset for info in infos], dtype=np.int64),
+                   np.array([info.compress_size for info in infos], dtype=np.int64),
+                   np.array([info.file_size for info in infos], dtype=np.int64),
+                   np.array([info.compress_type for info in infos], dtype=np.int16))
+
+    @classmethod
+    def load(cls, zip_path, cache_dir=ZIP_INDEX_CACHE_DIR):
+        """Load the index of `zip_path` from `cache_dir`, parsing the zip and caching it on a miss."""
+        stat = os.stat(zip_path)
+        key = f'{osp.abspath(zip_path)}-{stat.st_size}-{stat.st_mtime_ns}'
+        cache_file = osp.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+        if osp.exists(cache_file):
+            with np.load(cache_file) as data:
+                return cls(*(data[k] for k in ['names', 'header_offsets', 'compress_sizes',
+                                               'file_sizes', 'compress_types']))
+        index = cls.from_zipfile(zip_path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = f'{cache_file[:-len(".npz")]}.{os.getpid()}.tmp.npz'
+            np.savez(tmp_file, names=index.names, header_offsets=index.header_offsets,
+                     compress_sizes=index.compress_sizes, file_sizes=index.file_sizes,
+                     compress_types=index.compress_types)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            print(f'cannot cache the index of {zip_path}: {e}')
+        return index
+
+    def find(self, name):
+        """Returns the position of member `name`, or -1."""
+        key = name.encode('utf-8')
+        i = int(np.searchsorted(self.names, key))
+        if i < len(self.names) and self.names[i] == key:
+            return i
+        return -1
+
+    def names_with_prefix(self, prefix):
+        key = prefix.encode('utf-8')
+        start = int(np.searchsorted(self.names, key, side='left'))
+        # all the names starting with key sort before key + 0xff
+        end = int(np.searchsorted(self.names, key + b'\xff', side='left'))
+        return [name.decode('utf-8') for name in self.names[start:end]]
+
+
 class ZipReader(object):
-    """A class to read zipped files."""
+    """A class to read zipped files.
+
+    File descriptors and zipfile handles are opened lazily by each process
+    (they are not shared with the dataloader workers forked from it), members
+    are looked up in a cached ZipIndex, and stored or deflated members are read
+    with `os.pread` without going through zipfile.
+    """
     zip_bank = dict()
+    index_bank = dict()
+    fd_bank = dict()
+    _pid = None
+    _lock = threading.Lock()
+    _local = threading.local()
 
     def __init__(self):
         super(ZipReader, self).__init__()
 
+    @staticmethod
+    def _check_pid():
+        if ZipReader._pid != os.getpid():
+            # handles inherited through fork share their file offsets with the parent
+            ZipReader.zip_bank = dict()
+            ZipReader.fd_bank = dict()
+            ZipReader._local = threading.local()
+            ZipReader._pid = os.getpid()
+
+    @staticmethod
+    def get_index(path):
+        index = ZipReader.index_bank.get(path)
+        if index is None:
+            with ZipReader._lock:
+                if path not in ZipReader.index_bank:
+                    ZipReader.index_bank[path] = ZipIndex.load(path)
+                index = ZipReader.index_bank[path]
+        return index
+
+    @staticmethod
+    def get_fd(path):
+        ZipReader._check_pid()
+        fd = ZipReader.fd_bank.get(path)
+        if fd is None:
+            with ZipReader._lock:
+                if path not in ZipReader.fd_bank:
+                    ZipReader.fd_bank[path] = os.open(path, os.O_RDONLY)
+                fd = ZipReader.fd_bank[path]
+        return fd
+
     @staticmethod
     def get_zipfile(path):
-        zip_bank = ZipReader.zip_bank
+        # zipfile handles are not thread-safe, one per thread
+        ZipReader._check_pid()
+        zip_bank = getattr(ZipReader._local, 'zip_bank', None)
+        if zip_bank is None:
+            zip_bank = ZipReader._local.zip_bank = dict()
         if path not in zip_bank:
             zfile = zipfile.ZipFile(path, 'r')
             zip_bank[path] = zfile
@@ -48,12 +164,11 @@ class ZipReader(object):
     def list_folder(path):
         zip_path, folder_path = ZipReader.split_zip_style_path(path)
 
-        zfile = ZipReader.get_zipfile(zip_path)
+        index = ZipReader.get_index(zip_path)
         folder_list = []
-        for file_foler_name in zfile.namelist():
+        for file_foler_name in index.names_with_prefix(folder_path):
             file_foler_name = str.strip(file_foler_name, '/')
-            if file_foler_name.startswith(folder_path) and \
-                    len(os.path.splitext(file_foler_name)[-1]) == 0 and \
+            if len(os.path.splitext(file_foler_name)[-1]) == 0 and \
                     file_foler_name != folder_path:
                 if len(folder_path) == 0:
                     folder_list.append(file_foler_name)
@@ -68,12 +183,11 @@ class ZipReader(object):
             extension = ['.*']
         zip_path, folder_path = ZipReader.split_zip_style_path(path)
 
-        zfile = ZipReader.get_zipfile(zip_path)
+        index = ZipReader.get_index(zip_path)
         file_lists = []
-        for file_foler_name in zfile.namelist():
+        for file_foler_name in index.names_with_prefix(folder_path):
             file_foler_name = str.strip(file_foler_name, '/')
-            if file_foler_name.startswith(folder_path) and \
-                    str.lower(os.path.splitext(file_foler_name)[-1]) in extension:
+            if str.lower(os.path.splitext(file_foler_name)[-1]) in extension:
                 if len(folder_path) == 0:
                     file_lists.append(file_foler_name)
                 else:
@@ -81,18 +195,36 @@ class ZipReader(object):
 
         return file_lists
 
+    @staticmethod
+    def read_member(zip_path, name):
+        index = ZipReader.get_index(zip_path)
+        i = index.find(name)
+        if i < 0:
+            raise KeyError(f'There is no item named {name!r} in the archive {zip_path}')
+        compress_type = int(index.compress_types[i])
+        if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return ZipReader.get_zipfile(zip_path).read(name)
+
+        fd = ZipReader.get_fd(zip_path)
+        header_offset = int(index.header_offsets[i])
+        header = _LOCAL_HEADER.unpack(os.pread(fd, _LOCAL_HEADER.size, header_offset))
+        assert header[0] == _LOCAL_HEADER_SIGNATURE, f'bad local header for {name} in {zip_path}'
+        # the extra field of the local header can differ from the central directory one
+        data_offset = header_offset + _LOCAL_HEADER.size + header[-2] + header[-1]
+        data = os.pread(fd, int(index.compress_sizes[i]), data_offset)
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        return data
+
     @staticmethod
     def read(path):
         zip_path, path_img = ZipReader.split_zip_style_path(path)
-        zfile = ZipReader.get_zipfile(zip_path)
-        data = zfile.read(path_img)
-        return data
+        return ZipReader.read_member(zip_path, path_img)
 
     @staticmethod
     def imread(path):
         zip_path, path_img = ZipReader.split_zip_style_path(path)
-        zfile = ZipReader.get_zipfile(zip_path)
-        data = zfile.read(path_img)
+        data = ZipReader.read_member(zip_path, path_img)
         try:
             im = Image.open(io.BytesIO(data))
         except:
@@ -1,67 +1,123 @@
+from collections import OrderedDict
 from contextlib import contextmanager
 
-import deepspeed
 import torch
+import torch.distributed as dist
 import torch.nn as nn
-from deepspeed.runtime.zero import GatheredParameters
 
 
 class EMADeepspeed(nn.Module):
     """ migrated from https://github.com/microsoft/DeepSpeed/issues/2056
+
+    With ZeRO stage 1/2, parameters are replicated on all the ranks. Like the
+    optimizer states, the fp32 shadow weights are partitioned: each rank keeps
+    and updates a 1/world_size slice of every trainable parameter, with
+    batched foreach ops, every `update_interval` steps. Full weights are only
+    gathered by `copy_to`, `restore` and `state_dict`, a bucket of
+    `gather_bucket_size` elements at a time, and `state_dict` is only
+    materialized (on CPU) on rank 0, which saves the checkpoints.
     """
 
-    def __init__(self, model, decay=0.9999, use_num_updates=True):
+    def __init__(self, model, decay=0.9999, use_num_updates=True, update_interval=1, gather_bucket_size=2 ** 26):
         super().__init__()
         if decay < 0.0 or decay > 1.0:
             raise ValueError('Decay must be between 0 and 1')
+        if update_interval < 1:
+            raise ValueError('Update interval must be at least 1')
 
         self.m_name2s_name = {}
         self.decay = decay
         self.num_updates = 0 if use_num_updates else -1
+        self.update_interval = update_interval
+        self.gather_bucket_size = gather_bucket_size
+        self.num_steps = 0
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        else:
+            self.rank, self.world_size = 0, 1
+
+        # layout of the local partition: a slice of `chunk` elements per parameter
+        self.layout = []
+        offset = 0
+        for name, p in model.named_parameters():
+            if p.requires_grad:
+                assert not hasattr(p, 'ds_id'), 'ZeRO stage 3 is not supported'
+                # remove as '.'-character is not allowed in buffers
+                self.m_name2s_name.update({name: name.replace('.', '')})
+                chunk = (p.numel() + self.world_size - 1) // self.world_size
+                start = min(self.rank * chunk, p.numel())
+                length = min(chunk, p.numel() - start)
+                self.layout.append((name, p.shape, offset, chunk, start, length))
+                offset += chunk
+        device = next(model.parameters()).device
+        self.shadow = torch.zeros(offset, dtype=torch.float32, device=device)
+        self.shadow_slices = self._flat_slices(self.shadow)
+        with torch.no_grad():
+            for s_slice, m_slice in zip(self.shadow_slices, self._model_slices(model)):
+                s_slice.copy_(m_slice)
+        self.collected_params = None
+
+    def _flat_slices(self, flat):
+        return [flat[offset:offset + length] for _, _, offset, _, _, length in self.layout]
 
-        with GatheredParameters(model.parameters(), fwd_module=self):
-            for name, p in model.named_parameters():
-                if p.requires_grad:
-                    # remove as '.'-character is not allowed in buffers
-                    s_name = name.replace('.', '')
-                    self.m_name2s_name.update({name: s_name})
-                    self.register_buffer(s_name, p.clone().detach().data)
-                    # remove as '.'-character is not allowed in buffers
-        self.collected_params = []
+    def _model_slices(self, model):
+        m_param = dict(model.named_parameters())
+        return [m_param[name].data.view(-1)[start:start + length]
+                for name, _, _, _, start, length in self.layout]
+
+    def _buckets(self):
+        """Groups of consecutive parameters of about `gather_bucket_size` elements once gathered."""
+        bucket = []
+        for entry in self.layout:
+            if bucket and (entry[2] + entry[3] - bucket[0][2]) * self.world_size > self.gather_bucket_size:
+                yield bucket
+                bucket = []
+            bucket.append(entry)
+        if bucket:
+            yield bucket
+
+    def _gather(self, flat):
+        """Gather the partitions of all the ranks, yields the name and the full tensor of each parameter.
+        The tensors are only valid until the next one is yielded."""
+        if self.world_size == 1:
+            for name, shape, offset, _, _, _ in self.layout:
+                yield name, flat[offset:offset + shape.numel()].view(shape)
+            return
+        all_gather_into_tensor = getattr(dist, 'all_gather_into_tensor', None) or dist._all_gather_base
+        buffer = None
+        for bucket in self._buckets():
+            start, end = bucket[0][2], bucket[-1][2] + bucket[-1][3]
+            if buffer is None or buffer.numel() < (end - start) * self.world_size:
+                buffer = torch.empty((end - start) * self.world_size, dtype=flat.dtype, device=flat.device)
+            # rank r's partition of the bucket lands in row r
+            full = buffer[:(end - start) * self.world_size].view(self.world_size, end - start)
+            all_gather_into_tensor(full.view(-1), flat[start:end])
+            for name, shape, offset, chunk, _, _ in bucket:
+                yield name, full[:, offset - start:offset - start + chunk].reshape(-1)[:shape.numel()].view(shape)
 
     def forward(self, model):
-        decay = self.decay
+        self.num_steps += 1
+        if self.num_steps % self.update_interval != 0:
+            return
 
+        decay = self.decay
         if self.num_updates >= 0:
             self.num_updates += 1
             decay = min(self.decay, (1 + self.num_updates) / (10 + self.num_updates))
-
-        one_minus_decay = 1.0 - decay
-        shadow_params = dict(self.named_buffers())
+        # one update with decay ** interval approximates interval updates with decay
+        weight = 1.0 - decay ** self.update_interval
 
         with torch.no_grad():
-            with GatheredParameters(model.parameters()):
-                if deepspeed.comm.get_rank() == 0:
-                    m_param = dict(model.named_parameters())
-
-                    for key in m_param:
-                        if m_param[key].requires_grad:
-                            sname = self.m_name2s_name[key]
-                            shadow_params[sname] = shadow_params[sname].type_as(m_param[key])
-                            shadow_params[sname].sub_(one_minus_decay * (shadow_params[sname] - m_param[key]))
-                        else:
-                            assert key not in self.m_name2s_name
+            m_slices = self._model_slices(model)
+            if any(m.dtype != torch.float32 for m in m_slices):
+                m_slices = [m.float() for m in m_slices]
+            torch._foreach_lerp_(self.shadow_slices, m_slices, weight)
 
     def copy_to(self, model):
-        shadow_params = dict(self.named_buffers())
-        with GatheredParameters(model.parameters(), modifier_rank=0):
-            if deepspeed.comm.get_rank() == 0:
-                m_param = dict(model.named_parameters())
-                for key in m_param:
-                    if m_param[key].requires_grad:
-                        m_param[key].data.copy_(shadow_params[self.m_name2s_name[key]].data)
-                    else:
-                        assert key not in self.m_name2s_name
+        m_param = dict(model.named_parameters())
+        with torch.no_grad():
+            for name, full in self._gather(self.shadow):
+                m_param[name].data.copy_(full)
 
     def store(self, model):
         """
@@ -69,10 +125,10 @@ class EMADeepspeed(nn.Module):
         Args:
           model: A model that parameters will be stored
         """
-        with GatheredParameters(model.parameters()):
-            if deepspeed.comm.get_rank() == 0:
-                parameters = model.parameters()
-                self.collected_params = [param.clone() for param in parameters]
+        self.collected_params = torch.zeros_like(self.shadow)
+        with torch.no_grad():
+            for c_slice, m_slice in zip(self._flat_slices(self.collected_params), self._model_slices(model)):
+                c_slice.copy_(m_slice)
 
     def restore(self, model):
         """
@@ -84,11 +140,30 @@ class EMADeepspeed(nn.Module):
         Args:
           model: A model that to restore its parameters.
         """
-        with GatheredParameters(model.parameters(), modifier_rank=0):
-            if deepspeed.comm.get_rank() == 0:
-                parameters = model.parameters()
-                for c_param, param in zip(self.collected_params, parameters):
-                    param.data.copy_(c_param.data)
+        m_param = dict(model.named_parameters())
+        with torch.no_grad():
+            for name, full in self._gather(self.collected_params):
+                m_param[name].data.copy_(full)
+        self.collected_params = None
+
+    def state_dict(self, *args, **kwargs):
+        # full weights, so that checkpoints do not depend on the number of ranks. Every rank takes
+        # part in the gathers, only rank 0, which writes the client state of DeepSpeed, keeps them
+        state_dict = OrderedDict()
+        for name, full in self._gather(self.shadow):
+            if self.rank == 0:
+                state_dict[self.m_name2s_name[name]] = full.to('cpu', copy=True)
+        return state_dict
+
+    def load_state_dict(self, state_dict, strict=True):
+        with torch.no_grad():
+            for (name, _, _, _, start, length), s_slice in zip(self.layout, self.shadow_slices):
+                s_name = self.m_name2s_name[name]
+                if s_name not in state_dict:
+                    if strict:
+                        raise KeyError(f'missing key in EMA state dict: {s_name}')
+                    continue
+                s_slice.copy_(state_dict[s_name].reshape(-1)[start:start + length])
 
     @contextmanager
     def activate(self, model):
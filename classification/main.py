@@ -17,7 +17,7 @@ import torch
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
 from config import get_config
-from dataset import build_loader
+from dataset import build_device_augmentation, build_loader
 from logger import create_logger
 from lr_scheduler import build_scheduler
 from models import build_model
@@ -329,6 +329,9 @@ def main(config):
 
     # train
     logger.info('Start training')
+    device_aug = build_device_augmentation(config)
+    if device_aug is not None:
+        device_aug.cuda()
     start_time = time.time()
     for epoch in range(config.TRAIN.START_EPOCH, config.TRAIN.EPOCHS):
         data_loader_train.sampler.set_epoch(epoch)
@@ -343,7 +346,8 @@ def main(config):
                         lr_scheduler,
                         amp_autocast,
                         loss_scaler,
-                        model_ema=model_ema)
+                        model_ema=model_ema,
+                        device_aug=device_aug)
         if (epoch % config.SAVE_FREQ == 0 or epoch == (config.TRAIN.EPOCHS - 1)) and config.TRAIN.OPTIMIZER.USE_ZERO:
             optimizer.consolidate_state_dict(to=0)
         if dist.get_rank() == 0 and (epoch % config.SAVE_FREQ == 0 or epoch == (config.TRAIN.EPOCHS - 1)):
@@ -410,7 +414,8 @@ def train_one_epoch(config,
                     lr_scheduler,
                     amp_autocast=suppress,
                     loss_scaler=None,
-                    model_ema=None):
+                    model_ema=None,
+                    device_aug=None):
     model.train()
     optimizer.zero_grad()
 
@@ -428,6 +433,8 @@ def train_one_epoch(config,
         iter_begin_time = time.time()
         samples = samples.cuda(non_blocking=True)
         targets = targets.cuda(non_blocking=True)
+        if device_aug is not None:
+            samples = device_aug(samples)
 
         if mixup_fn is not None:
             samples, targets = mixup_fn(samples, targets)
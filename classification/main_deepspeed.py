@@ -17,7 +17,7 @@ import torch
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
 from config import get_config
-from dataset import build_loader
+from dataset import build_device_augmentation, build_loader
 from ddp_hooks import fp16_compress_hook
 from ema_deepspeed import EMADeepspeed
 from logger import create_logger
@@ -222,7 +222,8 @@ def throughput(data_loader, model, logger):
         return
 
 
-def train_epoch(config, model, criterion, data_loader, optimizer, epoch, mixup_fn, lr_scheduler, model_ema=None):
+def train_epoch(config, model, criterion, data_loader, optimizer, epoch, mixup_fn, lr_scheduler, model_ema=None,
+                device_aug=None):
     model.train()
 
     num_steps = len(data_loader)
@@ -238,6 +239,8 @@ def train_epoch(config, model, criterion, data_loader, optimizer, epoch, mixup_f
         iter_begin_time = time.time()
         samples = samples.cuda(non_blocking=True)
         targets = targets.cuda(non_blocking=True)
+        if device_aug is not None:
+            samples = device_aug(samples)
 
         if mixup_fn is not None:
             samples, targets = mixup_fn(samples, targets)
@@ -337,6 +340,9 @@ def train(config, ds_config):
     # -------------- build ---------------- #
 
     _, dataset_val, _, data_loader_train, data_loader_val, _, mixup_fn = build_loader(config)
+    device_aug = build_device_augmentation(config)
+    if device_aug is not None:
+        device_aug.cuda()
     model = build_model(config)
     model.cuda()
 
@@ -364,7 +370,8 @@ def train(config, ds_config):
 
     model_ema = None
     if config.TRAIN.EMA.ENABLE:
-        model_ema = EMADeepspeed(model, config.TRAIN.EMA.DECAY)
+        model_ema = EMADeepspeed(model, config.TRAIN.EMA.DECAY,
+                                 update_interval=config.TRAIN.EMA.UPDATE_INTERVAL)
 
     # -------------- resume ---------------- #
 
@@ -405,7 +412,7 @@ def train(config, ds_config):
     for epoch in range(start_epoch, config.TRAIN.EPOCHS):
         data_loader_train.sampler.set_epoch(epoch)
         train_epoch(config, model, criterion, data_loader_train, optimizer, epoch, mixup_fn, lr_scheduler,
-                    model_ema=model_ema)
+                    model_ema=model_ema, device_aug=device_aug)
 
         if epoch % config.SAVE_FREQ == 0 or epoch == config.TRAIN.EPOCHS - 1:
             model.save_checkpoint(
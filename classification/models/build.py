@@ -29,6 +29,8 @@ def build_model(config):
             pretrained=config.MODEL.INTERN_VIT_6B.PRETRAINED,
             cls_target=config.MODEL.INTERN_VIT_6B.CLS_TARGET,
             head_norm_type=config.MODEL.INTERN_VIT_6B.HEAD_NORM_TYPE,
+            out_index=config.MODEL.INTERN_VIT_6B.OUT_INDEX,
+            prune_unused_blocks=config.MODEL.INTERN_VIT_6B.PRUNE_UNUSED_BLOCKS,
         )
     else:
         raise NotImplementedError(f'Unkown model: {model_type}')
@@ -333,7 +333,7 @@ class InternViT6B(nn.Module):
                  embed_dim=3200, num_heads=25, mlp_ratio=4, init_values=0.1, qk_normalization=True, depth=48,
                  use_flash_attn=True, with_cp=True, layerscale_force_fp32=False, freeze_vit=True,
                  cls_target='cls_patch_concat', num_classes=1000, attn_pool_num_heads=16, clip_embed_dim=768,
-                 head_norm_type='bn', pretrained=None):
+                 head_norm_type='bn', pretrained=None, out_index=-1, prune_unused_blocks=False):
         super().__init__()
         self.num_features = self.embed_dim = embed_dim  # num_features for consistency with other models
 
@@ -360,6 +360,10 @@ class InternViT6B(nn.Module):
 
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]
 
+        # features are taken after block out_index, the next blocks are skipped
+        # in forward, and not even built with prune_unused_blocks
+        self.num_used_blocks = out_index % depth + 1
+        num_blocks = self.num_used_blocks if prune_unused_blocks else depth
         self.blocks = nn.ModuleList([
             Block(embed_dim, num_heads, mlp_ratio, qkv_bias=qkv_bias,
                   norm_layer=norm_layer_for_blocks,
@@ -368,7 +372,7 @@ class InternViT6B(nn.Module):
                   with_cp=with_cp,
                   qk_normalization=qk_normalization,
                   layerscale_force_fp32=layerscale_force_fp32)
-            for i in range(depth)])
+            for i in range(num_blocks)])
 
         if cls_target == 'clip_projector':
             self.clip_projector = AttentionPoolingBlock(
@@ -415,6 +419,9 @@ class InternViT6B(nn.Module):
             checkpoint = torch.load(pretrained, map_location='cpu')
             if 'module' in checkpoint:
                 checkpoint = checkpoint['module']
+            # drop the weights of pruned blocks
+            checkpoint = {k: v for k, v in checkpoint.items()
+                          if not k.startswith('blocks.') or int(k.split('.')[1]) < len(self.blocks)}
 
             # resize pos_embed
             pos_embed = checkpoint['pos_embed']
@@ -439,7 +446,7 @@ class InternViT6B(nn.Module):
         x = torch.cat((cls_tokens, x), dim=1)
         x = x + self.pos_embed
 
-        for idx, blk in enumerate(self.blocks):
+        for idx, blk in enumerate(self.blocks[:self.num_used_blocks]):
             x = blk(x)
         return x
 
@@ -0,0 +1,70 @@
+"""Tests of the batched augmentation of AUG.DEVICE, on CPU tensors."""
+
+import os
+import sys
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import _C  # noqa: E402
+from dataset.device_aug import (DeviceAugmentation,  # noqa: E402
+                                build_device_augmentation,
+                                build_uint8_transform)
+
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+
+
+def random_images(batch_size=8, size=32):
+    return torch.randint(0, 256, (batch_size, 3, size, size), dtype=torch.uint8)
+
+
+def test_normalize_only():
+    images = random_images()
+    expected = transforms.Normalize(MEAN, STD)(images.float() / 255)
+    assert torch.allclose(DeviceAugmentation(MEAN, STD)(images), expected, atol=1e-6)
+
+
+def test_color_jitter():
+    torch.manual_seed(0)
+    images = random_images()
+    x = DeviceAugmentation(MEAN, STD, color_jitter=0.4)(images)
+    # back to [0, 1]: jittered images stay in range and differ per sample
+    x = x * torch.tensor(STD).view(1, 3, 1, 1) + torch.tensor(MEAN).view(1, 3, 1, 1)
+    assert x.min() >= -1e-6 and x.max() <= 1 + 1e-6
+    assert not torch.allclose(x, images.float() / 255, atol=1e-3)
+
+
+def test_random_erasing():
+    torch.manual_seed(0)
+    images = torch.full((64, 3, 32, 32), 255, dtype=torch.uint8)
+    x = DeviceAugmentation((0, 0, 0), (1, 1, 1), re_prob=1., re_mode='const')(images)
+    erased = (x == 0).all(1).float().mean((1, 2))
+    # one rectangle of 2% to 1/3 of the image, rounded, on most images
+    assert (erased > 0).float().mean() > 0.9
+    assert erased.max() <= 0.4
+    x = DeviceAugmentation((0, 0, 0), (1, 1, 1), re_prob=0.)(images)
+    assert (x == 1).all()
+
+
+def test_uint8_transform_keeps_auto_augment():
+    config = _C.clone()
+    config.defrost()
+    config.DATA.IMG_SIZE = 64
+    config.AUG.DEVICE = True
+    transform = build_uint8_transform(config)
+    names = [type(t).__name__ for t in transform.transforms]
+    assert 'RandAugment' in names and 'ColorJitter' not in names
+    image = Image.fromarray(np.random.randint(0, 256, (80, 96, 3), dtype=np.uint8))
+    output = transform(image)
+    assert output.dtype == torch.uint8 and output.shape == (3, 64, 64)
+    # timm does not jitter the colors on top of auto augment
+    assert build_device_augmentation(config).color_jitter == 0
+
+    config.AUG.AUTO_AUGMENT = 'none'
+    names = [type(t).__name__ for t in build_uint8_transform(config).transforms]
+    assert 'RandAugment' not in names
+    assert build_device_augmentation(config).color_jitter == config.AUG.COLOR_JITTER
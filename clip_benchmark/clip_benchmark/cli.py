@@ -4,7 +4,7 @@ import csv
 import json
 import os
 import sys
-from copy import copy
+import time
 
 import torch
 
@@ -12,12 +12,14 @@ from clip_benchmark.datasets.builder import (build_dataset, dataset_collection,
                                              get_dataset_collate_fn,
                                              get_dataset_collection_from_file,
                                              get_dataset_default_task)
+from clip_benchmark.datasets.decoded_cache import uint8_transform
 from clip_benchmark.metrics import (linear_probe, mscoco_generative,
                                     zeroshot_classification,
                                     zeroshot_retrieval)
 from clip_benchmark.model_collection import (get_model_collection_from_file,
                                              model_collection)
 from clip_benchmark.models import MODEL_TYPES, load_clip
+from clip_benchmark.scheduler import schedule
 
 
 def get_parser_args():
@@ -50,6 +52,10 @@ def get_parser_args():
     parser_eval.add_argument('--fewshot_epochs', default=10, type=int, help='for linear probe, how many epochs.')
     parser_eval.add_argument('--fewshot_lr', default=0.1, type=float,
                              help='for linear probe, what is the learning rate.')
+    parser_eval.add_argument('--fewshot_solver', default='sgd', type=str, choices=['sgd', 'lbfgs', 'ridge'],
+                             help="for linear probe, how to fit the probe. 'sgd' trains with AdamW on GPU, 'lbfgs' (logistic regression) and 'ridge' (closed form) fit on CPU from the cached features.")
+    parser_eval.add_argument('--fewshot_wd', default=[1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1], type=float, nargs='+',
+                             help="for linear probe with --fewshot_solver 'lbfgs' or 'ridge', regularization strength(s) to sweep. The best one is selected on a held-out part of the training set.")
     parser_eval.add_argument('--skip_load', action='store_true',
                              help='for linear probes, when everything is cached, no need to load model.')
     parser_eval.add_argument('--seed', default=0, type=int, help='random seed.')
@@ -76,6 +82,16 @@ def get_parser_args():
     parser_eval.add_argument('--model_type', default='open_clip', type=str, choices=MODEL_TYPES, help='clip model type')
     parser_eval.add_argument('--wds_cache_dir', default=None, type=str,
                              help='optional cache directory for webdataset only')
+    parser_eval.add_argument('--wds_decoded_cache_dir', default=None, type=str,
+                             help='optional cache directory for the decoded and resized images, for webdataset only. Reused by all the models with the same preprocessing.')
+    parser_eval.add_argument('--uint8_transfer', default=False, action='store_true',
+                             help='for zero-shot classification, transfer uint8 images to the device and normalize them there, when the transform allows it.')
+    parser_eval.add_argument('--channels_last', default=False, action='store_true',
+                             help='for zero-shot classification, use channels last memory format for the model and images.')
+    parser_eval.add_argument('--devices', default=None, type=int, nargs='+',
+                             help='CUDA device ids to spread the models over, with one worker process per device. By default, everything runs in the current process.')
+    parser_eval.add_argument('--results_table', default=None, type=str,
+                             help='optional CSV file where to write the metrics and timings of all the evaluations.')
     parser_eval.set_defaults(which='eval')
 
     parser_build = subparsers.add_parser('build', help='Build CSV from evaluations')
@@ -156,17 +172,9 @@ def main_eval(base):
         print(f'Datasets: {datasets}')
         print(f'Languages: {languages}')
 
-    for model, pretrained in models:
-        for dataset in datasets:
-            for language in languages:
-                # We iterative over all possible model/dataset/languages
-                # TODO: possibility to parallelize evaluation here
-                args = copy(base)
-                args.model = model
-                args.pretrained = pretrained
-                args.dataset = dataset
-                args.language = language
-                run(args)
+    # Each model is loaded once for all its datasets/languages,
+    # and models are spread over `base.devices` if given.
+    schedule(base, models, datasets, languages)
 
 
 def _as_list(l):
@@ -175,8 +183,14 @@ def _as_list(l):
     return [l] if type(l) != list else l
 
 
-def run(args):
-    """Console script for clip_benchmark."""
+def run(args, cache=None):
+    """
+    Console script for clip_benchmark.
+
+    cache: dict or None
+        optional cache shared by successive calls in the same process, so that the last
+        loaded model and the datasets/dataloaders built with the same transform are reused.
+    """
     args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
     # set seed.
     torch.manual_seed(args.seed)
@@ -209,16 +223,17 @@ def run(args):
     if args.skip_load:
         model, transform, collate_fn, dataloader = None, None, None, None
     else:
-        model, transform, tokenizer = load_clip(
-            model_type=args.model_type,
-            model_name=args.model,
-            pretrained=args.pretrained,
-            cache_dir=args.model_cache_dir,
-            device=args.device
-        )
+        model, transform, tokenizer = _load_clip_cached(args, cache)
         print(transform)
         model.eval()
-        dataset = build_dataset(
+        if args.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        normalize = None
+        if args.uint8_transfer and task == 'zeroshot_classification':
+            # images are normalized on device by `zeroshot_classification.evaluate`
+            transform, normalize = uint8_transform(transform)
+        dataset = _build_dataset_cached(
+            cache,
             dataset_name=args.dataset,
             root=dataset_root,
             transform=transform,
@@ -229,6 +244,7 @@ def run(args):
             task=task,
             cupl=args.cupl,
             wds_cache_dir=args.wds_cache_dir,
+            wds_decoded_cache_dir=args.wds_decoded_cache_dir,
         )
         collate_fn = get_dataset_collate_fn(args.dataset)
         if args.verbose:
@@ -243,17 +259,23 @@ def run(args):
             except:
                 print('Dataset has no classes.')
 
-        if args.dataset.startswith('wds/'):
+        dataloader_key = (id(dataset), args.batch_size, args.num_workers)
+        if cache is not None and dataloader_key in cache.setdefault('dataloaders', {}):
+            dataloader = cache['dataloaders'][dataloader_key]
+        elif args.dataset.startswith('wds/'):
             dataloader = torch.utils.data.DataLoader(
                 dataset.batched(args.batch_size), batch_size=None,
                 shuffle=False, num_workers=args.num_workers,
+                pin_memory=args.device == 'cuda',
             )
         else:
             dataloader = torch.utils.data.DataLoader(
                 dataset, batch_size=args.batch_size,
                 shuffle=False, num_workers=args.num_workers,
-                collate_fn=collate_fn
+                collate_fn=collate_fn, pin_memory=args.device == 'cuda',
             )
+        if cache is not None:
+            cache['dataloaders'][dataloader_key] = dataloader
     if task == 'zeroshot_classification':
         zeroshot_templates = dataset.templates if hasattr(dataset, 'templates') else None
         if args.cupl:
@@ -273,6 +295,8 @@ def run(args):
             cupl=args.cupl,
             save_clf=args.save_clf,
             load_clfs=args.load_clfs,
+            normalize=normalize,
+            channels_last=args.channels_last,
         )
     elif task == 'zeroshot_retrieval':
         metrics = zeroshot_retrieval.evaluate(
@@ -294,7 +318,8 @@ def run(args):
         )
     elif task == 'linear_probe':
         # we also need the train split for linear probing.
-        train_dataset = build_dataset(
+        train_dataset = _build_dataset_cached(
+            cache,
             dataset_name=args.dataset,
             root=dataset_root,
             transform=transform,
@@ -322,6 +347,8 @@ def run(args):
             device=args.device,
             amp=args.amp,
             verbose=args.verbose,
+            solver=args.fewshot_solver,
+            wds=args.fewshot_wd,
         )
     elif task == 'mscoco_generative':
         metrics = mscoco_generative.evaluate(
@@ -350,7 +377,42 @@ def run(args):
     with open(output, 'a') as f:
         f.write(json.dumps(dump) + '\n')
         # json.dump(dump, f)
-    return 0
+    return dump
+
+
+def _load_clip_cached(args, cache):
+    # only the last model is kept, models are expected to be evaluated one after the other.
+    key = (args.model_type, args.model, args.pretrained)
+    if cache is not None and cache.get('model_key') == key:
+        return cache['model']
+    if cache is not None:
+        # free the previous model before loading the next one
+        cache.pop('model', None)
+    start = time.time()
+    model, transform, tokenizer = load_clip(
+        model_type=args.model_type,
+        model_name=args.model,
+        pretrained=args.pretrained,
+        cache_dir=args.model_cache_dir,
+        device=args.device
+    )
+    if cache is not None:
+        cache['model_key'] = key
+        cache['model'] = (model, transform, tokenizer)
+        cache['load_time'] = time.time() - start
+    return model, transform, tokenizer
+
+
+def _build_dataset_cached(cache, **kwargs):
+    # datasets only depend on the model through its transform, so they
+    # can be shared by all the models using the same preprocessing.
+    if cache is None:
+        return build_dataset(**kwargs)
+    key = tuple(sorted((k, repr(v)) for k, v in kwargs.items()))
+    datasets = cache.setdefault('datasets', {})
+    if key not in datasets:
+        datasets[key] = build_dataset(**kwargs)
+    return datasets[key]
 
 
 if __name__ == '__main__':
@@ -4,6 +4,7 @@ import sys
 import warnings
 from subprocess import call
 
+import numpy as np
 import torch
 from torch.utils.data import default_collate
 from torchvision.datasets import (CIFAR10, CIFAR100, DTD, GTSRB, MNIST, PCAM,
@@ -14,6 +15,8 @@ from torchvision.datasets import (CIFAR10, CIFAR100, DTD, GTSRB, MNIST, PCAM,
 
 from . import caltech101, flickr, imagenetv2, objectnet, voc2007
 from .birdsnap import BirdsnapV2
+from .decoded_cache import (DecodedCacheDataset, build_decoded_cache,
+                            cache_path, is_decoded_cache, split_transform)
 from .tools import pre_caption
 
 
@@ -41,7 +44,8 @@ def _load_classnames_and_classification_templates(dataset_name, current_folder,
 
 
 def build_dataset(dataset_name, root='root', transform=None, split='test', download=True, annotation_file=None,
-                  language='en', task='zeroshot_classification', cupl=False, wds_cache_dir=None, **kwargs):
+                  language='en', task='zeroshot_classification', cupl=False, wds_cache_dir=None,
+                  wds_decoded_cache_dir=None, **kwargs):
     """
     Main function to use in order to build a dataset instance,
 
@@ -61,6 +65,10 @@ def build_dataset(dataset_name, root='root', transform=None, split='test', downl
     annotation_file: str or None
         only for datasets with captions (used for retrieval) such as COCO
         and Flickr.
+
+    wds_decoded_cache_dir: str or None
+        only for WebDataset datasets, folder where to cache the decoded images
+        (see `build_wds_dataset`).
     """
     current_folder = os.path.dirname(__file__)
     if task in ('zeroshot_classification', 'linear_probe'):  # Only load templates and classnames if we have to
@@ -470,7 +478,8 @@ def build_dataset(dataset_name, root='root', transform=None, split='test', downl
     elif dataset_name.startswith('wds/'):
         # WebDataset support using `webdataset` library
         name = dataset_name.split('/', 1)[1]
-        ds = build_wds_dataset(name, transform=transform, split=split, data_dir=root, cache_dir=wds_cache_dir)
+        ds = build_wds_dataset(name, transform=transform, split=split, data_dir=root, cache_dir=wds_cache_dir,
+                               decoded_cache_dir=wds_decoded_cache_dir)
         return ds
     elif dataset_name == 'dummy':
         ds = Dummy()
@@ -676,7 +685,7 @@ def build_tfds_dataset(name, transform, download=True, split='test', data_dir='r
     return ds
 
 
-def build_wds_dataset(dataset_name, transform, split='test', data_dir='root', cache_dir=None):
+def build_wds_dataset(dataset_name, transform, split='test', data_dir='root', cache_dir=None, decoded_cache_dir=None):
     """
     Load a dataset in WebDataset format. Either local paths or HTTP URLs can be specified.
     Expected file structure is:
@@ -703,6 +712,13 @@ def build_wds_dataset(dataset_name, transform, split='test', data_dir='root', ca
     (`clip_benchmark.webdataset_builder.convert_dataset`) to convert datasets to this format.
 
     Set `cache_dir` to a path to cache the dataset, otherwise, no caching will occur.
+
+    Set `decoded_cache_dir` to a path to cache the decoded images, i.e. the uint8 images
+    obtained with the part of `transform` before `ToTensor`, in a memory-mapped array.
+    The cache is built on first use and depends on the dataset, split and transform, so later
+    evaluations with the same preprocessing skip decoding and resizing entirely.
+    Only `Compose` transforms ending with `ToTensor` and `Normalize` are supported,
+    other transforms are applied on the fly as usual.
     """
     import webdataset as wds
 
@@ -745,8 +761,31 @@ def build_wds_dataset(dataset_name, transform, split='test', data_dir='root', ca
     dataset = wds.WebDataset(filepattern, cache_dir=cache_dir).decode(
         wds.autodecode.ImageHandler('pil', extensions=['webp', 'png', 'jpg', 'jpeg']))
 
+    if decoded_cache_dir:
+        pre_transform, post_transform = split_transform(transform)
+        if pre_transform is not None:
+            path = cache_path(decoded_cache_dir, dataset_name, split, data_dir, pre_transform)
+            if not is_decoded_cache(path):
+                if dataset_type == 'retrieval':
+                    images = dataset.to_tuple(['webp', 'png', 'jpg', 'jpeg'], 'txt').map_tuple(
+                        lambda image: np.array(pre_transform(image)), str.splitlines)
+                else:
+                    label_type = 'npy' if dataset_type == 'multilabel' else 'cls'
+                    images = dataset.to_tuple(['webp', 'png', 'jpg', 'jpeg'], label_type).map_tuple(
+                        lambda image: np.array(pre_transform(image)), None)
+                target_type = 'captions' if dataset_type == 'retrieval' else 'labels'
+                if not build_decoded_cache(images, path, target_type=target_type, num_workers=min(8, nshards)):
+                    print('WARNING: images do not have the same shape after the transform, no decoded cache used')
+            if is_decoded_cache(path):
+                dataset = DecodedCacheDataset(path, transform=post_transform, to_float=post_transform is not None)
+        else:
+            print('WARNING: transform not supported by the decoded cache, no decoded cache used')
+
     # Load based on classification or retrieval task
-    if dataset_type == 'retrieval':
+    if isinstance(dataset, DecodedCacheDataset):
+        if dataset_type == 'retrieval':
+            dataset.classes = dataset.templates = None
+    elif dataset_type == 'retrieval':
         dataset = (dataset
                    .to_tuple(['webp', 'png', 'jpg', 'jpeg'], 'txt')
                    .map_tuple(transform, str.splitlines)
@@ -758,6 +797,7 @@ def build_wds_dataset(dataset_name, transform, split='test', data_dir='root', ca
                    .to_tuple(['webp', 'png', 'jpg', 'jpeg'], label_type)
                    .map_tuple(transform, None)
                    )
+    if dataset_type != 'retrieval':
         # Get class names if present
         classnames_fname = os.path.join(metadata_dir, 'classnames.txt')
         try:
@@ -0,0 +1,202 @@
+"""
+Cache of decoded images for WebDataset datasets.
+
+Evaluation transforms are deterministic, so the uint8 images obtained after
+decoding, resizing and cropping (i.e., everything before `ToTensor`) can be stored
+once in a memory-mapped array and reused by all the checkpoints evaluated with the
+same preprocessing. Only `ToTensor` scaling and `Normalize` are applied on load
+(or nothing, for transforms ending with `PILToTensor`, see `uint8_transform`).
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+from torchvision.transforms import Compose, Normalize, PILToTensor, ToTensor
+from tqdm import tqdm
+
+
+def split_transform(transform):
+    """
+    Split `transform` into its uint8 part (everything before `ToTensor`) and its
+    `Normalize` part (everything after `ToTensor`).
+
+    Transforms ending with `PILToTensor` (see `uint8_transform`) are split into
+    their part before `PILToTensor` and None, i.e. images stay uint8.
+
+    Returns
+    -------
+
+    (pre, post) transforms, or (None, None) if `transform` is not a `Compose` with a `ToTensor`
+    only followed by `Normalize` transforms, or ending with `PILToTensor`.
+    """
+    if not isinstance(transform, Compose):
+        return None, None
+    transforms = transform.transforms
+    for i, t in enumerate(transforms):
+        if isinstance(t, ToTensor):
+            post = transforms[i + 1:]
+            if all(isinstance(p, Normalize) for p in post):
+                return Compose(transforms[:i]), Compose(post)
+            break
+        if isinstance(t, PILToTensor):
+            if i == len(transforms) - 1:
+                return Compose(transforms[:i]), None
+            break
+    return None, None
+
+
+def uint8_transform(transform):
+    """
+    Make `transform` output uint8 images (`PILToTensor`) instead of normalized float images,
+    so that 4x less bytes are transferred to the device, where the normalization is done.
+
+    Returns
+    -------
+
+    (uint8 transform, normalize transform to apply on device after scaling to [0, 1]),
+    or (transform, None) if `transform` is not supported by `split_transform`.
+    """
+    pre, post = split_transform(transform)
+    if pre is None or post is None:
+        return transform, None
+    return Compose(pre.transforms + [PILToTensor()]), post
+
+
+def transform_signature(transform):
+    # function reprs contain their address, which changes from one run to the other
+    return re.sub(r' at 0x[0-9a-fA-F]+', '', repr(transform))
+
+
+def cache_path(cache_dir, dataset_name, split, data_dir, transform):
+    key = json.dumps([dataset_name, split, data_dir, transform_signature(transform)])
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest())
+
+
+def build_decoded_cache(dataset, path, target_type='labels', num_workers=8):
+    """
+    Write the (uint8 HWC image, target) pairs of the iterable `dataset` to `path`.
+    `target_type` is 'labels' for class ids or multi-label arrays and 'captions' for lists of captions.
+
+    Returns True on success, False if the images do not all have the same shape
+    (in which case nothing is written).
+
+    The cache is written to a temporary directory unique to the process, then renamed to `path`,
+    so that concurrent builds of the same cache (e.g. one per GPU) never write to the same files.
+    The first complete cache is kept and the others are discarded.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.tmp.', dir=parent)
+    # mkdtemp makes the directory private, the cache is shared like the rest of the cache directory
+    os.chmod(tmp_path, 0o755)
+    try:
+        if not _write_decoded_cache(dataset, tmp_path, target_type, num_workers):
+            return False
+        if is_decoded_cache(path):
+            # built by another process in the meantime
+            return True
+        if os.path.exists(path):
+            # not a complete cache
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process renamed its cache to `path` first
+            if not is_decoded_cache(path):
+                raise
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _write_decoded_cache(dataset, tmp_path, target_type, num_workers):
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=num_workers)
+    shape = None
+    targets = []
+    with open(os.path.join(tmp_path, 'images.u8'), 'wb') as f:
+        for image, target in tqdm(dataloader, desc='Caching decoded images'):
+            image = np.ascontiguousarray(image, dtype=np.uint8)
+            if image.ndim == 2:
+                # grayscale, `ToTensor` adds the channel dimension
+                image = image[:, :, None]
+            if shape is None:
+                shape = image.shape
+            elif image.shape != shape:
+                return False
+            f.write(image.tobytes())
+            targets.append(target.numpy() if isinstance(target, torch.Tensor) else target)
+    if shape is None:
+        return False
+    if target_type == 'captions':
+        with open(os.path.join(tmp_path, 'captions.json'), 'w') as f:
+            json.dump(targets, f)
+    else:
+        np.save(os.path.join(tmp_path, 'targets.npy'), np.stack([np.asarray(t) for t in targets]))
+    meta = {'shape': [len(targets), *shape], 'target_type': target_type}
+    # meta.json marks the cache as complete
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return True
+
+
+def is_decoded_cache(path):
+    return os.path.exists(os.path.join(path, 'meta.json'))
+
+
+class DecodedCacheDataset(torch.utils.data.Dataset):
+    """
+    Map-style dataset reading uint8 images from a cache written by `build_decoded_cache`
+    and applying `ToTensor` scaling followed by `transform` (the `Normalize` part).
+    With `to_float=False`, images are returned as uint8 CHW tensors, like `PILToTensor`.
+
+    Like WebDataset pipelines, it supports `.batched(batch_size)`.
+    """
+
+    def __init__(self, path, transform=None, to_float=True):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.images = np.memmap(os.path.join(path, 'images.u8'), dtype=np.uint8, mode='r',
+                                shape=tuple(meta['shape']))
+        if meta['target_type'] == 'captions':
+            with open(os.path.join(path, 'captions.json')) as f:
+                self.targets = json.load(f)
+        else:
+            self.targets = torch.from_numpy(np.load(os.path.join(path, 'targets.npy')))
+        self.transform = transform
+        self.to_float = to_float
+
+    def __len__(self):
+        return len(self.images)
+
+    def _to_tensor(self, images):
+        images = torch.from_numpy(np.array(images)).movedim(-1, -3)
+        if not self.to_float:
+            return images.contiguous()
+        images = images.float().div_(255)
+        return self.transform(images) if self.transform else images
+
+    def __getitem__(self, index):
+        return self._to_tensor(self.images[index]), self.targets[index]
+
+    def batched(self, batch_size):
+        return _BatchedDecodedCacheDataset(self, batch_size)
+
+
+class _BatchedDecodedCacheDataset(torch.utils.data.Dataset):
+
+    def __init__(self, dataset, batch_size):
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, index):
+        batch = slice(index * self.batch_size, (index + 1) * self.batch_size)
+        return self.dataset._to_tensor(self.dataset.images[batch]), self.dataset.targets[batch]
@@ -63,9 +63,9 @@ class FeatureDataset(Dataset):
 
 
 def evaluate(model, train_dataloader, dataloader, fewshot_k, batch_size, num_workers, lr, epochs,
-             model_id, seed, feature_root, device, amp=True, verbose=False):
+             model_id, seed, feature_root, device, amp=True, verbose=False, solver='sgd', wds=(0.,),
+             val_proportion=0.2):
     # warning: we currently only support non-multi-label classification datasets.
-    assert device == 'cuda'  # need to use cuda for this else too slow
     # first we need to featurize the dataset, and store the result in feature_root
     if not os.path.exists(feature_root):
         os.mkdir(feature_root)
@@ -73,10 +73,11 @@ def evaluate(model, train_dataloader, dataloader, fewshot_k, batch_size, num_wor
     if not os.path.exists(feature_dir):
         os.mkdir(feature_dir)
 
-    featurizer = Featurizer(model).cuda()
     autocast = torch.cuda.amp.autocast if amp else suppress
     if not os.path.exists(os.path.join(feature_dir, 'targets_train.pt')):
         # now we have to cache the features
+        assert device == 'cuda'  # need to use cuda for this else too slow
+        featurizer = Featurizer(model).cuda()
         devices = [x for x in range(torch.cuda.device_count())]
         featurizer = torch.nn.DataParallel(featurizer, device_ids=devices)
 
@@ -156,6 +157,13 @@ def evaluate(model, train_dataloader, dataloader, fewshot_k, batch_size, num_wor
 
     features = features[idxs]
     targets = targets[idxs]
+
+    if solver != 'sgd':
+        # closed-form / full-batch solvers, these run on CPU from the cached features.
+        return evaluate_cpu(features, targets, feature_dir, solver, wds, val_proportion,
+                            fewshot_k, seed, verbose=verbose)
+
+    assert device == 'cuda'  # need to use cuda for this else too slow
     feature_dset = FeatureDataset(features, targets)
 
     # now train the model
@@ -234,6 +242,13 @@ def evaluate(model, train_dataloader, dataloader, fewshot_k, batch_size, num_wor
 
     logits = torch.cat(pred)
     target = torch.cat(true)
+    metrics = compute_metrics(logits, target, verbose=verbose)
+    print('acc1:', metrics['lp_acc1'])
+    metrics.update({'lr': lr, 'epochs': epochs, 'seed': seed, 'fewshot_k': fewshot_k})
+    return metrics
+
+
+def compute_metrics(logits, target, verbose=False):
     pred = logits.argmax(axis=1)
 
     # measure accuracy
@@ -245,7 +260,117 @@ def evaluate(model, train_dataloader, dataloader, fewshot_k, batch_size, num_wor
     mean_per_class_recall = balanced_accuracy_score(target, pred)
     if verbose:
         print(classification_report(target, pred, digits=3))
+    return {'lp_acc1': acc1, 'lp_acc5': acc5, 'lp_mean_per_class_recall': mean_per_class_recall}
+
+
+def fit_ridge(features, targets, num_classes, wds):
+    """
+    Fit one-vs-rest ridge regression probes on one-hot targets for every
+    regularization strength in `wds`.
+
+    A single SVD of the centered features gives the closed-form solution for
+    all regularization strengths, so the whole sweep costs one factorization.
+    `wd` is scaled by the number of examples so that it is comparable with `fit_lbfgs`.
+
+    Returns
+    -------
+
+    list of (weight, bias) where weight is (C, D) and bias is (C,), in the same order as `wds`
+    """
+    features = features.double()
+    onehot = F.one_hot(targets, num_classes).double()
+    x_mean = features.mean(dim=0)
+    y_mean = onehot.mean(dim=0)
+    u, s, vh = torch.linalg.svd(features - x_mean, full_matrices=False)
+    uty = u.t() @ (onehot - y_mean)
+    probes = []
+    for wd in wds:
+        denom = s ** 2 + len(features) * wd
+        scale = torch.where(denom > 0, s / denom, torch.zeros_like(s))
+        weight = vh.t() @ (scale.unsqueeze(1) * uty)
+        bias = y_mean - x_mean @ weight
+        probes.append((weight.t().float(), bias.float()))
+    return probes
+
+
+def fit_lbfgs(features, targets, num_classes, wds, max_iter=100):
+    """
+    Fit multinomial logistic regression probes with full-batch L-BFGS for every
+    regularization strength in `wds`.
+
+    Strengths are visited from the strongest to the weakest regularization and each
+    fit is warm-started from the previous solution, which typically converges in a
+    handful of iterations.
+
+    Returns
+    -------
+
+    list of (weight, bias) where weight is (C, D) and bias is (C,), in the same order as `wds`
+    """
+    features = features.float()
+    probe = torch.nn.Linear(features.shape[1], num_classes)
+    torch.nn.init.zeros_(probe.weight)
+    torch.nn.init.zeros_(probe.bias)
+    probes = {}
+    for i in sorted(range(len(wds)), key=lambda i: -wds[i]):
+        wd = wds[i]
+        optimizer = torch.optim.LBFGS(probe.parameters(), lr=1, max_iter=max_iter, history_size=10,
+                                      tolerance_grad=1e-6, line_search_fn='strong_wolfe')
+
+        def closure():
+            optimizer.zero_grad()
+            loss = F.cross_entropy(probe(features), targets) + 0.5 * wd * probe.weight.pow(2).sum()
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+        probes[i] = (probe.weight.detach().clone(), probe.bias.detach().clone())
+    return [probes[i] for i in range(len(wds))]
+
+
+SOLVERS = {
+    'ridge': fit_ridge,
+    'lbfgs': fit_lbfgs,
+}
+
+
+def evaluate_cpu(features, targets, feature_dir, solver, wds, val_proportion, fewshot_k, seed, verbose=False):
+    """
+    Sweep the regularization strengths `wds` with one of the CPU `SOLVERS`, select
+    the best one on a held-out part of the (few-shot) training features, refit on
+    all of them and evaluate on the cached validation features.
+    """
+    wds = list(wds)
+    features = features.float()
+    num_classes = targets.max().item() + 1
+    fit = SOLVERS[solver]
+
+    start = time.time()
+    sweep = []
+    if len(wds) > 1:
+        perm = torch.randperm(len(features))
+        num_val = int(len(features) * val_proportion)
+        if num_val == 0 or num_val == len(features):
+            raise ValueError('not enough training data to select the regularization strength')
+        val_idxs, train_idxs = perm[:num_val], perm[num_val:]
+        probes = fit(features[train_idxs], targets[train_idxs], num_classes, wds)
+        for wd, (weight, bias) in zip(wds, probes):
+            logits = features[val_idxs] @ weight.t() + bias
+            acc1 = (logits.argmax(dim=1) == targets[val_idxs]).float().mean().item()
+            sweep.append({'wd': wd, 'val_acc1': acc1})
+            if verbose:
+                print(f'wd: {wd}\tval acc1: {acc1:.4f}')
+        best_wd = max(sweep, key=lambda r: r['val_acc1'])['wd']
+    else:
+        best_wd = wds[0]
+    weight, bias = fit(features, targets, num_classes, [best_wd])[0]
+    fit_time = time.time() - start
 
-    print('acc1:', acc1)
-    return {'lp_acc1': acc1, 'lp_acc5': acc5, 'lp_mean_per_class_recall': mean_per_class_recall,
-            'lr': lr, 'epochs': epochs, 'seed': seed, 'fewshot_k': fewshot_k}
+    features = torch.load(os.path.join(feature_dir, 'features_val.pt')).float()
+    targets = torch.load(os.path.join(feature_dir, 'targets_val.pt'))
+    logits = features @ weight.t() + bias
+    metrics = compute_metrics(logits, targets, verbose=verbose)
+    print('acc1:', metrics['lp_acc1'])
+    metrics.update({'solver': solver, 'wd': best_wd, 'sweep': sweep, 'fit_time': fit_time,
+                    'seed': seed, 'fewshot_k': fewshot_k})
+    return metrics
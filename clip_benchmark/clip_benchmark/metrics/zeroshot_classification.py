@@ -2,7 +2,10 @@
 Code adapated from https://github.com/mlfoundations/open_clip/blob/main/src/training/zero_shot.py
 Thanks to the authors of OpenCLIP
 """
+import threading
+import time
 from contextlib import suppress
+from queue import Queue
 
 import torch
 import torch.nn.functional as F
@@ -76,7 +79,89 @@ def accuracy(output, target, topk=(1,)):
     return [float(correct[:k].reshape(-1).float().sum(0, keepdim=True).cpu().numpy()) / n for k in topk]
 
 
-def run_classification(model, classifier, dataloader, device, amp=True):
+class DevicePrefetcher:
+    """
+    Iterate over the (images, target) batches of `dataloader`, moved to `device` ahead of time.
+
+    On CUDA, the copy of the next batch is issued on a side stream while the current batch
+    is processed (use a dataloader with `pin_memory=True` so that copies are asynchronous).
+    On other devices, the next batch is loaded by a background thread (double buffering).
+
+    uint8 images (see `clip_benchmark.datasets.decoded_cache.uint8_transform`) are scaled
+    to [0, 1] and normalized with `normalize` on device.
+    """
+
+    def __init__(self, dataloader, device, normalize=None, channels_last=False):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.normalize = normalize
+        self.channels_last = channels_last
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _to_device(self, images, target, non_blocking=False):
+        images = images.to(self.device, non_blocking=non_blocking)
+        target = target.to(self.device, non_blocking=non_blocking)
+        if images.dtype == torch.uint8:
+            images = images.float().div_(255)
+            if self.normalize is not None:
+                images = self.normalize(images)
+        if self.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        return images, target
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._iter_cuda()
+        return self._iter_threaded()
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(self.device)
+        pending = None
+        for images, target in self.dataloader:
+            with torch.cuda.stream(stream):
+                batch = self._to_device(images, target, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(stream)
+            if pending is not None:
+                yield self._wait(*pending)
+            pending = batch, event
+        if pending is not None:
+            yield self._wait(*pending)
+
+    def _wait(self, batch, event):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(event)
+        for tensor in batch:
+            # memory allocated on the side stream is used on the current one
+            tensor.record_stream(current_stream)
+        return batch
+
+    def _iter_threaded(self):
+        queue = Queue(maxsize=1)
+        done = object()
+
+        def load():
+            try:
+                for images, target in self.dataloader:
+                    queue.put(self._to_device(images, target))
+            except Exception as e:
+                queue.put(e)
+            queue.put(done)
+
+        threading.Thread(target=load, daemon=True).start()
+        while True:
+            batch = queue.get()
+            if batch is done:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+
+def run_classification(model, classifier, dataloader, device, amp=True, normalize=None, channels_last=False,
+                       verbose=False):
     """
     Run zero-shot classifcation
 
@@ -88,6 +173,10 @@ def run_classification(model, classifier, dataloader, device, amp=True):
 
     dataloader: torch.utils.data.Dataloader
 
+    normalize: transform applied on device to uint8 images, after scaling them to [0, 1]
+
+    channels_last: whether to feed images in channels last memory format
+
     Returns
     -------
     (pred, true)  where
@@ -98,22 +187,26 @@ def run_classification(model, classifier, dataloader, device, amp=True):
     pred = []
     true = []
     nb = 0
+    start = time.time()
     with torch.no_grad():
-        for images, target in tqdm(dataloader):
-            images = images.to(device)
-            target = target.to(device)
-
+        for images, target in tqdm(DevicePrefetcher(dataloader, device, normalize=normalize,
+                                                    channels_last=channels_last)):
             with autocast():
                 # predict
                 image_features = model.encode_image(images)
                 image_features = F.normalize(image_features, dim=-1)
                 logits = 100. * image_features @ classifier
 
-            true.append(target.cpu())
-            pred.append(logits.float().cpu())
+            # keep everything on device, only one transfer at the end
+            true.append(target)
+            pred.append(logits.float())
+            nb += len(images)
 
-    pred = torch.cat(pred)
-    true = torch.cat(true)
+    pred = torch.cat(pred).cpu()
+    true = torch.cat(true).cpu()
+    if verbose:
+        elapsed = time.time() - start
+        print(f'Classified {nb} images in {elapsed:.1f}s ({nb / max(elapsed, 1e-6):.1f} images/sec)')
     return pred, true
 
 
@@ -159,7 +252,7 @@ def average_precision_per_class(scores, targets):
 
 
 def evaluate(model, dataloader, tokenizer, classnames, templates, device, amp=True, verbose=False, cupl=False,
-             save_clf=None, load_clfs=[]):
+             save_clf=None, load_clfs=[], normalize=None, channels_last=False):
     """
     Run zero-shot classification and evaluate the metrics
 
@@ -185,6 +278,10 @@ def evaluate(model, dataloader, tokenizer, classnames, templates, device, amp=Tr
 
     verbose: whether to use verbose model
 
+    normalize: transform applied on device to uint8 images, after scaling them to [0, 1]
+
+    channels_last: whether to feed images in channels last memory format
+
     Returns
     -------
 
@@ -203,7 +300,8 @@ def evaluate(model, dataloader, tokenizer, classnames, templates, device, amp=Tr
         torch.save(classifier, save_clf)
         # exit() - not sure if we want to exit here or not.
 
-    logits, target = run_classification(model, classifier, dataloader, device, amp=amp)
+    logits, target = run_classification(model, classifier, dataloader, device, amp=amp, normalize=normalize,
+                                        channels_last=channels_last, verbose=verbose)
     is_multilabel = (len(target.shape) == 2)
 
     if is_multilabel:
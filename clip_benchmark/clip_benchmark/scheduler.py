@@ -0,0 +1,127 @@
+"""
+Schedule the (model, dataset, language) evaluations of `clip_benchmark eval`.
+
+Jobs are grouped by model so that each model is loaded only once, datasets and
+dataloaders are shared between models using the same transform, and model groups
+can be spread over several devices with one worker process per device.
+"""
+import csv
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import copy
+
+import torch
+
+_device = None
+# shared by all the jobs of a process, so that datasets are reused across models
+_cache = {}
+
+
+def _init_worker(device_queue):
+    global _device
+    _device = device_queue.get()
+    torch.cuda.set_device(_device)
+
+
+def run_model_jobs(base, model, pretrained, jobs):
+    """
+    Evaluate a model on a list of (dataset, language) jobs, loading it only once.
+
+    Returns
+    -------
+
+    list of dict, one row per job with the metrics and timings, and its status: 'done', 'skipped'
+    (existing results) or 'insufficient_data' (no metrics, see `linear_probe.evaluate`)
+    """
+    from clip_benchmark.cli import run
+
+    cache = _cache
+    rows = []
+    for dataset, language in jobs:
+        # We iterative over all possible datasets/languages of the model
+        args = copy(base)
+        args.model = model
+        args.pretrained = pretrained
+        args.dataset = dataset
+        args.language = language
+        start = time.time()
+        dump = run(args, cache=cache)
+        total_time = time.time() - start
+        load_time = cache.pop('load_time', 0.)
+        row = {
+            'model': model,
+            'pretrained': pretrained,
+            'dataset': dataset,
+            'language': language,
+            'device': _device,
+            'load_time': load_time,
+            'eval_time': total_time - load_time,
+        }
+        if dump is None:
+            row['status'] = 'skipped'
+        elif dump['metrics'] is None:
+            # e.g. few-shot linear probes on datasets with less than k examples of a class
+            row['status'] = 'insufficient_data'
+            row['task'] = dump['task']
+        else:
+            row['status'] = 'done'
+            row['task'] = dump['task']
+            for name, value in dump['metrics'].items():
+                row[name] = value if isinstance(value, (int, float, str)) else json.dumps(value)
+        rows.append(row)
+    return rows
+
+
+def schedule(base, models, datasets, languages):
+    """
+    Evaluate all the `models` on all the `datasets` and `languages`.
+
+    If `base.devices` is set, each model is evaluated in a worker process bound to
+    one of the devices, otherwise everything runs in the current process.
+    If `base.results_table` is set, a CSV with the metrics and timings of all the jobs is written.
+
+    Returns
+    -------
+
+    list of dict, one row per job
+    """
+    jobs = [(dataset, language) for dataset in datasets for language in languages]
+    devices = getattr(base, 'devices', None)
+    rows = []
+    if not devices:
+        for model, pretrained in models:
+            rows.extend(run_model_jobs(base, model, pretrained, jobs))
+    else:
+        # CUDA can not be re-initialized in forked processes
+        context = multiprocessing.get_context('spawn')
+        device_queue = context.Queue()
+        for device in devices:
+            device_queue.put(device)
+        with ProcessPoolExecutor(max_workers=len(devices), mp_context=context,
+                                 initializer=_init_worker, initargs=(device_queue,)) as executor:
+            futures = [executor.submit(run_model_jobs, base, model, pretrained, jobs)
+                       for model, pretrained in models]
+            for future in as_completed(futures):
+                rows.extend(future.result())
+
+    results_table = getattr(base, 'results_table', None)
+    if results_table:
+        write_results_table(rows, results_table)
+        if base.verbose:
+            print(f'Dump results table to: {results_table}')
+    return rows
+
+
+def write_results_table(rows, path):
+    fieldnames = []
+    for row in rows:
+        for field in row.keys():
+            if field not in fieldnames:
+                fieldnames.append(field)
+    with open(path, 'w') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
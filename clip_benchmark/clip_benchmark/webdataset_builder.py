@@ -2,8 +2,13 @@
 
 import argparse
 import io
+import json
 import os
+import shutil
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 import torch
 import torch.utils.data
@@ -45,6 +50,8 @@ def get_parser_args():
                         help='Maximum number of images per TAR shard (Default: 10_000)')
     parser.add_argument('--max-size', default=1_000_000_000, type=int,
                         help='Maximum size in bytes per TAR shard (Default: 1_000_000_000)')
+    parser.add_argument('--num-workers', default=1, type=int,
+                        help='Number of processes writing TAR shards in parallel (Default: 1)')
     args = parser.parse_args()
     return args
 
@@ -74,7 +81,8 @@ def run(args):
             transform=None,
             image_format=args.image_format,
             max_count=args.max_count,
-            max_size=args.max_size
+            max_size=args.max_size,
+            num_workers=args.num_workers,
         )
     else:
         convert_dataset(
@@ -86,6 +94,7 @@ def run(args):
             max_count=args.max_count,
             max_size=args.max_size,
             multilabel=args.multilabel,
+            num_workers=args.num_workers,
         )
 
 
@@ -101,6 +110,8 @@ def PIL_to_bytes(image_format):
         image.save(bytestream, **OPTIONS[image_format])
         return bytestream.getvalue()
 
+    # Mark the transform as a plain encoder, so that files already in `image_format` can be copied as is
+    transform.image_format = image_format
     return transform
 
 
@@ -109,9 +120,179 @@ def path_to_bytes(filepath):
         return fp.read()
 
 
+def _path_extension(filepath):
+    return os.path.splitext(filepath)[1].replace('.', '').lower().replace('jpeg', 'jpg')
+
+
+class EncodedDataset(torch.utils.data.Dataset):
+    """
+    Wrap a dataset of (image, label) pairs to return (encoded image, extension, label) triplets.
+
+    When images are only encoded to `image_format` (`transform=PIL_to_bytes(image_format)`, either
+    here or as the transform of `dataset`) and `dataset.samples` gives the source files, the files
+    already in `image_format` are copied with `path_to_bytes` instead of being decoded and re-encoded.
+    """
+
+    def __init__(self, dataset, transform=None, image_format='webp'):
+        self.dataset = dataset
+        self.transform = transform
+        self.image_format = image_format
+        dataset_transform = getattr(dataset, 'transform', None)
+        self.copy_files = (
+            isinstance(getattr(dataset, 'samples', None), list)
+            and getattr(dataset, 'target_transform', None) is None
+            and (
+                (transform is None and getattr(dataset_transform, 'image_format', None) == image_format)
+                or (dataset_transform is None and getattr(transform, 'image_format', None) == image_format)
+            )
+        )
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        if self.copy_files:
+            filepath, output = self.dataset.samples[index]
+            if isinstance(filepath, str) and _path_extension(filepath) == self.image_format:
+                return path_to_bytes(filepath), self.image_format, output
+        input, output = self.dataset[index]
+        if isinstance(input, str) and self.transform is path_to_bytes:
+            # If copying file, determine image format from extension
+            extension = _path_extension(input) or self.image_format
+        else:
+            extension = self.image_format
+        return (self.transform(input) if self.transform else input), extension, output
+
+
+def _classification_sample(output, multilabel=False):
+    # Convert label if necessary
+    if isinstance(output, torch.Tensor):
+        if multilabel:
+            output = output.detach().cpu().numpy()
+        else:
+            output = output.item()
+    return {'npy' if multilabel else 'cls': output}
+
+
+def _retrieval_sample(output):
+    return {'txt': '\n'.join(caption.replace('\n', r'\n') for caption in output)}
+
+
+def _write_samples(samples, pattern, make_sample, max_count, max_size):
+    # Write (index, (data, extension, output)) items, return the list of [shard file name, number of samples]
+    sink = webdataset.ShardWriter(
+        pattern,
+        maxcount=max_count,
+        maxsize=max_size
+    )
+    shards = []
+    for index, (data, extension, output) in samples:
+        sample = {
+            '__key__': 's%07d' % index,
+            extension: data,
+        }
+        sample.update(make_sample(output))
+        sink.write(sample)
+        if not shards or shards[-1][0] != sink.fname:
+            shards.append([sink.fname, 0])
+        shards[-1][1] += 1
+    sink.close()
+    return shards
+
+
+_worker_dataset = None
+_worker_make_sample = None
+
+
+def _init_shard_worker(dataset, make_sample):
+    global _worker_dataset, _worker_make_sample
+    _worker_dataset = dataset
+    _worker_make_sample = make_sample
+
+
+def _write_index_range(pattern, start, stop, max_count, max_size):
+    samples = ((index, _worker_dataset[index]) for index in range(start, stop))
+    return _write_samples(samples, pattern, _worker_make_sample, max_count, max_size)
+
+
+def write_shards(dataset, split, output_folder, make_sample, *, transform=None, image_format='webp',
+                 max_count=10_000, max_size=1_000_000_000, num_workers=1, verbose=True):
+    """
+    Write the (image, label) pairs of `dataset` to `output_folder/split/{0..N-1}.tar`, together with
+    `nshards.txt` and a `manifest.json` listing the number of samples and first sample index of each shard.
+
+    With `num_workers > 1` (and a `dataset` supporting `len()`), contiguous index ranges are written
+    by separate processes, each to its own shards, which are then renamed in index order.
+
+    Returns the number of samples written.
+    """
+    encoded = EncodedDataset(dataset, transform=transform, image_format=image_format)
+    split_folder = os.path.join(output_folder, split)
+    data_fname = os.path.join(split_folder, r'%d.tar')
+    try:
+        length = len(dataset)
+    except TypeError:
+        length = None
+    start = time.time()
+    if num_workers > 1 and length:
+        parts_folder = os.path.join(split_folder, '_parts')
+        os.makedirs(parts_folder, exist_ok=True)
+        bounds = [length * i // num_workers for i in range(num_workers + 1)]
+        ranges = [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+        with ProcessPoolExecutor(max_workers=len(ranges), initializer=_init_shard_worker,
+                                 initargs=(encoded, make_sample)) as executor:
+            futures = [
+                executor.submit(_write_index_range, os.path.join(parts_folder, f'{worker:05d}_%d.tar'),
+                                lo, hi, max_count, max_size)
+                for worker, (lo, hi) in enumerate(ranges)
+            ]
+            parts = [future.result() for future in tqdm(futures, desc='Converting')]
+        shards = []
+        for part in parts:
+            for fname, count in part:
+                shard_fname = data_fname % len(shards)
+                os.replace(fname, shard_fname)
+                shards.append([shard_fname, count])
+        shutil.rmtree(parts_folder)
+    else:
+        # Multiprocessed dataloader, should work with Dataset or list
+        dataloader = torch.utils.data.DataLoader(
+            encoded,
+            batch_size=1,
+            num_workers=8,
+            collate_fn=lambda batch: batch[0]  # No collate, only for multiprocessing
+        )
+        shards = _write_samples(enumerate(tqdm(dataloader, desc='Converting')), data_fname, make_sample,
+                                max_count, max_size)
+    elapsed = time.time() - start
+    nsamples = sum(count for _, count in shards)
+    num_shards = len(shards)
+    if verbose:
+        print("Saved dataset to '%s'" % data_fname.replace(r'%d', '{0..%d}' % (num_shards - 1)))
+        print('Converted %d images in %.1fs (%.1f images/sec)' % (nsamples, elapsed, nsamples / max(elapsed, 1e-6)))
+    # Save number of shards
+    nshards_fname = os.path.join(split_folder, 'nshards.txt')
+    with open(nshards_fname, 'w') as nshards_file:
+        print(num_shards, end='\n', file=nshards_file)
+    if verbose:
+        print("Saved number of shards = %d to '%s'" % (num_shards, nshards_fname))
+    # Save manifest
+    manifest = {'nsamples': nsamples, 'shards': []}
+    first_index = 0
+    for fname, count in shards:
+        manifest['shards'].append({'name': os.path.basename(fname), 'count': count, 'first_index': first_index})
+        first_index += count
+    manifest_fname = os.path.join(split_folder, 'manifest.json')
+    with open(manifest_fname, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    if verbose:
+        print("Saved manifest to '%s'" % manifest_fname)
+    return nsamples
+
+
 def convert_dataset(dataset, split, output_folder, *, transform=None,
                     image_format='webp', max_count=10_000, max_size=1_000_000_000,
-                    multilabel=False, verbose=True):
+                    multilabel=False, verbose=True, num_workers=1):
     """
     Convert an iterable `dataset` of (image, label) pairs to webdataset (.tar) format, and store in `output_folder/split`.
 
@@ -123,6 +304,7 @@ def convert_dataset(dataset, split, output_folder, *, transform=None,
 
     Copying image files directly or writing raw binary data is fastest since it allows multiprocessing;
     passing in PIL images will be slower, but should work for any format of dataset.
+    Set `num_workers > 1` to write contiguous index ranges of the dataset to TAR shards in parallel processes.
 
     Labels must be zero-indexed integers (for multilabel datasets, labels must be arrays/tensors).
 
@@ -132,13 +314,6 @@ def convert_dataset(dataset, split, output_folder, *, transform=None,
     """
     # Create output directory
     os.makedirs(os.path.join(output_folder, split), exist_ok=True)
-    # Multiprocessed dataloader, should work with Dataset or list
-    dataloader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=1,
-        num_workers=8,
-        collate_fn=lambda batch: batch[0]  # No collate, only for multiprocessing
-    )
     if verbose:
         try:
             print(f'Dataset size: {len(dataset)}')
@@ -170,48 +345,16 @@ def convert_dataset(dataset, split, output_folder, *, transform=None,
             if verbose:
                 print("Saved dataset type to '%s'" % type_fname)
     # Write to TAR files
-    data_fname = os.path.join(output_folder, split, r'%d.tar')
-    sink = webdataset.ShardWriter(
-        data_fname,
-        maxcount=max_count,
-        maxsize=max_size
+    nsamples = write_shards(
+        dataset, split, output_folder, partial(_classification_sample, multilabel=multilabel),
+        transform=transform, image_format=image_format, max_count=max_count, max_size=max_size,
+        num_workers=num_workers, verbose=verbose,
     )
-    nsamples = 0
-    label_type = 'npy' if multilabel else 'cls'
-    for index, (input, output) in enumerate(tqdm(dataloader, desc='Converting')):
-        nsamples += 1
-        if isinstance(input, str) and transform is path_to_bytes:
-            # If copying file, determine image format from extension
-            extension = os.path.splitext(input)[1].replace('.', '').lower().replace('jpeg', 'jpg') or image_format
-        else:
-            extension = image_format
-        # Convert label if necessary
-        if isinstance(output, torch.Tensor):
-            if multilabel:
-                output = output.detach().cpu().numpy()
-            else:
-                output = output.item()
-        # Write example
-        sink.write({
-            '__key__': 's%07d' % index,
-            extension: transform(input) if transform else input,
-            label_type: output,
-        })
-    num_shards = sink.shard
-    sink.close()
-    if verbose:
-        print("Saved dataset to '%s'" % data_fname.replace(r'%d', '{0..%d}' % (num_shards - 1)))
-    # Save number of shards
-    nshards_fname = os.path.join(output_folder, split, 'nshards.txt')
-    with open(nshards_fname, 'w') as nshards_file:
-        print(num_shards, end='\n', file=nshards_file)
-    if verbose:
-        print("Saved number of shards = %d to '%s'" % (num_shards, nshards_fname))
     print('Final dataset size:', nsamples)
 
 
 def convert_retrieval_dataset(dataset, split, output_folder, *, transform=None, image_format='webp', max_count=10_000,
-                              max_size=1_000_000_000, verbose=True):
+                              max_size=1_000_000_000, verbose=True, num_workers=1):
     """
     Convert an iterable `dataset` of (image, [caption1, caption2, ...]) pairs to webdataset (.tar) format, and store in `output_folder/split`.
 
@@ -221,13 +364,6 @@ def convert_retrieval_dataset(dataset, split, output_folder, *, transform=None,
     """
     # Create output directory
     os.makedirs(os.path.join(output_folder, split), exist_ok=True)
-    # Multiprocessed dataloader, should work with Dataset or list
-    dataloader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=1,
-        num_workers=8,
-        collate_fn=lambda batch: batch[0]  # No collate, only for multiprocessing
-    )
     if verbose:
         try:
             print(f'Dataset size: {len(dataset)}')
@@ -242,35 +378,11 @@ def convert_retrieval_dataset(dataset, split, output_folder, *, transform=None,
     if verbose:
         print("Saved dataset type to '%s'" % type_fname)
     # Write to TAR files
-    data_fname = os.path.join(output_folder, split, r'%d.tar')
-    sink = webdataset.ShardWriter(
-        data_fname,
-        maxcount=max_count,
-        maxsize=max_size
+    nsamples = write_shards(
+        dataset, split, output_folder, _retrieval_sample,
+        transform=transform, image_format=image_format, max_count=max_count, max_size=max_size,
+        num_workers=num_workers, verbose=verbose,
     )
-    nsamples = 0
-    for index, (input, output) in enumerate(tqdm(dataloader, desc='Converting')):
-        nsamples += 1
-        if isinstance(input, str) and transform is path_to_bytes:
-            # If copying file, determine image format from extension
-            extension = os.path.splitext(input)[1].replace('.', '').lower().replace('jpeg', 'jpg') or image_format
-        else:
-            extension = image_format
-        sink.write({
-            '__key__': 's%07d' % index,
-            extension: transform(input) if transform else input,
-            'txt': '\n'.join(caption.replace('\n', r'\n') for caption in output),
-        })
-    num_shards = sink.shard
-    sink.close()
-    if verbose:
-        print("Saved dataset to '%s'" % data_fname.replace(r'%d', '{0..%d}' % (num_shards - 1)))
-    # Save number of shards
-    nshards_fname = os.path.join(output_folder, split, 'nshards.txt')
-    with open(nshards_fname, 'w') as nshards_file:
-        print(num_shards, end='\n', file=nshards_file)
-    if verbose:
-        print("Saved number of shards = %d to '%s'" % (num_shards, nshards_fname))
     print('Final dataset size:', nsamples)
 
 
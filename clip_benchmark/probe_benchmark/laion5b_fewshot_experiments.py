@@ -22,8 +22,16 @@ if __name__ == '__main__':
     datasets = ['imagenet1k-unverified']
 
     ks = [1, 2, 4, 8, 16, 32, 64, 128]
-    lrs = [0.1, 0.01, 0.001, 0.0001]
-    epoch_vals = [10, 20, 40, 80]
+    # 'sgd' trains one probe per (epochs, lr) on GPU. 'lbfgs' and 'ridge' fit on CPU from the
+    # cached features and sweep all the regularization strengths `wds` in a single run.
+    solver = 'lbfgs'
+    wds = [1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1]
+    if solver == 'sgd':
+        lrs = [0.1, 0.01, 0.001, 0.0001]
+        epoch_vals = [10, 20, 40, 80]
+    else:
+        lrs = [0.]
+        epoch_vals = [0]
     batch_sizes = [32 * 8]
 
     for epochs in epoch_vals:
@@ -43,13 +51,19 @@ if __name__ == '__main__':
                             args.task = 'linear_probe'
                             args.pretrained = pretrained
                             args.model = model
-                            args.output = '/private/home/mitchellw/git/forks/CLIP_benchmark/probe_benchmark/data/' + f'{model}-{pretrained}-{dataset}-{epochs}-{k}-{lr}-{bs}.json'.replace(
+                            if solver == 'sgd':
+                                name = f'{model}-{pretrained}-{dataset}-{epochs}-{k}-{lr}-{bs}.json'
+                            else:
+                                name = f'{model}-{pretrained}-{dataset}-{solver}-{k}.json'
+                            args.output = '/private/home/mitchellw/git/forks/CLIP_benchmark/probe_benchmark/data/' + name.replace(
                                 '/', '_')
                             if os.path.exists(args.output):
                                 print('skipping - exists.')
                             args.fewshot_k = k
                             args.fewshot_epochs = epochs
                             args.fewshot_lr = lr
+                            args.fewshot_solver = solver
+                            args.fewshot_wd = wds
                             args.batch_size = bs
                             args.skip_load = True  # NOTE
                             run(args)
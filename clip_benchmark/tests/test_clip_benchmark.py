@@ -31,6 +31,9 @@ class base_args:
     load_clfs = []
     model_type = 'open_clip'
     wds_cache_dir = None
+    wds_decoded_cache_dir = None
+    uint8_transfer = False
+    channels_last = False
     which = 'eval'
     skip_existing = False
 
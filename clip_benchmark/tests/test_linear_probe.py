@@ -0,0 +1,45 @@
+"""Tests for the CPU solvers of `clip_benchmark.metrics.linear_probe`."""
+
+import pytest
+import torch
+from sklearn.linear_model import Ridge
+
+from clip_benchmark.metrics.linear_probe import fit_lbfgs, fit_ridge
+
+
+def separable_problem(num_classes=4, dim=16, num_per_class=50, seed=0):
+    # well separated class centers, shared by the train and test splits
+    centers = 4 * torch.randn(num_classes, dim, generator=torch.Generator().manual_seed(0))
+    targets = torch.arange(num_classes).repeat_interleave(num_per_class)
+    features = centers[targets] + torch.randn(len(targets), dim, generator=torch.Generator().manual_seed(seed + 1))
+    return features, targets
+
+
+@pytest.mark.parametrize('fit', [fit_ridge, fit_lbfgs])
+def test_separable(fit):
+    features, targets = separable_problem()
+    test_features, test_targets = separable_problem(seed=1)
+    wds = [1e-1, 1e-6, 1e-3]
+    probes = fit(features, targets, 4, wds)
+    assert len(probes) == len(wds)
+    for weight, bias in probes:
+        assert weight.shape == (4, 16) and bias.shape == (4,)
+        accuracy = ((test_features @ weight.t() + bias).argmax(1) == test_targets).float().mean()
+        assert accuracy >= 0.95
+
+
+def test_ridge_matches_sklearn():
+    features, targets = separable_problem()
+    onehot = torch.nn.functional.one_hot(targets, 4).double().numpy()
+    wds = [1e-2, 1e-4]
+    for wd, (weight, bias) in zip(wds, fit_ridge(features, targets, 4, wds)):
+        # `wd` is scaled by the number of examples
+        ridge = Ridge(alpha=len(features) * wd).fit(features.double().numpy(), onehot)
+        torch.testing.assert_close(weight, torch.from_numpy(ridge.coef_).float(), rtol=1e-4, atol=1e-5)
+        torch.testing.assert_close(bias, torch.from_numpy(ridge.intercept_).float(), rtol=1e-4, atol=1e-5)
+
+
+def test_lbfgs_regularization():
+    features, targets = separable_problem()
+    weak, strong = fit_lbfgs(features, targets, 4, [1e-4, 1e-1])
+    assert strong[0].norm() < weak[0].norm()
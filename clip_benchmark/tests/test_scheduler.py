@@ -0,0 +1,35 @@
+"""Tests for `clip_benchmark.scheduler`, with `cli.run` replaced by canned results."""
+
+import csv
+
+import clip_benchmark.cli
+from clip_benchmark.scheduler import run_model_jobs, write_results_table
+
+
+class base_args:
+    verbose = False
+
+
+def fake_run(args, cache=None):
+    if args.dataset == 'existing':
+        return None
+    metrics = None if args.dataset == 'fewshot' else {'acc1': 0.5, 'per_class': [1, 0]}
+    return {'dataset': args.dataset, 'model': args.model, 'pretrained': args.pretrained,
+            'task': 'linear_probe', 'metrics': metrics, 'language': args.language}
+
+
+def test_run_model_jobs_statuses(monkeypatch, tmp_path):
+    monkeypatch.setattr(clip_benchmark.cli, 'run', fake_run)
+    jobs = [('cifar10', 'en'), ('fewshot', 'en'), ('existing', 'en')]
+    rows = run_model_jobs(base_args, 'ViT-B-32', 'openai', jobs)
+    assert [row['status'] for row in rows] == ['done', 'insufficient_data', 'skipped']
+    assert rows[0]['acc1'] == 0.5 and rows[0]['per_class'] == '[1, 0]'
+    # no metric columns without metrics
+    assert 'acc1' not in rows[1] and rows[1]['task'] == 'linear_probe'
+
+    path = tmp_path / 'results.csv'
+    write_results_table(rows, path)
+    with open(path) as f:
+        table = list(csv.DictReader(f))
+    assert [row['status'] for row in table] == ['done', 'insufficient_data', 'skipped']
+    assert table[1]['acc1'] == ''
@@ -0,0 +1,73 @@
+"""Tests for `clip_benchmark.webdataset_builder`, read back with `build_wds_dataset`."""
+
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from clip_benchmark.datasets.builder import build_wds_dataset
+from clip_benchmark.webdataset_builder import (EncodedDataset, PIL_to_bytes,
+                                               convert_dataset)
+
+
+class ToyDataset(torch.utils.data.Dataset):
+    classes = ['zero', 'one', 'two']
+    templates = ['a photo of a {c}.']
+
+    def __init__(self, num_images=23):
+        rng = np.random.RandomState(0)
+        self.images = [rng.randint(0, 256, (12, 16, 3), dtype=np.uint8) for _ in range(num_images)]
+        self.labels = [i % len(self.classes) for i in range(num_images)]
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return Image.fromarray(self.images[index]), self.labels[index]
+
+
+@pytest.mark.parametrize('num_workers', [1, 3])
+def test_round_trip(tmp_path, num_workers):
+    toy = ToyDataset()
+    convert_dataset(toy, 'test', str(tmp_path), transform=PIL_to_bytes('png'), image_format='png',
+                    max_count=5, num_workers=num_workers, verbose=False)
+
+    with open(tmp_path / 'test' / 'manifest.json') as f:
+        manifest = json.load(f)
+    assert manifest['nsamples'] == len(toy)
+    assert [shard['name'] for shard in manifest['shards']] == [f'{i}.tar' for i in range(len(manifest['shards']))]
+    assert sum(shard['count'] for shard in manifest['shards']) == len(toy)
+    with open(tmp_path / 'test' / 'nshards.txt') as f:
+        assert int(f.read()) == len(manifest['shards'])
+
+    dataset = build_wds_dataset('wds/toy', transform=np.array, split='test', data_dir=str(tmp_path))
+    assert dataset.classes == toy.classes and dataset.templates == toy.templates
+    samples = list(dataset)
+    # shards and samples are in index order
+    assert [label for _, label in samples] == toy.labels
+    for (image, _), expected in zip(samples, toy.images):
+        np.testing.assert_array_equal(image, expected)
+
+
+def test_copy_files(tmp_path):
+    toy = ToyDataset(4)
+    toy.samples = []
+    for i, (image, label) in enumerate(zip(toy.images, toy.labels)):
+        path = os.path.join(tmp_path, f'{i}.png')
+        Image.fromarray(image).save(path)
+        toy.samples.append((path, label))
+    encoded = EncodedDataset(toy, transform=PIL_to_bytes('png'), image_format='png')
+    assert encoded.copy_files
+    for i, (data, extension, label) in enumerate(encoded):
+        with open(toy.samples[i][0], 'rb') as f:
+            assert data == f.read()
+        assert extension == 'png' and label == toy.labels[i]
+    # files in another format are re-encoded
+    for i, (data, extension, label) in enumerate(EncodedDataset(toy, transform=PIL_to_bytes('webp'),
+                                                                 image_format='webp')):
+        assert extension == 'webp'
+        np.testing.assert_array_equal(np.array(Image.open(io.BytesIO(data))), toy.images[i])
@@ -0,0 +1,92 @@
+"""Tests for the device prefetching and uint8 transfer (`--uint8_transfer`) of zero-shot classification."""
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from clip_benchmark.datasets.decoded_cache import uint8_transform
+from clip_benchmark.metrics.zeroshot_classification import (DevicePrefetcher,
+                                                            run_classification)
+
+MEAN = (0.48145466, 0.4578275, 0.40821073)
+STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+class ToyDataset(torch.utils.data.Dataset):
+
+    def __init__(self, transform, num_images=10):
+        rng = np.random.RandomState(0)
+        self.images = [Image.fromarray(rng.randint(0, 256, (40, 48, 3), dtype=np.uint8)) for _ in range(num_images)]
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.transform(self.images[index]), index % 3
+
+
+class ToyModel(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.proj = torch.nn.Linear(3 * 32 * 32, 8)
+
+    def encode_image(self, images):
+        return self.proj(images.reshape(len(images), -1))
+
+
+def clip_transform():
+    return transforms.Compose([
+        transforms.Resize(32),
+        transforms.CenterCrop(32),
+        transforms.ToTensor(),
+        transforms.Normalize(MEAN, STD),
+    ])
+
+
+def loader(transform):
+    return torch.utils.data.DataLoader(ToyDataset(transform), batch_size=4)
+
+
+@pytest.mark.parametrize('channels_last', [False, True])
+def test_prefetcher_matches_loader(channels_last):
+    dataloader = loader(clip_transform())
+    batches = list(DevicePrefetcher(dataloader, 'cpu', channels_last=channels_last))
+    assert len(batches) == len(dataloader)
+    for (images, target), (expected_images, expected_target) in zip(batches, dataloader):
+        torch.testing.assert_close(images, expected_images, rtol=0, atol=0)
+        torch.testing.assert_close(target, expected_target, rtol=0, atol=0)
+        assert images.is_contiguous(memory_format=torch.channels_last) == channels_last
+
+
+def test_prefetcher_raises_loader_errors():
+
+    def failing():
+        yield torch.zeros(1, 3, 2, 2), torch.zeros(1)
+        raise ValueError('broken batch')
+
+    with pytest.raises(ValueError, match='broken batch'):
+        list(DevicePrefetcher(failing(), 'cpu'))
+
+
+def test_uint8_transfer():
+    transform = clip_transform()
+    uint8, normalize = uint8_transform(transform)
+    assert isinstance(uint8.transforms[-1], transforms.PILToTensor)
+    batches = list(DevicePrefetcher(loader(uint8), 'cpu', normalize=normalize))
+    for (images, target), (expected_images, expected_target) in zip(batches, loader(transform)):
+        assert images.dtype == torch.float32
+        torch.testing.assert_close(images, expected_images, rtol=0, atol=1e-5)
+        assert torch.equal(target, expected_target)
+
+    torch.manual_seed(0)
+    model = ToyModel()
+    classifier = torch.nn.functional.normalize(torch.randn(8, 3), dim=0)
+    logits, true = run_classification(model, classifier, loader(transform), 'cpu', amp=False)
+    uint8_logits, uint8_true = run_classification(model, classifier, loader(uint8), 'cpu', amp=False,
+                                                  normalize=normalize)
+    torch.testing.assert_close(uint8_logits, logits, rtol=1e-4, atol=1e-4)
+    assert torch.equal(uint8_true, true)
@@ -4,7 +4,7 @@ import os
 import random
 
 import torch
-from internvl.model.internvl_chat import InternVLChatModel
+from internvl.model.internvl_chat import InternVLChatModel, load_checkpoint
 from internvl.train.dataset import build_transform, dynamic_preprocess
 from PIL import Image
 from tqdm import tqdm
@@ -130,11 +130,12 @@ if __name__ == '__main__':
         os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
     kwargs = {'device_map': 'auto'} if args.auto else {}
     tokenizer = AutoTokenizer.from_pretrained(args.checkpoint, trust_remote_code=True, use_fast=False)
-    model = InternVLChatModel.from_pretrained(
-        args.checkpoint, low_cpu_mem_usage=True, torch_dtype=torch.bfloat16,
-        load_in_8bit=args.load_in_8bit, **kwargs).eval()
-    if not args.load_in_8bit and not args.auto:
-        model = model.cuda()
+    if args.load_in_8bit:
+        model = InternVLChatModel.from_pretrained(
+            args.checkpoint, low_cpu_mem_usage=True, torch_dtype=torch.bfloat16,
+            load_in_8bit=True, **kwargs).eval()
+    else:
+        model = load_checkpoint(args.checkpoint, torch_dtype=torch.bfloat16, **kwargs)
     image_size = model.config.force_image_size or model.config.vision_config.image_size
     use_thumbnail = model.config.use_thumbnail
 
@@ -6,8 +6,9 @@
 
 from .configuration_intern_vit import InternVisionConfig
 from .configuration_internvl_chat import InternVLChatConfig
+from .loading import load_checkpoint
 from .modeling_intern_vit import InternVisionModel
 from .modeling_internvl_chat import InternVLChatModel
 
 __all__ = ['InternVisionConfig', 'InternVisionModel',
-           'InternVLChatConfig', 'InternVLChatModel']
+           'InternVLChatConfig', 'InternVLChatModel', 'load_checkpoint']
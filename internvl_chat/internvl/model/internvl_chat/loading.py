@@ -0,0 +1,133 @@
+# --------------------------------------------------------
+# InternVL
+# Copyright (c) 2023 OpenGVLab
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+"""Loading of InternVL-Chat checkpoints with a bounded host memory.
+
+The model is created on the meta device, then the tensors of the memory-mapped
+safetensors shards are read, cast and moved to their device one at a time: the
+host memory holds one tensor besides the page cache of the shards, instead of
+every weight in the checkpoint dtype and then in the target dtype.
+"""
+import json
+import os
+import resource
+import time
+
+import torch
+from accelerate import (dispatch_model, infer_auto_device_map,
+                        init_empty_weights)
+from accelerate.utils import get_balanced_memory
+from safetensors import safe_open
+from torch import nn
+from transformers.modeling_utils import PreTrainedModel
+from transformers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME
+
+from .modeling_internvl_chat import InternVLChatModel
+
+
+def safetensors_shards(model_path):
+    """{shard file: [tensor names]} of a checkpoint directory, None without safetensors weights."""
+    index_file = os.path.join(model_path, SAFE_WEIGHTS_INDEX_NAME)
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            weight_map = json.load(f)['weight_map']
+        shards = {}
+        for name, shard in weight_map.items():
+            shards.setdefault(os.path.join(model_path, shard), []).append(name)
+        return shards
+    weights_file = os.path.join(model_path, SAFE_WEIGHTS_NAME)
+    if os.path.isfile(weights_file):
+        with safe_open(weights_file, framework='pt') as f:
+            return {weights_file: list(f.keys())}
+    return None
+
+
+def module_device(device_map, name):
+    """Device of the tensor `name` in an accelerate device map, whose keys are module names."""
+    parts = name.split('.')
+    for i in range(len(parts), -1, -1):
+        prefix = '.'.join(parts[:i])
+        if prefix in device_map:
+            return device_map[prefix]
+    raise KeyError(f'{name} is not in the device map')
+
+
+def set_tensor(model, name, value):
+    module_name, _, tensor_name = name.rpartition('.')
+    module = model.get_submodule(module_name)
+    if tensor_name in module._parameters:
+        module._parameters[tensor_name] = nn.Parameter(
+            value, requires_grad=module._parameters[tensor_name].requires_grad)
+    else:
+        module._buffers[tensor_name] = value
+
+
+def load_checkpoint(model_path, torch_dtype=torch.bfloat16, device_map='cuda', model_cls=InternVLChatModel):
+    """Same model as `model_cls.from_pretrained(model_path, torch_dtype=torch_dtype, device_map=device_map)`,
+    with the weights materialized one tensor at a time, directly in `torch_dtype` on their device.
+
+    `device_map` is a device, 'auto' to split the model over the GPUs, or a {module name: device} dict.
+    Checkpoints which are not a local directory with safetensors weights are loaded with from_pretrained.
+    Prints the load time and the peak RSS of the process, which includes the mapped pages of the shards.
+    """
+    start = time.perf_counter()
+    shards = safetensors_shards(model_path) if os.path.isdir(model_path) else None
+    if shards is None:
+        print(f'No safetensors weights in {model_path}, loading with from_pretrained')
+        model = model_cls.from_pretrained(
+            model_path, torch_dtype=torch_dtype, low_cpu_mem_usage=True, device_map=device_map)
+    else:
+        config = model_cls.config_class.from_pretrained(model_path)
+        # like from_pretrained, the buffers computed at init, e.g. the rotary frequencies, are in torch_dtype
+        default_dtype = torch.get_default_dtype()
+        torch.set_default_dtype(torch_dtype)
+        try:
+            with init_empty_weights():
+                model = model_cls(config)
+        finally:
+            torch.set_default_dtype(default_dtype)
+
+        if device_map == 'auto':
+            no_split_module_classes = model._no_split_modules
+            max_memory = get_balanced_memory(
+                model, dtype=torch_dtype, no_split_module_classes=no_split_module_classes)
+            device_map = infer_auto_device_map(
+                model, max_memory=max_memory, no_split_module_classes=no_split_module_classes, dtype=torch_dtype)
+        elif not isinstance(device_map, dict):
+            device_map = {'': device_map}
+
+        expected = set(model.state_dict())
+        loaded, unexpected = set(), []
+        for shard, names in shards.items():
+            with safe_open(shard, framework='pt') as f:
+                for name in names:
+                    if name not in expected:
+                        unexpected.append(name)
+                        continue
+                    tensor = f.get_tensor(name)
+                    dtype = torch_dtype if tensor.is_floating_point() else tensor.dtype
+                    set_tensor(model, name, tensor.to(device=module_device(device_map, name), dtype=dtype))
+                    loaded.add(name)
+        if unexpected:
+            print(f'Unused weights of {model_path}: {unexpected}')
+
+        # the tensors not in the checkpoint: tied weights, and the buffers which are not saved
+        for module in model.modules():
+            if isinstance(module, PreTrainedModel):
+                module.tie_weights()
+        for name, param in model.named_parameters():
+            if param.is_meta:
+                raise ValueError(f'{name} is missing from the checkpoint {model_path}')
+        for name, buffer in model.named_buffers():
+            if name not in loaded:
+                set_tensor(model, name, buffer.to(module_device(device_map, name)))
+        if len(set(device_map.values())) > 1:
+            dispatch_model(model, device_map)
+        model.hf_device_map = device_map
+        model.eval()
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(f'Loaded {model_path} in {time.perf_counter() - start:.1f}s, peak RSS {peak_rss / 2 ** 30:.2f} GiB')
+    return model
@@ -0,0 +1,263 @@
+"""
+In-process metrics of the serving processes, exported in the Prometheus text format on /metrics.
+
+An observation takes a lock and a bisect, the memory gauges are only read when scraped.
+"""
+import bisect
+import math
+import os
+import sys
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+INTER_TOKEN_BUCKETS = (0.005, 0.01, 0.015, 0.02, 0.03, 0.04, 0.05, 0.075, 0.1, 0.25, 0.5, 1)
+TOKEN_BUCKETS = (1, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+TILE_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 40)
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    labels = ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"')) for k, v in labels.items())
+    return '{' + labels + '}'
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        return ''.join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def samples(self):
+        """(name suffix, labels, value) of every sample."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, registry=REGISTRY):
+        super().__init__(name, documentation, registry)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', {}, self.value)]
+
+
+class Gauge(Metric):
+    """Value of `fn` when scraped: a number, None (no sample), or a {label value: number} dict with `labelname`."""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, fn, labelname=None, registry=REGISTRY):
+        super().__init__(name, documentation, registry)
+        self.fn = fn
+        self.labelname = labelname
+
+    def samples(self):
+        value = self.fn()
+        if value is None:
+            return []
+        if self.labelname is None:
+            return [('', {}, value)]
+        return [('', {self.labelname: k}, v) for k, v in value.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, registry)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append(('_bucket', {'le': _format_value(float(bound))}, cumulative))
+        samples.append(('_sum', {}, total))
+        samples.append(('_count', {}, cumulative))
+        return samples
+
+
+def host_memory_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def _gpu_memory(fn_name):
+    # only reported by the processes which use torch
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available():
+        return None
+    return {device: getattr(torch.cuda, fn_name)(device) for device in range(torch.cuda.device_count())}
+
+
+def register_memory_gauges(prefix, registry=REGISTRY):
+    Gauge(f'{prefix}_host_memory_rss_bytes', 'Resident memory of the process', host_memory_rss, registry=registry)
+    for fn_name, documentation in [('memory_allocated', 'GPU memory allocated by tensors'),
+                                   ('max_memory_allocated', 'Peak GPU memory allocated by tensors'),
+                                   ('memory_reserved', 'GPU memory reserved by the caching allocator')]:
+        Gauge(f'{prefix}_gpu_{fn_name}_bytes', documentation, lambda fn_name=fn_name: _gpu_memory(fn_name),
+              labelname='device', registry=registry)
+
+
+class GenerationMetrics(object):
+    """The metrics of a model worker."""
+
+    def __init__(self, registry=REGISTRY):
+        self.requests = Counter('worker_requests_total', 'Generation requests', registry)
+        self.queue_wait = Histogram(
+            'worker_queue_wait_seconds', 'Time from the arrival of a request to the start of its processing',
+            registry=registry)
+        self.image_preprocess = Histogram(
+            'worker_image_preprocess_seconds', 'Image decoding and preprocessing time of a request',
+            registry=registry)
+        self.vision = Histogram('worker_vision_seconds', 'Forward time of the vision model', registry=registry)
+        self.prefill = Histogram(
+            'worker_prefill_seconds', 'Time from the start of generate to the first token, vision model included',
+            registry=registry)
+        self.time_to_first_token = Histogram(
+            'worker_time_to_first_token_seconds', 'Time from the arrival of a request to its first token',
+            registry=registry)
+        self.inter_token = Histogram(
+            'worker_inter_token_seconds', 'Time between two generated tokens', INTER_TOKEN_BUCKETS, registry)
+        self.generated_tokens = Histogram(
+            'worker_generated_tokens', 'Generated tokens per request', TOKEN_BUCKETS, registry)
+        self.generated_tokens_total = Counter('worker_generated_tokens_total', 'Generated tokens', registry)
+        self.tiles = Histogram('worker_tiles_per_request', 'Image tiles per request', TILE_BUCKETS, registry)
+
+
+class TimedStreamer(object):
+    """Wraps the streamer passed to generate, observing the prefill time, the time to the first token,
+    the time between the tokens and the number of generated tokens of the request.
+
+    Created right before generate is called, so that the prefill time includes the forward of the
+    vision model, which the models run in generate before the language model."""
+
+    def __init__(self, streamer, metrics, start_time):
+        self.streamer = streamer
+        self.metrics = metrics
+        self.start_time = start_time
+        self.generate_time = time.perf_counter()
+        self.prompt_skipped = False
+        self.last_time = None
+        self.num_tokens = 0
+
+    def put(self, value):
+        now = time.perf_counter()
+        if not self.prompt_skipped:
+            # the prompt
+            self.prompt_skipped = True
+        elif self.last_time is None:
+            self.metrics.prefill.observe(now - self.generate_time)
+            self.metrics.time_to_first_token.observe(now - self.start_time)
+            self.last_time = now
+            self.num_tokens += value.numel()
+        else:
+            self.metrics.inter_token.observe(now - self.last_time)
+            self.last_time = now
+            self.num_tokens += value.numel()
+        self.streamer.put(value)
+
+    def end(self):
+        self.metrics.generated_tokens.observe(self.num_tokens)
+        self.metrics.generated_tokens_total.inc(self.num_tokens)
+        self.streamer.end()
+
+    def __iter__(self):
+        return iter(self.streamer)
+
+
+class ModuleTimer(object):
+    """Observes the forward time of a module. On GPU, the time is measured with CUDA events which are
+    read once completed (see `collect`), so that the timing does not synchronize the generation."""
+
+    def __init__(self, module, histogram):
+        import torch
+        self.torch = torch
+        self.histogram = histogram
+        self.pending = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.use_events = any(p.is_cuda for p in module.parameters())
+        module.register_forward_pre_hook(self.pre_hook)
+        module.register_forward_hook(self.hook)
+
+    def pre_hook(self, module, args):
+        if self.use_events:
+            self.local.start = self.torch.cuda.Event(enable_timing=True)
+            self.local.start.record()
+        else:
+            self.local.start = time.perf_counter()
+
+    def hook(self, module, args, output):
+        if self.use_events:
+            end = self.torch.cuda.Event(enable_timing=True)
+            end.record()
+            with self.lock:
+                self.pending.append((self.local.start, end))
+            self.collect()
+        else:
+            self.histogram.observe(time.perf_counter() - self.local.start)
+
+    def collect(self):
+        done, pending = [], []
+        with self.lock:
+            for events in self.pending:
+                (done if events[1].query() else pending).append(events)
+            self.pending = pending
+        for start, end in done:
+            self.histogram.observe(start.elapsed_time(end) / 1000)
@@ -1,7 +1,13 @@
 import base64
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
 from io import BytesIO
 
 import torch
+import transformers
+from packaging import version
 from PIL import Image
 from transformers import StoppingCriteria
 
@@ -12,6 +18,80 @@ def load_image_from_base64(image):
     return Image.open(BytesIO(base64.b64decode(image)))
 
 
+IMAGE_REF_PREFIX = 'sha256:'
+
+
+def image_ref(image):
+    """Content address of a base64 encoded image, sent instead of the image once the worker has it."""
+    return IMAGE_REF_PREFIX + hashlib.sha256(image.encode()).hexdigest()
+
+
+class MissingImagesError(KeyError):
+
+    def __init__(self, refs):
+        super().__init__(refs)
+        self.refs = refs
+
+
+class ImageStore(object):
+    """LRU cache of the decoded images of a worker, addressed by `image_ref`.
+
+    Requests may reference images uploaded by earlier requests, e.g. the
+    previous turns of a conversation, instead of sending them again; they
+    are decoded once. `max_bytes` bounds the size of the decoded pixels.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _nbytes(image):
+        return image.width * image.height * len(image.getbands())
+
+    def put(self, ref, image):
+        nbytes = self._nbytes(image)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if ref in self.images:
+                self.images.move_to_end(ref)
+                return
+            self.images[ref] = image
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.size -= self._nbytes(evicted)
+
+    def get(self, ref):
+        with self.lock:
+            image = self.images.get(ref)
+            if image is not None:
+                self.images.move_to_end(ref)
+            return image
+
+    def load(self, images):
+        """Returns the PIL images of a request, each item is a base64 encoded image or
+        the `image_ref` of an image in the store. Raises MissingImagesError with the
+        references which are not (or no longer) in the store."""
+        loaded, missing = [], []
+        for image in images:
+            if image.startswith(IMAGE_REF_PREFIX):
+                ref, pil_image = image, self.get(image)
+                if pil_image is None:
+                    missing.append(ref)
+            else:
+                ref, pil_image = image_ref(image), load_image_from_base64(image)
+                pil_image.load()
+                self.put(ref, pil_image)
+            loaded.append(pil_image)
+        if missing:
+            raise MissingImagesError(missing)
+        return loaded
+
+
 def expand2square(pil_img, background_color):
     width, height = pil_img.size
     if width == height:
@@ -41,27 +121,58 @@ def process_images(images, image_processor, model_cfg):
     return new_images
 
 
-def tokenizer_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX,
-                          num_image_tokens=None, return_tensors=None):
-    prompt_chunks = [tokenizer(chunk).input_ids for chunk in prompt.split('<image>')]
+# input_ids of the prompt chunks between the images, per tokenizer; the chunks of the
+# system prompts and of the previous turns come back with every request of a conversation
+TOKENIZED_CHUNKS_CACHE_SIZE = 4096
+_tokenized_chunks = weakref.WeakKeyDictionary()
+_tokenized_chunks_lock = threading.Lock()
 
-    def insert_separator(X, sep):
-        return [ele for sublist in zip(X, [sep]*len(X)) for ele in sublist][:-1]
 
-    input_ids = []
-    offset = 0
-    if len(prompt_chunks) > 0 and len(prompt_chunks[0]) > 0 and prompt_chunks[0][0] == tokenizer.bos_token_id:
-        offset = 1
-        input_ids.append(prompt_chunks[0][0])
+def tokenize_chunks(tokenizer, chunks):
+    """Returns the input_ids of every chunk, tokenizing the chunks which are not cached in one call."""
+    with _tokenized_chunks_lock:
+        cache = _tokenized_chunks.setdefault(tokenizer, OrderedDict())
+        chunk_ids = []
+        for chunk in chunks:
+            ids = cache.get(chunk)
+            if ids is not None:
+                cache.move_to_end(chunk)
+            chunk_ids.append(ids)
+    missing = list(dict.fromkeys(chunk for chunk, ids in zip(chunks, chunk_ids) if ids is None))
+    if not missing:
+        return chunk_ids
+    tokenized = dict(zip(missing, tokenizer(missing).input_ids))
+    with _tokenized_chunks_lock:
+        for chunk, ids in tokenized.items():
+            cache[chunk] = ids
+        while len(cache) > TOKENIZED_CHUNKS_CACHE_SIZE:
+            cache.popitem(last=False)
+    return [tokenized[chunk] if ids is None else ids for chunk, ids in zip(chunks, chunk_ids)]
 
-    for x in insert_separator(prompt_chunks, [image_token_index] * (offset + num_image_tokens)):
-        input_ids.extend(x[offset:])
 
-    if return_tensors is not None:
-        if return_tensors == 'pt':
-            return torch.tensor(input_ids, dtype=torch.long)
+def tokenizer_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX,
+                          num_image_tokens=None, return_tensors=None):
+    """Tokenizes the text between the <image> placeholders, which are replaced by `num_image_tokens`
+    image tokens. `prompt` may also be a list of prompts, a list of results is then returned."""
+    if return_tensors not in (None, 'pt'):
         raise ValueError(f'Unsupported tensor type: {return_tensors}')
-    return input_ids
+    prompts = [prompt] if isinstance(prompt, str) else prompt
+    prompt_chunks = [p.split('<image>') for p in prompts]
+    chunk_ids = tokenize_chunks(tokenizer, [chunk for chunks in prompt_chunks for chunk in chunks])
+
+    results = []
+    start = 0
+    for chunks in prompt_chunks:
+        first, *others = chunk_ids[start:start + len(chunks)]
+        start += len(chunks)
+        # the chunks after the first one lose their BOS token
+        offset = 1 if len(first) > 0 and first[0] == tokenizer.bos_token_id else 0
+        input_ids = list(first)
+        for ids in others:
+            input_ids.extend([image_token_index] * num_image_tokens)
+            input_ids.extend(ids[offset:])
+        results.append(input_ids if return_tensors is None else torch.tensor(input_ids, dtype=torch.long))
+    return results[0] if isinstance(prompt, str) else results
 
 
 def get_model_name_from_path(model_path):
@@ -73,30 +184,120 @@ def get_model_name_from_path(model_path):
         return model_paths[-1]
 
 
+# transformers >= 4.39 stops the rows of a batch individually
+PER_ROW_STOPPING = version.parse(transformers.__version__) >= version.parse('4.39.0')
+_keyword_matchers = weakref.WeakKeyDictionary()
+_keyword_matchers_lock = threading.Lock()
+
+
+class KeywordMatcher(object):
+    """Aho-Corasick automaton over the token ids of the keywords.
+
+    A keyword may also be generated with other tokens than its own tokenization, `may_end_keyword`
+    flags the tokens whose text can end (or contain) a keyword, only after them the text is checked.
+    """
+
+    def __init__(self, keywords, tokenizer):
+        self.max_len = 0
+        self.goto = [{}]
+        self.fail = [0]
+        self.match = [False]
+        for keyword in keywords:
+            keyword_ids = tokenizer(keyword).input_ids
+            if len(keyword_ids) > 1 and keyword_ids[0] == tokenizer.bos_token_id:
+                keyword_ids = keyword_ids[1:]
+            self.max_len = max(self.max_len, len(keyword_ids))
+            state = 0
+            for token in keyword_ids:
+                if token not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.match.append(False)
+                    self.goto[state][token] = len(self.goto) - 1
+                state = self.goto[state][token]
+            self.match[state] = True
+        # failure links, breadth first
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for token, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and token not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(token, 0)
+                self.match[next_state] = self.match[next_state] or self.match[self.fail[next_state]]
+                queue.append(next_state)
+
+        suffixes = {keyword[i:] for keyword in keywords for i in range(len(keyword))}
+        non_ascii = any(not keyword.isascii() for keyword in keywords)
+        self.may_end_keyword = []
+        pieces = tokenizer.batch_decode([[token] for token in range(len(tokenizer))], skip_special_tokens=True)
+        for piece in pieces:
+            flag = non_ascii and '\ufffd' in piece  # part of a multi-byte character
+            # decoded alone, the piece may have lost its leading space
+            for text in (piece, ' ' + piece):
+                flag = flag or any(keyword in text for keyword in keywords) \
+                    or any(text[:i] in suffixes for i in range(1, len(text) + 1))
+            self.may_end_keyword.append(flag)
+
+    def step(self, state, token):
+        while state and token not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(token, 0)
+
+    def needs_decode(self, token):
+        return token >= len(self.may_end_keyword) or self.may_end_keyword[token]
+
+
+def keyword_matcher(keywords, tokenizer):
+    """KeywordMatcher of the keywords, built once per tokenizer."""
+    with _keyword_matchers_lock:
+        matchers = _keyword_matchers.setdefault(tokenizer, {})
+        if tuple(keywords) not in matchers:
+            matchers[tuple(keywords)] = KeywordMatcher(keywords, tokenizer)
+        return matchers[tuple(keywords)]
+
+
 class KeywordsStoppingCriteria(StoppingCriteria):
+    """Stops every row of the batch once it generates one of the keywords.
+
+    The new token of each row advances its state in the KeywordMatcher of the keywords, the last
+    tokens are only decoded when the token may end a keyword tokenized differently. The finished
+    rows are marked in `finished`, generate stops when all of them are finished (with transformers
+    >= 4.39, the finished rows are padded meanwhile).
+    """
+
     def __init__(self, keywords, tokenizer, input_ids):
         self.keywords = keywords
-        self.keyword_ids = []
-        self.max_keyword_len = 0
-        for keyword in keywords:
-            cur_keyword_ids = tokenizer(keyword).input_ids
-            if len(cur_keyword_ids) > 1 and cur_keyword_ids[0] == tokenizer.bos_token_id:
-                cur_keyword_ids = cur_keyword_ids[1:]
-            if len(cur_keyword_ids) > self.max_keyword_len:
-                self.max_keyword_len = len(cur_keyword_ids)
-            self.keyword_ids.append(torch.tensor(cur_keyword_ids))
         self.tokenizer = tokenizer
+        self.matcher = keyword_matcher(keywords, tokenizer)
+        self.max_keyword_len = self.matcher.max_len
         self.start_len = input_ids.shape[1]
+        self.num_seen = input_ids.shape[1]
+        self.finished = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        # a keyword may start in the prompt
+        self.states = [0] * input_ids.shape[0]
+        if self.max_keyword_len > 1:
+            for row, ids in enumerate(input_ids[:, -(self.max_keyword_len - 1):].tolist()):
+                for token in ids:
+                    self.states[row] = self.matcher.step(self.states[row], token)
 
-    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        assert output_ids.shape[0] == 1, 'Only support batch size 1 (yet)'  # TODO
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        new_ids = output_ids[:, self.num_seen:].tolist()
+        self.num_seen = output_ids.shape[1]
         offset = min(output_ids.shape[1] - self.start_len, self.max_keyword_len)
-        self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
-        for keyword_id in self.keyword_ids:
-            if (output_ids[0, -keyword_id.shape[0]:] == keyword_id).all():
-                return True
-        outputs = self.tokenizer.batch_decode(output_ids[:, -offset:], skip_special_tokens=True)[0]
-        for keyword in self.keywords:
-            if keyword in outputs:
-                return True
-        return False
+        finished = self.finished.tolist()
+        for row, ids in enumerate(new_ids):
+            if finished[row]:
+                continue
+            needs_decode = False
+            for token in ids:
+                self.states[row] = self.matcher.step(self.states[row], token)
+                finished[row] = finished[row] or self.matcher.match[self.states[row]]
+                needs_decode = needs_decode or self.matcher.needs_decode(token)
+            if not finished[row] and needs_decode:
+                outputs = self.tokenizer.decode(output_ids[row, -offset:], skip_special_tokens=True)
+                finished[row] = any(keyword in outputs for keyword in self.keywords)
+        self.finished = torch.tensor(finished, dtype=torch.bool, device=output_ids.device)
+        if PER_ROW_STOPPING:
+            return self.finished.clone()
+        return all(finished)
@@ -14,18 +14,22 @@ import requests
 import torch
 import uvicorn
 from fastapi import BackgroundTasks, FastAPI, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from internvl.train.dataset import dynamic_preprocess
 from transformers import (AutoTokenizer, CLIPImageProcessor,
                           TextIteratorStreamer)
 
-from ..model.internvl_chat import InternVLChatModel
+from ..model.internvl_chat import InternVLChatModel, load_checkpoint
 from .constants import (DEFAULT_IM_END_TOKEN, DEFAULT_IM_START_TOKEN,
                         DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IMAGE_TOKEN,
                         IMAGE_TOKEN_INDEX, WORKER_HEART_BEAT_INTERVAL)
-from .mm_utils import (KeywordsStoppingCriteria, load_image_from_base64,
-                       process_images, tokenizer_image_token)
-from .utils import build_logger, pretty_print_semaphore, server_error_msg
+from .metrics import (REGISTRY, Gauge, GenerationMetrics, ModuleTimer,
+                      TimedStreamer, register_memory_gauges)
+from .mm_utils import (ImageStore, KeywordsStoppingCriteria,
+                       MissingImagesError, process_images,
+                       tokenizer_image_token)
+from .utils import (build_logger, encode_stream, pretty_print_semaphore,
+                    server_error_msg)
 
 GB = 1 << 30
 
@@ -47,7 +51,7 @@ class ModelWorker:
     def __init__(self, controller_addr, worker_addr,
                  worker_id, no_register,
                  model_path, model_base, model_name,
-                 load_8bit, load_4bit, device):
+                 load_8bit, load_4bit, device, image_store_size=1024):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
@@ -69,13 +73,14 @@ class ModelWorker:
             import os
             os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
             # This can make distributed deployment work properly, wonder why
+        if load_8bit:
+            kwargs = {'device_map': 'auto'} if device == 'auto' else {}
             self.model = InternVLChatModel.from_pretrained(
-                model_path, load_in_8bit=load_8bit, torch_dtype=torch.float16, device_map='auto').eval()
+                model_path, load_in_8bit=True, torch_dtype=torch.float16, **kwargs).eval()
         else:
-            self.model = InternVLChatModel.from_pretrained(
-                model_path, load_in_8bit=load_8bit, torch_dtype=torch.float16).eval()
-        if not load_8bit and not device == 'auto':
-            self.model = self.model.cuda()
+            # the weights are materialized one tensor at a time, in fp16 on the GPUs
+            self.model = load_checkpoint(
+                model_path, torch_dtype=torch.float16, device_map='auto' if device == 'auto' else 'cuda')
         self.image_size = self.model.config.force_image_size
         self.image_processor = CLIPImageProcessor(
             crop_size=self.image_size, do_center_crop=True, do_normalize=True, do_resize=True,
@@ -83,6 +88,11 @@ class ModelWorker:
         )
         self.context_len = 12800
         self.is_multimodal = True
+        self.image_store = ImageStore(image_store_size * 2 ** 20)
+        self.metrics = GenerationMetrics()
+        Gauge('worker_queue_length', 'Requests running or waiting for the model semaphore', self.get_queue_length)
+        register_memory_gauges('worker')
+        self.vision_timer = ModuleTimer(self.model.vision_model, self.metrics.vision)
 
         if not no_register:
             self.register_to_controller()
@@ -135,10 +145,12 @@ class ModelWorker:
             'model_names': [self.model_name],
             'speed': 1,
             'queue_length': self.get_queue_length(),
+            # requests may reference the images of earlier requests, see ImageStore
+            'image_store': True,
         }
 
     @torch.inference_mode()
-    def generate_stream(self, params):
+    def generate_stream(self, params, start_time):
         tokenizer, model, image_processor = self.tokenizer, self.model, self.image_processor
 
         prompt = params['prompt']
@@ -153,7 +165,8 @@ class ModelWorker:
                     raise ValueError('Number of images does not match number of <image> tokens in prompt')
                 logger.info(f'dynamic_image_size: {model.config.dynamic_image_size}')
                 logger.info(f'use_thumbnail: {model.config.use_thumbnail}')
-                images = [load_image_from_base64(image) for image in images]
+                preprocess_start = time.perf_counter()
+                images = self.image_store.load(images)
                 if model.config.dynamic_image_size:
                     images = dynamic_preprocess(
                         images[0], image_size=self.image_size, max_num=max_input_tiles,
@@ -166,6 +179,8 @@ class ModelWorker:
                     images = [image.to(self.model.device, dtype=torch.float16) for image in images]
                 else:
                     images = images.to(self.model.device, dtype=torch.float16)
+                self.metrics.image_preprocess.observe(time.perf_counter() - preprocess_start)
+                self.metrics.tiles.observe(images.size(0))
                 # images = torch.concat(images)
                 logger.info(f'Split images to {images.shape}')
 
@@ -187,6 +202,7 @@ class ModelWorker:
         max_context_length = getattr(model.config, 'max_position_embeddings', 16384)
         max_new_tokens = int(params.get('max_new_tokens', 1024))
         stop_str = params.get('stop', None)
+        stream_version = int(params.get('stream_version', 1))
         do_sample = True if temperature > 0.001 else False
         logger.info(f'num_image_tokens: {num_image_tokens}')
         logger.info(f'stop_str: {stop_str}')
@@ -202,7 +218,8 @@ class ModelWorker:
         max_new_tokens = min(max_new_tokens, max_context_length - input_ids.shape[-1])
         logger.info(f'max_new_tokens: {max_new_tokens}')
         if max_new_tokens < 1:
-            yield json.dumps({'text': ori_prompt + 'Exceeds max token length. Please start a new conversation, thanks.', 'error_code': 0}).encode() + b'\0'
+            yield from encode_stream(['Exceeds max token length. Please start a new conversation, thanks.'],
+                                     ori_prompt, stream_version=stream_version)
             return
 
         thread = Thread(target=model.generate, kwargs=dict(
@@ -212,23 +229,27 @@ class ModelWorker:
             repetition_penalty=1.0,
             top_p=top_p,
             max_new_tokens=max_new_tokens,
-            streamer=streamer,
+            streamer=TimedStreamer(streamer, self.metrics, start_time),
             eos_token_id=eos_token_id,
             **image_args
         ))
         thread.start()
 
-        generated_text = ori_prompt
-        for new_text in streamer:
-            generated_text += new_text
-            if generated_text.endswith(stop_str):
-                generated_text = generated_text[:-len(stop_str)]
-            yield json.dumps({'text': generated_text, 'error_code': 0}).encode() + b'\0'
+        yield from encode_stream(streamer, ori_prompt, stop_str, stream_version)
 
-    def generate_stream_gate(self, params):
+    def generate_stream_gate(self, params, start_time):
+        self.metrics.requests.inc()
         try:
-            for x in self.generate_stream(params):
+            for x in self.generate_stream(params, start_time):
                 yield x
+        except MissingImagesError as e:
+            # the client sends these images again
+            ret = {
+                'text': server_error_msg,
+                'error_code': 4,
+                'missing_images': e.refs,
+            }
+            yield json.dumps(ret).encode() + b'\0'
         except ValueError as e:
             print('Caught ValueError:', e)
             ret = {
@@ -264,14 +285,16 @@ def release_model_semaphore(fn=None):
 @app.post('/worker_generate_stream')
 async def generate_stream(request: Request):
     global model_semaphore, global_counter
+    start_time = time.perf_counter()
     global_counter += 1
     params = await request.json()
 
     if model_semaphore is None:
         model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
     await model_semaphore.acquire()
+    worker.metrics.queue_wait.observe(time.perf_counter() - start_time)
     worker.send_heart_beat()
-    generator = worker.generate_stream_gate(params)
+    generator = worker.generate_stream_gate(params, start_time)
     background_tasks = BackgroundTasks()
     background_tasks.add_task(partial(release_model_semaphore, fn=worker.send_heart_beat))
     return StreamingResponse(generator, background=background_tasks)
@@ -282,6 +305,12 @@ async def get_status(request: Request):
     return worker.get_status()
 
 
+@app.get('/metrics')
+async def metrics():
+    worker.vision_timer.collect()
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', type=str, default='localhost')
@@ -300,6 +329,7 @@ if __name__ == '__main__':
     parser.add_argument('--no-register', action='store_true')
     parser.add_argument('--load-8bit', action='store_true')
     parser.add_argument('--load-4bit', action='store_true')
+    parser.add_argument('--image-store-size', type=int, default=1024, help='MB of decoded images kept for later requests')
     args = parser.parse_args()
     logger.info(f'args: {args}')
 
@@ -315,5 +345,6 @@ if __name__ == '__main__':
                          args.model_name,
                          args.load_8bit,
                          args.load_4bit,
-                         args.device)
+                         args.device,
+                         args.image_store_size)
     uvicorn.run(app, host=args.host, port=args.port, log_level='info')
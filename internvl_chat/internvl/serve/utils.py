@@ -1,4 +1,5 @@
 import datetime
+import json
 import logging
 import logging.handlers
 import os
@@ -124,3 +125,42 @@ def pretty_print_semaphore(semaphore):
     if semaphore is None:
         return 'None'
     return f'Semaphore(value={semaphore._value}, locked={semaphore.locked()})'
+
+
+def _stop_prefix_len(text, stop_str):
+    """Length of the longest suffix of `text` which is a prefix of `stop_str`."""
+    for n in range(min(len(text), len(stop_str)), 0, -1):
+        if stop_str.startswith(text[-n:]):
+            return n
+    return 0
+
+
+def encode_stream(text_iter, prompt='', stop_str=None, stream_version=1):
+    """Encode the text pieces of a generation as the chunks of /worker_generate_stream.
+
+    Version 1 sends the prompt and all the text generated so far in every chunk.
+    Version 2 sends the new text only, as `delta` with a sequence number
+    `seq`, the last chunk has `finished` set. Text which may be the start of
+    `stop_str` is held back until it is not, so that deltas never have to be
+    taken back when `stop_str` is removed, and the concatenated deltas are the
+    text of the last version 1 chunk without the prompt.
+    """
+    generated_text = prompt if stream_version == 1 else ''
+    sent = 0
+    seq = 0
+    for new_text in text_iter:
+        generated_text += new_text
+        if stop_str and generated_text.endswith(stop_str):
+            generated_text = generated_text[:-len(stop_str)]
+        if stream_version == 1:
+            yield json.dumps({'text': generated_text, 'error_code': 0}).encode() + b'\0'
+            continue
+        end = len(generated_text) - (_stop_prefix_len(generated_text, stop_str) if stop_str else 0)
+        if end > sent:
+            chunk = {'version': 2, 'seq': seq, 'delta': generated_text[sent:end], 'error_code': 0}
+            yield json.dumps(chunk).encode() + b'\0'
+            sent = end
+            seq += 1
+    if stream_version != 1:
+        chunk = {'version': 2, 'seq': seq, 'delta': generated_text[sent:], 'finished': True, 'error_code': 0}
+        yield json.dumps(chunk).encode() + b'\0'
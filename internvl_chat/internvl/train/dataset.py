@@ -1,4 +1,5 @@
 import io
+import math
 
 from transformers.trainer_pt_utils import LabelSmoother
 
@@ -39,12 +40,28 @@ class WeightedConcatDataset(ConcatDataset):
         return self.total_size
 
 
-def pil_loader(img_str):
-    buff = io.BytesIO(img_str)
-    img = Image.open(buff)
+def load_image(fp, min_size_fn=None):
+    """Open an image as RGB.
+
+    With `min_size_fn` (original (width, height) -> minimum (width, height), see
+    `reduced_decode_size`), JPEG images are decoded with DCT scaling at the
+    smallest 1/2, 1/4 or 1/8 scale still at least that large. The original size
+    is kept in `img.info['original_size']`, so that `dynamic_preprocess` picks
+    the same tile grid as with a full decode.
+    """
+    img = Image.open(fp)
+    if min_size_fn is not None and img.format == 'JPEG':
+        orig_size = img.size
+        img.draft('RGB', tuple(min_size_fn(orig_size)))
+        img.info['original_size'] = orig_size
     return img.convert('RGB')
 
 
+def pil_loader(img_str, min_size_fn=None):
+    buff = io.BytesIO(img_str)
+    return load_image(buff, min_size_fn)
+
+
 class TCSLoader(object):
 
     def __init__(self, conf_path, sc_config_key='sensecore'):
@@ -54,9 +71,9 @@ class TCSLoader(object):
         self.sc_config_key = sc_config_key
         print('--> after Client(conf_path)')
 
-    def __call__(self, fn):
+    def __call__(self, fn, min_size_fn=None):
         img_value_str = self.client.get(fn)
-        img = pil_loader(img_value_str)
+        img = pil_loader(img_value_str, min_size_fn)
         return img
 
 
@@ -639,15 +656,34 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
     return best_ratio
 
 
+def get_target_ratios(min_num, max_num):
+    target_ratios = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+        i * j <= max_num and i * j >= min_num)
+    return sorted(target_ratios, key=lambda x: x[0] * x[1])
+
+
+def reduced_decode_size(orig_size, image_size, dynamic_image_size=False, min_num=1, max_num=6, pad2square=False):
+    """Smallest decoded (width, height) that keeps the resolution of the model inputs:
+    the tile grid chosen by `dynamic_preprocess`, or the single (padded) input image."""
+    width, height = orig_size
+    if dynamic_image_size:
+        target_aspect_ratio = find_closest_aspect_ratio(
+            width / height, get_target_ratios(min_num, max_num), width, height, image_size)
+        return image_size * target_aspect_ratio[0], image_size * target_aspect_ratio[1]
+    if pad2square:
+        scale = image_size / max(width, height)
+        return math.ceil(width * scale), math.ceil(height * scale)
+    return image_size, image_size
+
+
 def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
-    orig_width, orig_height = image.size
+    # size before a reduced decode (see load_image), the tile grid must not depend on it
+    orig_width, orig_height = image.info.get('original_size', image.size)
     aspect_ratio = orig_width / orig_height
 
     # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    target_ratios = get_target_ratios(min_num, max_num)
 
     # find the closest aspect ratio to the target
     target_aspect_ratio = find_closest_aspect_ratio(
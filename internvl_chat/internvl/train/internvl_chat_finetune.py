@@ -7,6 +7,7 @@ import sys
 import warnings
 from copy import deepcopy
 from dataclasses import dataclass, field
+from functools import partial
 from typing import Dict, Optional
 
 import orjson as json
@@ -28,9 +29,9 @@ from internvl.train.constants import (BOX_END_TOKEN, BOX_START_TOKEN,
                                       REF_START_TOKEN)
 from internvl.train.dataset import (ConcatDataset, TCSLoader,
                                     WeightedConcatDataset, build_transform,
-                                    dynamic_preprocess, preprocess,
+                                    dynamic_preprocess, load_image, preprocess,
                                     preprocess_internlm, preprocess_mpt,
-                                    preprocess_phi3)
+                                    preprocess_phi3, reduced_decode_size)
 from internvl.train.trainer_monkey_patch import replace_create_optimizer
 from PIL import Image, ImageFile, PngImagePlugin
 from torch.utils.data import Dataset
@@ -201,6 +202,12 @@ class DataTrainingArguments:
         default='imagenet',
         metadata={'help': 'The normalize type for the image. Default is imagenet.'},
     )
+    reduced_decode: Optional[bool] = field(
+        default=False,
+        metadata={'help': 'Set to True to decode JPEG images at the smallest DCT scale '
+                          'still larger than the image tiles. Off by default: the decoded pixels '
+                          'differ from a full decode, and the effect on accuracy has not been measured.'},
+    )
 
 
 class LazySupervisedDataset(Dataset):
@@ -209,7 +216,8 @@ class LazySupervisedDataset(Dataset):
     def __init__(self, template_name, meta, tokenizer, tcs_loader, num_image_token,
                  image_size=224, is_train=True, pad2square=False, group_by_length=False,
                  dynamic_image_size=False, use_thumbnail=False, min_dynamic_patch=1,
-                 max_dynamic_patch=6, repeat_time=1, normalize_type='imagenet'):
+                 max_dynamic_patch=6, repeat_time=1, normalize_type='imagenet',
+                 reduced_decode=False):
         super(LazySupervisedDataset, self).__init__()
         self.tokenizer = tokenizer
         self.template_name = template_name
@@ -239,6 +247,7 @@ class LazySupervisedDataset(Dataset):
         self.min_dynamic_patch = min_dynamic_patch
         self.max_dynamic_patch = max_dynamic_patch
         self.normalize_type = normalize_type
+        self.reduced_decode = reduced_decode
         if self.group_by_length:
             self.conv2length = {}  # using dict to speedup the calculation of token length
             self.length = []
@@ -271,10 +280,15 @@ class LazySupervisedDataset(Dataset):
             image_path = self.root + data_item['image']
         else:
             image_path = os.path.join(self.root, data_item['image'])
+        min_size_fn = None
+        if self.reduced_decode:
+            min_size_fn = partial(reduced_decode_size, image_size=self.image_size,
+                                  dynamic_image_size=self.dynamic_image_size, min_num=self.min_dynamic_patch,
+                                  max_num=self.max_dynamic_patch, pad2square=self.pad2square)
         if self.tcs_loader is not None:
-            image = self.tcs_loader(image_path)
+            image = self.tcs_loader(image_path, min_size_fn)
         else:
-            image = Image.open(image_path).convert('RGB')
+            image = load_image(image_path, min_size_fn)
         transform = build_transform(is_train=self.is_train, input_size=self.image_size,
                                     pad2square=self.pad2square, normalize_type=self.normalize_type)
         if self.dynamic_image_size:
@@ -389,6 +403,7 @@ def build_datasets(data_args, tokenizer, tcs_loader, model, group_by_length=Fals
                 max_dynamic_patch=max_num,
                 repeat_time=repeat_time,
                 normalize_type=normalize_type,
+                reduced_decode=data_args.reduced_decode,
             )
         except Exception:
             logger.info(f'Error in loading dataset: {ds_name}')
@@ -0,0 +1,310 @@
+"""Latency/throughput/memory benchmark of InternVisionModel, InternViT6B and InternVLChatModel.
+
+Sweeps batch size, resolution, dtype, attention backend and number of dynamic
+tiles, and reports p50/p95 latency, throughput and peak memory per case, as
+JSON or CSV. Weights are random (timings do not depend on them); the model
+configs are the InternViT-6B / InternVL-Chat ones, read from --config-path if
+given, and their depth and width can be reduced to run on CPU for regression
+tracking, e.g.
+
+    python tools/benchmark.py --models vision intern_vit_6b chat --device cpu --dtypes fp32 \\
+        --num-layers 2 --hidden-size 256 --llm-num-layers 2 --llm-hidden-size 256 \\
+        --batch-sizes 1 2 --resolutions 224 448 --tiles 1 3 --output benchmark.csv
+
+InternViT6B is the classification model, imported from --classification-dir.
+For the chat model, prefill (ViT + projector + LLM forward over the prompt)
+and decode (one LLM forward per new token with the KV cache) are timed
+separately; decode latencies are per token.
+"""
+import argparse
+import csv
+import gc
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+from internvl.model.internvl_chat import (InternVisionConfig,
+                                          InternVisionModel,
+                                          InternVLChatConfig,
+                                          InternVLChatModel)
+from internvl.model.internvl_chat.modeling_intern_vit import has_flash_attn
+from transformers.utils import is_flash_attn_2_available
+
+DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+ATTN_IMPLEMENTATIONS = {'naive': 'eager', 'flash': 'flash_attention_2'}
+DEFAULT_LLM_CONFIG = {
+    'architectures': ['LlamaForCausalLM'], 'hidden_size': 4096, 'intermediate_size': 11008,
+    'num_hidden_layers': 32, 'num_attention_heads': 32, 'vocab_size': 92553,
+}
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def reset_peak_memory(device):
+    gc.collect()
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    # peak RSS of the process so far, not reset between cases
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def time_fn(fn, device, warmup, iters):
+    """Returns the latencies of `iters` calls of `fn` in seconds, after `warmup` calls."""
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(iters):
+        synchronize(device)
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def summarize(latencies, items):
+    """p50/p95/mean latency in ms, and throughput of `items` per call."""
+    latencies = np.array(latencies)
+    return {
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p95_ms': float(np.percentile(latencies, 95) * 1000),
+        'mean_ms': float(latencies.mean() * 1000),
+        'throughput': float(items / latencies.mean()),
+    }
+
+
+def scale_width(config, hidden_size, num_heads_key, intermediate_key):
+    # keep the head dim and the mlp ratio of the full config
+    head_dim = config[hidden_size[0]] // config[num_heads_key]
+    mlp_ratio = config[intermediate_key] / config[hidden_size[0]]
+    config[hidden_size[0]] = hidden_size[1]
+    config[num_heads_key] = max(hidden_size[1] // head_dim, 1)
+    config[intermediate_key] = int(hidden_size[1] * mlp_ratio)
+
+
+def vision_config_dict(args):
+    if args.config_path is not None:
+        config = InternVLChatConfig.from_pretrained(args.config_path).vision_config.to_dict()
+    else:
+        config = InternVisionConfig().to_dict()
+    if args.num_layers is not None:
+        config['num_hidden_layers'] = args.num_layers
+    if args.hidden_size is not None:
+        scale_width(config, ('hidden_size', args.hidden_size), 'num_attention_heads', 'intermediate_size')
+    return config
+
+
+def llm_config_dict(args):
+    if args.config_path is not None:
+        config = InternVLChatConfig.from_pretrained(args.config_path).llm_config.to_dict()
+    else:
+        config = dict(DEFAULT_LLM_CONFIG)
+    if args.llm_num_layers is not None:
+        config['num_hidden_layers'] = args.llm_num_layers
+    if args.llm_hidden_size is not None:
+        if 'num_key_value_heads' in config and config['num_key_value_heads'] is not None:
+            group = config['num_attention_heads'] // config['num_key_value_heads']
+        else:
+            group = 1
+        scale_width(config, ('hidden_size', args.llm_hidden_size), 'num_attention_heads', 'intermediate_size')
+        config['num_key_value_heads'] = max(config['num_attention_heads'] // group, 1)
+    return config
+
+
+def build_vision(args, attn, resolution):
+    config = InternVisionConfig(**vision_config_dict(args))
+    config.use_flash_attn = attn == 'flash'
+    config.image_size = resolution
+    return InternVisionModel(config)
+
+
+def build_intern_vit_6b(args, attn, resolution):
+    sys.path.insert(0, os.path.abspath(args.classification_dir))
+    from models.intern_vit_6b import InternViT6B
+    config = vision_config_dict(args)
+    return InternViT6B(img_size=resolution, pretrain_size=resolution,
+                       embed_dim=config['hidden_size'], num_heads=config['num_attention_heads'],
+                       mlp_ratio=config['intermediate_size'] / config['hidden_size'],
+                       depth=config['num_hidden_layers'], qkv_bias=config['qkv_bias'],
+                       qk_normalization=config['qk_normalization'], use_flash_attn=attn == 'flash',
+                       with_cp=False, freeze_vit=True, head_norm_type='ln')
+
+
+def build_chat(args, attn, resolution):
+    vision_config = vision_config_dict(args)
+    vision_config['use_flash_attn'] = attn == 'flash'
+    vision_config['image_size'] = resolution
+    llm_config = llm_config_dict(args)
+    llm_config['attn_implementation'] = ATTN_IMPLEMENTATIONS[attn]
+    if args.config_path is not None:
+        config = InternVLChatConfig.from_pretrained(args.config_path)
+        config = InternVLChatConfig(vision_config=vision_config, llm_config=llm_config,
+                                    select_layer=config.select_layer, downsample_ratio=config.downsample_ratio,
+                                    ps_version=config.ps_version, force_image_size=resolution)
+    else:
+        config = InternVLChatConfig(vision_config=vision_config, llm_config=llm_config,
+                                    select_layer=-1, ps_version='v2', force_image_size=resolution)
+    if -config.select_layer > vision_config['num_hidden_layers']:
+        config.select_layer = -1
+    return InternVLChatModel(config)
+
+
+def unavailable(model_name, attn, dtype, device):
+    """Returns why a case cannot run, or None."""
+    if attn == 'flash':
+        if device.type != 'cuda':
+            return 'flash attention needs a GPU'
+        if not has_flash_attn:
+            return 'flash_attn is not installed'
+        if model_name == 'chat' and not is_flash_attn_2_available():
+            return 'flash_attention_2 is not available in transformers'
+        if dtype == 'fp32':
+            return 'flash attention needs fp16 or bf16'
+    return None
+
+
+def bench_vision(model, args, device, dtype, batch_size, resolution, tiles):
+    # dynamic tiles of the same image are a batch for the vision encoder
+    num_images = batch_size * tiles
+    pixel_values = torch.randn(num_images, 3, resolution, resolution, device=device, dtype=dtype)
+    latencies = time_fn(lambda: model(pixel_values), device, args.warmup, args.iters)
+    return [dict(stage='forward', unit='images/s', **summarize(latencies, num_images))]
+
+
+def bench_chat(model, args, device, dtype, batch_size, resolution, tiles):
+    language_model = model.language_model
+    vocab_size = language_model.config.vocab_size
+    pixel_values = torch.randn(batch_size * tiles, 3, resolution, resolution, device=device, dtype=dtype)
+    text_ids = torch.randint(0, vocab_size, (batch_size, args.prompt_len), device=device)
+    next_ids = torch.randint(0, vocab_size, (batch_size, 1), device=device)
+
+    def prefill():
+        vit_embeds = model.extract_feature(pixel_values)
+        vit_embeds = vit_embeds.reshape(batch_size, -1, vit_embeds.shape[-1])
+        text_embeds = language_model.get_input_embeddings()(text_ids)
+        input_embeds = torch.cat([vit_embeds.to(text_embeds.dtype), text_embeds], dim=1)
+        return language_model(inputs_embeds=input_embeds, use_cache=True)
+
+    prefill_latencies = time_fn(prefill, device, args.warmup, args.iters)
+    prompt_len = tiles * model.num_image_token + args.prompt_len
+
+    decode_latencies = []
+    for _ in range(max(args.iters // args.decode_tokens, 1)):
+        past_key_values = prefill().past_key_values
+        for step in range(args.decode_tokens + 1):
+            synchronize(device)
+            start = time.perf_counter()
+            outputs = language_model(input_ids=next_ids, past_key_values=past_key_values, use_cache=True)
+            synchronize(device)
+            past_key_values = outputs.past_key_values
+            if step > 0:
+                # the first step warms up the decoding kernels
+                decode_latencies.append(time.perf_counter() - start)
+    return [
+        dict(stage='prefill', unit='tokens/s', prompt_len=prompt_len,
+             **summarize(prefill_latencies, batch_size * prompt_len)),
+        dict(stage='decode', unit='tokens/s', prompt_len=prompt_len,
+             **summarize(decode_latencies, batch_size)),
+    ]
+
+
+BUILDERS = {'vision': (build_vision, bench_vision),
+            'intern_vit_6b': (build_intern_vit_6b, bench_vision),
+            'chat': (build_chat, bench_chat)}
+
+
+def run(args):
+    device = torch.device(args.device)
+    results = []
+    for model_name in args.models:
+        build, bench = BUILDERS[model_name]
+        # the classification model takes single images, no tiles
+        tiles_list = [1] if model_name == 'intern_vit_6b' else args.tiles
+        for dtype_name in args.dtypes:
+            for attn in args.attn:
+                for resolution in args.resolutions:
+                    case = dict(model=model_name, dtype=dtype_name, attn=attn, resolution=resolution)
+                    reason = unavailable(model_name, attn, dtype_name, device)
+                    if reason is not None:
+                        print(f'skipped {case}: {reason}')
+                        results.append(dict(case, skipped=reason))
+                        continue
+                    dtype = DTYPES[dtype_name]
+                    model = build(args, attn, resolution).to(device=device, dtype=dtype).eval()
+                    for batch_size in args.batch_sizes:
+                        for tiles in tiles_list:
+                            reset_peak_memory(device)
+                            with torch.inference_mode():
+                                rows = bench(model, args, device, dtype, batch_size, resolution, tiles)
+                            for row in rows:
+                                row = dict(case, batch_size=batch_size, tiles=tiles, **row,
+                                           peak_memory_mb=peak_memory_mb(device))
+                                print(', '.join(f'{k}={v:.2f}' if isinstance(v, float) else f'{k}={v}'
+                                                for k, v in row.items()))
+                                results.append(row)
+                    del model
+                    reset_peak_memory(device)
+    return results
+
+
+def save(results, output):
+    if output.endswith('.csv'):
+        keys = []
+        for row in results:
+            keys += [k for k in row if k not in keys]
+        with open(output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=keys)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(f'results are saved to {output}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='InternViT / InternVL-Chat benchmark')
+    parser.add_argument('--models', type=str, nargs='+', default=['vision'], choices=list(BUILDERS))
+    parser.add_argument('--config-path', type=str, default=None,
+                        help='InternVL-Chat model directory whose config is used, the default configs if not set')
+    parser.add_argument('--classification-dir', type=str,
+                        default=os.path.join(os.path.dirname(__file__), '..', '..', 'classification'))
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[224, 448])
+    parser.add_argument('--dtypes', type=str, nargs='+', default=['bf16'], choices=list(DTYPES))
+    parser.add_argument('--attn', type=str, nargs='+', default=['naive', 'flash'], choices=list(ATTN_IMPLEMENTATIONS))
+    parser.add_argument('--tiles', type=int, nargs='+', default=[1, 7],
+                        help='number of dynamic tiles per image (including the thumbnail)')
+    parser.add_argument('--prompt-len', type=int, default=64, help='number of text tokens of the chat prompt')
+    parser.add_argument('--decode-tokens', type=int, default=32)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iters', type=int, default=10)
+    # reduced-depth / width configs, e.g. for CPU regression runs
+    parser.add_argument('--num-layers', type=int, default=None)
+    parser.add_argument('--hidden-size', type=int, default=None)
+    parser.add_argument('--llm-num-layers', type=int, default=None)
+    parser.add_argument('--llm-hidden-size', type=int, default=None)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='.json or .csv')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    results = run(args)
+    save(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""Analytic FLOPs and memory of the InternVL-Chat pipeline, without running the model.
+
+For each max_dynamic_patch and batch size, reports the FLOPs, parameters and
+memory of the vision encoder, the pixel-shuffle MLP projector, the LLM
+prefill over the image and text tokens, and the LLM decode per new token:
+
+    python tools/flops_calculator.py --config-path OpenGVLab/InternVL-Chat-V1-5 \\
+        --max-dynamic-patch 1 6 12 --batch-sizes 1 8 --text-len 256 --new-tokens 512
+
+Conventions: a multiply-add is 2 FLOPs, norms, activations and softmax are
+not counted. Attention is causal in the LLM (half of the score matrix) and
+full in the ViT. Memory is in --dtype: weights, the KV cache at the end of
+decoding, and the activations, either the peak working set of one layer
+(inference) or the tensors saved for the backward pass (--training, with
+or without gradient checkpointing). Attention score matrices are only
+materialized with --attn naive.
+"""
+import argparse
+import json
+
+from internvl.model.internvl_chat import InternVisionConfig, InternVLChatConfig
+
+BYTES = {'fp32': 4, 'fp16': 2, 'bf16': 2}
+DEFAULT_LLM_CONFIG = {
+    'architectures': ['LlamaForCausalLM'], 'hidden_size': 4096, 'intermediate_size': 11008,
+    'num_hidden_layers': 32, 'num_attention_heads': 32, 'vocab_size': 92553,
+}
+
+
+def num_tiles(config, max_dynamic_patch):
+    """Worst case number of 448px tiles of one image: the tile grid plus the thumbnail."""
+    if not config.dynamic_image_size:
+        return 1
+    return max_dynamic_patch + (1 if config.use_thumbnail and max_dynamic_patch > 1 else 0)
+
+
+def vit_stats(config, images, args):
+    vision_config = config.vision_config
+    image_size = config.force_image_size or vision_config.image_size
+    patch_size = vision_config.patch_size
+    d, inter = vision_config.hidden_size, vision_config.intermediate_size
+    heads = vision_config.num_attention_heads
+    n = (image_size // patch_size) ** 2 + 1
+    # the layers after select_layer are computed but unused, like extract_feature does
+    depth = vision_config.num_hidden_layers
+    tokens = images * n
+
+    embed_flops = 2 * (n - 1) * images * 3 * patch_size ** 2 * d
+    layer_flops = (2 * tokens * d * 3 * d  # qkv
+                   + 2 * 2 * images * n * n * d  # q @ k, attn @ v
+                   + 2 * tokens * d * d  # proj
+                   + 2 * 2 * tokens * d * inter)  # fc1, fc2
+    params = 3 * patch_size ** 2 * d + (n + 1) * d + depth * (4 * d * d + 2 * d * inter)
+
+    scores = images * heads * n * n if args.attn == 'naive' else 0
+    if args.training:
+        # saved for backward: norm inputs, qkv input, q/k/v, scores, proj input, fc1 input, fc1 and gelu outputs
+        saved = tokens * (2 * d + d + 3 * d + d + d + 2 * inter) + scores
+        activations = depth * tokens * d + saved if args.grad_checkpointing else depth * saved
+    else:
+        activations = tokens * d + max(tokens * 3 * d + scores, tokens * inter)
+    return dict(tokens=tokens, flops=embed_flops + depth * layer_flops, params=params,
+                activation_bytes=activations * BYTES[args.dtype])
+
+
+def projector_stats(config, images, args):
+    vision_config = config.vision_config
+    image_size = config.force_image_size or vision_config.image_size
+    r = config.downsample_ratio
+    in_dim = int(vision_config.hidden_size / r ** 2)
+    h = config.llm_config.hidden_size
+    tokens = images * int((image_size // vision_config.patch_size) ** 2 * r ** 2)
+    flops = 2 * tokens * in_dim * h + 2 * tokens * h * h
+    params = 2 * in_dim + in_dim * h + h + h * h + h
+    activations = tokens * (in_dim + 2 * h) if args.training else tokens * (in_dim + h)
+    return dict(tokens=tokens, flops=flops, params=params, activation_bytes=activations * BYTES[args.dtype])
+
+
+def llm_dims(llm_config):
+    h = llm_config.hidden_size
+    heads = llm_config.num_attention_heads
+    kv_heads = getattr(llm_config, 'num_key_value_heads', None) or heads
+    head_dim = h // heads
+    return h, heads, kv_heads * head_dim, llm_config.intermediate_size, llm_config.num_hidden_layers
+
+
+def llm_linear_flops(llm_config, tokens):
+    h, _, kv_dim, inter, _ = llm_dims(llm_config)
+    # q, k, v, o projections and the gated MLP (gate, up, down)
+    return 2 * tokens * (h * h + 2 * h * kv_dim + h * h + 3 * h * inter)
+
+
+def llm_params(llm_config):
+    h, _, kv_dim, inter, depth = llm_dims(llm_config)
+    vocab = llm_config.vocab_size
+    embeddings = vocab * h * (1 if getattr(llm_config, 'tie_word_embeddings', False) else 2)
+    return embeddings + depth * (2 * h * h + 2 * h * kv_dim + 3 * h * inter)
+
+
+def llm_prefill_stats(config, batch_size, seq_len, args):
+    llm_config = config.llm_config
+    h, heads, kv_dim, inter, depth = llm_dims(llm_config)
+    vocab = llm_config.vocab_size
+    tokens = batch_size * seq_len
+    attn_flops = 2 * 2 * batch_size * (seq_len * (seq_len + 1) // 2) * h
+    # HF models compute the logits of every position
+    flops = depth * (llm_linear_flops(llm_config, tokens) + attn_flops) + 2 * tokens * h * vocab
+
+    scores = batch_size * heads * seq_len * seq_len if args.attn == 'naive' else 0
+    if args.training:
+        # saved for backward: norm inputs, qkv input, q/k/v, scores, o input, mlp input, gate/up/act outputs
+        saved = tokens * (2 * h + h + h + 2 * kv_dim + h + h + 3 * inter) + scores
+        activations = depth * tokens * h + saved if args.grad_checkpointing else depth * saved
+        # fp32 logits and their gradient
+        logits_bytes = 2 * tokens * vocab * 4
+    else:
+        activations = tokens * h + max(tokens * (h + 2 * kv_dim) + scores, tokens * 3 * inter)
+        logits_bytes = tokens * vocab * 4
+    kv_cache = 2 * depth * tokens * kv_dim
+    return dict(tokens=tokens, flops=flops, params=llm_params(llm_config),
+                activation_bytes=activations * BYTES[args.dtype] + logits_bytes,
+                kv_cache_bytes=kv_cache * BYTES[args.dtype])
+
+
+def llm_decode_stats(config, batch_size, context_len, args):
+    """Cost of generating one token per sequence with `context_len` tokens in the KV cache."""
+    llm_config = config.llm_config
+    h, heads, kv_dim, inter, depth = llm_dims(llm_config)
+    vocab = llm_config.vocab_size
+    attn_flops = 2 * 2 * batch_size * (context_len + 1) * h
+    flops = depth * (llm_linear_flops(llm_config, batch_size) + attn_flops) + 2 * batch_size * h * vocab
+    scores = batch_size * heads * (context_len + 1) if args.attn == 'naive' else 0
+    activations = batch_size * (h + max(h + 2 * kv_dim, 3 * inter)) + scores
+    kv_cache = 2 * depth * batch_size * (context_len + 1) * kv_dim
+    return dict(tokens=batch_size, flops=flops, params=0,
+                activation_bytes=activations * BYTES[args.dtype] + batch_size * vocab * 4,
+                kv_cache_bytes=kv_cache * BYTES[args.dtype],
+                # every weight is read once per step, decoding is bound by it
+                weight_read_bytes=llm_params(llm_config) * BYTES[args.dtype])
+
+
+def estimate(config, max_dynamic_patch, batch_size, args):
+    """Per-component stats of one batch of `batch_size` single-image conversations."""
+    images = batch_size * num_tiles(config, max_dynamic_patch)
+    vit = vit_stats(config, images, args)
+    projector = projector_stats(config, images, args)
+    seq_len = projector['tokens'] // batch_size + args.text_len
+    prefill = llm_prefill_stats(config, batch_size, seq_len, args)
+    # the last generated token, where the KV cache is the largest
+    decode = llm_decode_stats(config, batch_size, seq_len + args.new_tokens - 1, args)
+    weights = (vit['params'] + projector['params'] + prefill['params']) * BYTES[args.dtype]
+    return dict(max_dynamic_patch=max_dynamic_patch, batch_size=batch_size, images=images, seq_len=seq_len,
+                weight_bytes=weights, vit=vit, projector=projector, llm_prefill=prefill,
+                llm_decode_per_token=decode)
+
+
+def build_config(args):
+    if args.config_path is not None:
+        config = InternVLChatConfig.from_pretrained(args.config_path)
+    else:
+        config = InternVLChatConfig(vision_config=InternVisionConfig(image_size=448).to_dict(),
+                                    llm_config=DEFAULT_LLM_CONFIG, force_image_size=448,
+                                    dynamic_image_size=True, use_thumbnail=True)
+    if args.downsample_ratio is not None:
+        config.downsample_ratio = args.downsample_ratio
+    if args.llm_num_layers is not None:
+        config.llm_config.num_hidden_layers = args.llm_num_layers
+    if args.llm_hidden_size is not None:
+        config.llm_config.hidden_size = args.llm_hidden_size
+    if args.llm_intermediate_size is not None:
+        config.llm_config.intermediate_size = args.llm_intermediate_size
+    return config
+
+
+def print_table(results):
+    print(f'{"max_patch":>9} {"batch":>5} {"seq_len":>7} {"component":<21} {"GFLOPs":>12} '
+          f'{"activations GiB":>15} {"KV cache GiB":>12}')
+    for result in results:
+        for name in ['vit', 'projector', 'llm_prefill', 'llm_decode_per_token']:
+            stats = result[name]
+            print(f'{result["max_dynamic_patch"]:>9} {result["batch_size"]:>5} {result["seq_len"]:>7} {name:<21} '
+                  f'{stats["flops"] / 1e9:>12.1f} {stats["activation_bytes"] / 2 ** 30:>15.3f} '
+                  f'{stats.get("kv_cache_bytes", 0) / 2 ** 30:>12.3f}')
+        print(f'{"":>23} weights: {result["weight_bytes"] / 2 ** 30:.2f} GiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='InternVL-Chat FLOPs and memory calculator')
+    parser.add_argument('--config-path', type=str, default=None,
+                        help='InternVL-Chat model directory whose config is used, '
+                             'InternViT-6B-448px with a 7B Llama if not set')
+    parser.add_argument('--max-dynamic-patch', type=int, nargs='+', default=[6])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1])
+    parser.add_argument('--downsample-ratio', type=float, default=None)
+    parser.add_argument('--llm-num-layers', type=int, default=None)
+    parser.add_argument('--llm-hidden-size', type=int, default=None)
+    parser.add_argument('--llm-intermediate-size', type=int, default=None)
+    parser.add_argument('--text-len', type=int, default=128, help='number of text tokens of the prompt')
+    parser.add_argument('--new-tokens', type=int, default=512, help='number of generated tokens')
+    parser.add_argument('--dtype', type=str, default='bf16', choices=list(BYTES))
+    parser.add_argument('--attn', type=str, default='flash', choices=['naive', 'flash'])
+    parser.add_argument('--training', action='store_true', help='activations saved for the backward pass')
+    parser.add_argument('--grad-checkpointing', action='store_true')
+    parser.add_argument('--output', type=str, default=None, help='save the results as JSON')
+    args = parser.parse_args()
+
+    config = build_config(args)
+    results = [estimate(config, max_dynamic_patch, batch_size, args)
+               for max_dynamic_patch in args.max_dynamic_patch for batch_size in args.batch_sizes]
+    print_table(results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
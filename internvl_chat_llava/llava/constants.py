@@ -1,5 +1,7 @@
 CONTROLLER_HEART_BEAT_EXPIRATION = 30
 WORKER_HEART_BEAT_INTERVAL = 15
+# version of the /worker_generate_stream chunks requested by the clients, 2 sends deltas
+STREAM_VERSION = 2
 
 LOGDIR = "."
 
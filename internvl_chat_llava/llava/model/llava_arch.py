@@ -19,6 +19,7 @@ import torch
 import torch.nn as nn
 
 from .multimodal_encoder.builder import build_vision_tower
+from .multimodal_encoder.clip_encoder import group_images_by_shape
 from .multimodal_projector.builder import build_vision_projector
 
 from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
@@ -97,6 +98,14 @@ class LlavaMetaForCausalLM(ABC):
         return self.get_model().get_vision_tower()
 
     def encode_images(self, images):
+        if type(images) is list:
+            # images of different resolutions, the vision tower and the projector run once per resolution
+            image_features = [None] * len(images)
+            for indices, batch in group_images_by_shape(images):
+                batch_features = self.encode_images(batch)
+                for i, index in enumerate(indices):
+                    image_features[index] = batch_features[i]
+            return image_features
         image_features = self.get_model().get_vision_tower()(images)
         image_features = self.get_model().mm_projector(image_features)
         return image_features
@@ -111,112 +120,112 @@ class LlavaMetaForCausalLM(ABC):
             return input_ids, attention_mask, past_key_values, None, labels
 
         if type(images) is list or images.ndim == 5:
-            concat_images = torch.cat([image for image in images], dim=0)
-            image_features = self.encode_images(concat_images)
             split_sizes = [image.shape[0] for image in images]
-            image_features = torch.split(image_features, split_sizes, dim=0)
-            image_features = [x.flatten(0, 1) for x in image_features]
+            if all(image.shape[1:] == images[0].shape[1:] for image in images):
+                concat_images = torch.cat([image for image in images], dim=0)
+                image_features = self.encode_images(concat_images)
+                image_features = torch.split(image_features, split_sizes, dim=0)
+                image_features = [x.flatten(0, 1) for x in image_features]
+            else:
+                # samples of different resolutions
+                tile_features = self.encode_images([tile for image in images for tile in image])
+                ends = torch.tensor(split_sizes).cumsum(0).tolist()
+                image_features = [torch.cat(tile_features[end - size:end], dim=0) for size, end in zip(split_sizes, ends)]
         else:
             image_features = self.encode_images(images)
 
-        new_input_embeds = []
-        new_labels = [] if labels is not None else None
-        cur_image_idx = 0
-        for batch_idx, cur_input_ids in enumerate(input_ids):
-            if (cur_input_ids == IMAGE_TOKEN_INDEX).sum() == 0:
-                # multimodal LLM, but the current sample is not multimodal
-                # FIXME: this is a hacky fix, for deepspeed zero3 to work
-                half_len = cur_input_ids.shape[0] // 2
-                cur_image_features = image_features[cur_image_idx]
-                cur_input_embeds_1 = self.get_model().embed_tokens(cur_input_ids[:half_len])
-                cur_input_embeds_2 = self.get_model().embed_tokens(cur_input_ids[half_len:])
-                cur_input_embeds = torch.cat([cur_input_embeds_1, cur_image_features[0:0], cur_input_embeds_2], dim=0)
-                new_input_embeds.append(cur_input_embeds)
-                if labels is not None:
-                    new_labels.append(labels[batch_idx])
-                cur_image_idx += 1
-                continue
-            image_token_indices = torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0]
-            cur_new_input_embeds = []
-            if labels is not None:
-                cur_labels = labels[batch_idx]
-                cur_new_labels = []
-                assert cur_labels.shape == cur_input_ids.shape
-            while image_token_indices.numel() > 0:
-                cur_image_features = image_features[cur_image_idx]
-                image_token_start = image_token_indices[0]
-                if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids[:image_token_start-1]).detach())
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids[image_token_start-1:image_token_start]))
-                    cur_new_input_embeds.append(cur_image_features)
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids[image_token_start+1:image_token_start+2]))
-                    if labels is not None:
-                        cur_new_labels.append(cur_labels[:image_token_start])
-                        cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=labels.device, dtype=labels.dtype))
-                        cur_new_labels.append(cur_labels[image_token_start:image_token_start+1])
-                        cur_labels = cur_labels[image_token_start+2:]
-                else:
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids[:image_token_start]))
-                    cur_new_input_embeds.append(cur_image_features)
-                    if labels is not None:
-                        cur_new_labels.append(cur_labels[:image_token_start])
-                        cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=labels.device, dtype=labels.dtype))
-                        cur_labels = cur_labels[image_token_start+1:]
-                cur_image_idx += 1
-                if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
-                    cur_input_ids = cur_input_ids[image_token_start+2:]
-                else:
-                    cur_input_ids = cur_input_ids[image_token_start+1:]
-                image_token_indices = torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0]
-            if cur_input_ids.numel() > 0:
-                if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids).detach())
-                else:
-                    cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids))
-                if labels is not None:
-                    cur_new_labels.append(cur_labels)
-            cur_new_input_embeds = [x.to(device=self.device) for x in cur_new_input_embeds]
-            cur_new_input_embeds = torch.cat(cur_new_input_embeds, dim=0)
-            new_input_embeds.append(cur_new_input_embeds)
-            if labels is not None:
-                cur_new_labels = torch.cat(cur_new_labels, dim=0)
-                new_labels.append(cur_new_labels)
-
-        if any(x.shape != new_input_embeds[0].shape for x in new_input_embeds):
-            max_len = max(x.shape[0] for x in new_input_embeds)
-
-            new_input_embeds_align = []
-            for cur_new_embed in new_input_embeds:
-                cur_new_embed = torch.cat((cur_new_embed, torch.zeros((max_len - cur_new_embed.shape[0], cur_new_embed.shape[1]), dtype=cur_new_embed.dtype, device=cur_new_embed.device)), dim=0)
-                new_input_embeds_align.append(cur_new_embed)
-            new_input_embeds = torch.stack(new_input_embeds_align, dim=0)
-
-            if labels is not None:
-                new_labels_align = []
-                _new_labels = new_labels
-                for cur_new_label in new_labels:
-                    cur_new_label = torch.cat((cur_new_label, torch.full((max_len - cur_new_label.shape[0],), IGNORE_INDEX, dtype=cur_new_label.dtype, device=cur_new_label.device)), dim=0)
-                    new_labels_align.append(cur_new_label)
-                new_labels = torch.stack(new_labels_align, dim=0)
-
-            if attention_mask is not None:
-                new_attention_mask = []
-                for cur_attention_mask, cur_new_labels, cur_new_labels_align in zip(attention_mask, _new_labels, new_labels):
-                    new_attn_mask_pad_left = torch.full((cur_new_labels.shape[0] - labels.shape[1],), True, dtype=attention_mask.dtype, device=attention_mask.device)
-                    new_attn_mask_pad_right = torch.full((cur_new_labels_align.shape[0] - cur_new_labels.shape[0],), False, dtype=attention_mask.dtype, device=attention_mask.device)
-                    cur_new_attention_mask = torch.cat((new_attn_mask_pad_left, cur_attention_mask, new_attn_mask_pad_right), dim=0)
-                    new_attention_mask.append(cur_new_attention_mask)
-                attention_mask = torch.stack(new_attention_mask, dim=0)
-                assert attention_mask.shape == new_labels.shape
+        embed_tokens = self.get_model().embed_tokens
+        batch_size, seq_len = input_ids.shape
+        is_image = input_ids == IMAGE_TOKEN_INDEX
+        num_images = is_image.sum(dim=1)
+
+        # every image token takes the next image feature, a sample without image tokens skips one
+        # (the dummy image of text-only samples)
+        num_consumed = torch.where(num_images == 0, torch.ones_like(num_images), num_images)
+        first_image_idx = num_consumed.cumsum(0) - num_consumed
+        image_batch_idx, image_pos = torch.where(is_image)
+        image_idx = (first_image_idx[:, None] + is_image.cumsum(dim=1) - 1)[image_batch_idx, image_pos]
+        if torch.is_tensor(image_features):
+            image_lengths = torch.full((image_idx.shape[0],), image_features.shape[1], device=input_ids.device)
+        else:
+            image_lengths = torch.tensor([image_features[i].shape[0] for i in image_idx.tolist()],
+                                         dtype=torch.long, device=input_ids.device)
+
+        # position of every input token in the output: image tokens are replaced by their features
+        widths = torch.ones_like(input_ids)
+        widths[image_batch_idx, image_pos] = image_lengths
+        new_lengths = widths.sum(dim=1)
+        max_len = int(new_lengths.max())
+        offsets = widths.cumsum(dim=1) - widths
+        positions = torch.arange(max_len, device=input_ids.device)[None, :]
+        left_padding = getattr(self.config, 'tokenizer_padding_side', 'right') == 'left'
+        if left_padding:
+            offsets = offsets + (max_len - new_lengths)[:, None]
+            padding = positions < (max_len - new_lengths)[:, None]
+        else:
+            padding = positions >= new_lengths[:, None]
+        batch_offsets = torch.arange(batch_size, device=input_ids.device)[:, None] * max_len
+
+        # the text tokens, embedded in one call
+        text_embeds = embed_tokens(torch.where(is_image, torch.zeros_like(input_ids), input_ids))
+        use_im_start_end = getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False)
+        if use_im_start_end:
+            # only the embeddings of the start / end tokens around the images are trained
+            next_to_image = torch.zeros_like(is_image)
+            next_to_image[:, :-1] |= is_image[:, 1:]
+            next_to_image[:, 1:] |= is_image[:, :-1]
+            trained = next_to_image | (num_images == 0)[:, None]
+            text_embeds = torch.where(trained[:, :, None], text_embeds, text_embeds.detach())
+
+        # every input row is copied to its output position, the rows of the image tokens
+        # are then overwritten by the image features
+        hidden_size = text_embeds.shape[-1]
+        new_input_embeds = text_embeds.new_empty((batch_size * max_len, hidden_size))
+        new_input_embeds.index_copy_(0, (batch_offsets + offsets).flatten(), text_embeds.flatten(0, 1))
+
+        if torch.is_tensor(image_features):
+            if torch.equal(image_idx, torch.arange(image_features.shape[0], device=image_idx.device)):
+                image_rows = image_features.flatten(0, 1)
+            else:
+                image_rows = image_features.index_select(0, image_idx).flatten(0, 1)
+        else:
+            image_rows = [image_features[i] for i in image_idx.tolist()]
+            image_rows = torch.cat(image_rows, dim=0) if image_rows else image_features[0][0:0]
+        if (num_images == 0).any():
+            # FIXME: keeps the features in the graph of text-only batches, for deepspeed zero3 to work
+            image_rows = torch.cat([image_rows, image_features[int(first_image_idx[num_images == 0][0])][0:0]], dim=0)
+        row_batch_idx = image_batch_idx.repeat_interleave(image_lengths)
+        row_offsets = image_lengths.cumsum(0) - image_lengths
+        row_pos = offsets[image_batch_idx, image_pos].repeat_interleave(image_lengths) \
+            + torch.arange(row_batch_idx.shape[0], device=input_ids.device) - row_offsets.repeat_interleave(image_lengths)
+        new_input_embeds.index_copy_(0, row_batch_idx * max_len + row_pos,
+                                     image_rows.to(device=new_input_embeds.device, dtype=new_input_embeds.dtype))
+        new_input_embeds.index_fill_(0, torch.where(padding.flatten())[0], 0)
+        new_input_embeds = new_input_embeds.view(batch_size, max_len, hidden_size).to(device=self.device)
+
+        if labels is not None:
+            text_labels = labels
+            if use_im_start_end:
+                # the end token after an image takes the label of the image token
+                text_labels = labels.clone()
+                text_labels[:, 1:] = torch.where(is_image[:, :-1], labels[:, :-1], labels[:, 1:])
+            text_labels = torch.where(is_image, torch.full_like(text_labels, IGNORE_INDEX), text_labels)
+            new_labels = torch.full((batch_size * max_len,), IGNORE_INDEX, dtype=labels.dtype, device=labels.device)
+            new_labels.index_copy_(0, (batch_offsets + offsets).flatten(), text_labels.flatten())
+            new_labels = new_labels.view(batch_size, max_len)
         else:
-            new_input_embeds = torch.stack(new_input_embeds, dim=0)
-            if labels is not None:
-                new_labels  = torch.stack(new_labels, dim=0)
-
-            if attention_mask is not None:
-                new_attn_mask_pad_left = torch.full((attention_mask.shape[0], new_input_embeds.shape[1] - input_ids.shape[1]), True, dtype=attention_mask.dtype, device=attention_mask.device)
-                attention_mask = torch.cat((new_attn_mask_pad_left, attention_mask), dim=1)
-                assert attention_mask.shape == new_input_embeds.shape[:2]
+            new_labels = None
+
+        if attention_mask is not None:
+            # the original mask shifted by the added tokens, which are attended, and the padding masked
+            num_added = new_lengths - seq_len
+            if left_padding:
+                num_added = num_added + (max_len - new_lengths)
+            mask_positions = (positions - num_added[:, None]).to(attention_mask.device)
+            new_attention_mask = attention_mask.gather(1, mask_positions.clamp(0, seq_len - 1))
+            new_attention_mask = torch.where(mask_positions < 0, torch.ones_like(new_attention_mask), new_attention_mask)
+            new_attention_mask = torch.where(mask_positions >= seq_len, torch.zeros_like(new_attention_mask), new_attention_mask)
+            attention_mask = new_attention_mask.masked_fill(padding.to(attention_mask.device), 0)
 
         return None, attention_mask, past_key_values, new_input_embeds, new_labels
 
@@ -22,6 +22,14 @@ def is_internvl_14b_model(vision_tower_name):
     return any(name in vision_tower_name for name in model_names)
 
 
+def group_images_by_shape(images):
+    """Groups a list of image tensors by shape, returns (indices, stacked images) per shape."""
+    groups = {}
+    for index, image in enumerate(images):
+        groups.setdefault(tuple(image.shape), []).append(index)
+    return [(indices, torch.stack([images[index] for index in indices], dim=0)) for indices in groups.values()]
+
+
 class CLIPVisionTower(nn.Module):
     def __init__(self, vision_tower, args, delay_load=False):
         super().__init__()
@@ -82,16 +90,15 @@ class CLIPVisionTower(nn.Module):
     @torch.no_grad()
     def forward(self, images):
         if type(images) is list:
-            image_features = []
-            for image in images:
-                if is_internvl_14b_model(self.vision_tower_name):
-                    image_forward_out, query_out = self.vision_tower(image.to(device=self.device, dtype=self.dtype).unsqueeze(0), output_hidden_states=True)
-                    image_feature = self.feature_select(image_forward_out).to(image.dtype)
-                    image_features.append([image_feature, query_out])
-                else:
-                    image_forward_out = self.vision_tower(image.to(device=self.device, dtype=self.dtype).unsqueeze(0), output_hidden_states=True)
-                    image_feature = self.feature_select(image_forward_out).to(image.dtype)
-                    image_features.append(image_feature)
+            # one batched forward per resolution, the features are returned in the order of the images
+            image_features = [None] * len(images)
+            for indices, batch in group_images_by_shape(images):
+                batch_features = self.forward(batch)
+                for i, index in enumerate(indices):
+                    if is_internvl_14b_model(self.vision_tower_name):
+                        image_features[index] = [batch_features[0][i:i + 1], batch_features[1][i:i + 1]]
+                    else:
+                        image_features[index] = batch_features[i:i + 1]
         else:
             if is_internvl_14b_model(self.vision_tower_name):
                 image_forward_outs, query_outs = self.vision_tower(images.to(device=self.device, dtype=self.dtype), output_hidden_states=True)
@@ -4,6 +4,7 @@ It sends worker addresses to clients.
 """
 import argparse
 import asyncio
+import collections
 import dataclasses
 from enum import Enum, auto
 import json
@@ -13,21 +14,39 @@ from typing import List, Union
 import threading
 
 from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+import httpx
 import numpy as np
 import requests
 import uvicorn
 
 from llava.constants import CONTROLLER_HEART_BEAT_EXPIRATION
+from llava.serve.metrics import REGISTRY, Counter, Gauge, Histogram, register_memory_gauges
 from llava.utils import build_logger, server_error_msg
 
 
 logger = build_logger("controller", "controller.log")
+# httpx logs every proxied request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+requests_total = Counter("controller_requests_total", "Generation requests proxied by the controller")
+errors_total = Counter("controller_errors_total", "Proxied requests without worker or whose worker failed")
+time_to_first_chunk = Histogram(
+    "controller_time_to_first_chunk_seconds", "Time from the arrival of a request to its first chunk")
+stream_duration = Histogram("controller_stream_seconds", "Time from the arrival of a request to its last chunk")
+# the handlers of the app use the module level controller
+Gauge("controller_worker_in_flight", "Requests being proxied to each worker",
+      lambda: {name: w.in_flight for name, w in controller.worker_info_snapshot()}, labelname="worker")
+Gauge("controller_worker_queue_length", "Queue length of each worker, from its last heart beat",
+      lambda: {name: w.queue_length for name, w in controller.worker_info_snapshot()}, labelname="worker")
+register_memory_gauges("controller")
 
 
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    POWER_OF_TWO = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -35,6 +54,8 @@ class DispatchMethod(Enum):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "power_of_two":
+            return cls.POWER_OF_TWO
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -46,6 +67,13 @@ class WorkerInfo:
     queue_length: int
     check_heart_beat: bool
     last_heart_beat: str
+    # requests proxied by the controller and not finished yet
+    in_flight: int = 0
+
+    def load(self):
+        # the queue length of the last heart beat also counts the requests sent
+        # to the worker directly, in_flight is up to date for the proxied ones
+        return max(self.queue_length, self.in_flight) / self.speed
 
 
 def heart_beat_controller(controller):
@@ -58,12 +86,20 @@ class Controller:
     def __init__(self, dispatch_method: str):
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
+        # worker_info is read by the event loop and modified by the registrations, which run
+        # in the thread pool, and by the heart beat thread
+        self.lock = threading.RLock()
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
 
         self.heart_beat_thread = threading.Thread(
-            target=heart_beat_controller, args=(self,))
+            target=heart_beat_controller, args=(self,), daemon=True)
         self.heart_beat_thread.start()
 
+        # Dict[str -> httpx.AsyncClient], keep-alive connections to each worker,
+        # and the number of streams open with each client (only used by the event loop)
+        self.clients = {}
+        self.client_streams = collections.Counter()
+
         logger.info("Init controller")
 
     def register_worker(self, worker_name: str, check_heart_beat: bool,
@@ -78,9 +114,19 @@ class Controller:
         if not worker_status:
             return False
 
-        self.worker_info[worker_name] = WorkerInfo(
-            worker_status["model_names"], worker_status["speed"], worker_status["queue_length"],
-            check_heart_beat, time.time())
+        with self.lock:
+            w_info = self.worker_info.get(worker_name)
+            if w_info is None:
+                self.worker_info[worker_name] = WorkerInfo(
+                    worker_status["model_names"], worker_status["speed"], worker_status["queue_length"],
+                    check_heart_beat, time.time())
+            else:
+                # updated in place, the proxied streams keep counting their in_flight on it
+                w_info.model_names = worker_status["model_names"]
+                w_info.speed = worker_status["speed"]
+                w_info.queue_length = worker_status["queue_length"]
+                w_info.check_heart_beat = check_heart_beat
+                w_info.last_heart_beat = time.time()
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
@@ -99,25 +145,35 @@ class Controller:
         return r.json()
 
     def remove_worker(self, worker_name: str):
-        del self.worker_info[worker_name]
+        with self.lock:
+            del self.worker_info[worker_name]
+
+    def worker_info_snapshot(self):
+        with self.lock:
+            return list(self.worker_info.items())
 
     def refresh_all_workers(self):
-        old_info = dict(self.worker_info)
-        self.worker_info = {}
+        old_info = dict(self.worker_info_snapshot())
 
         for w_name, w_info in old_info.items():
             if not self.register_worker(w_name, w_info.check_heart_beat, None):
                 logger.info(f"Remove stale worker: {w_name}")
+                with self.lock:
+                    self.worker_info.pop(w_name, None)
 
     def list_models(self):
         model_names = set()
 
-        for w_name, w_info in self.worker_info.items():
+        for w_name, w_info in self.worker_info_snapshot():
             model_names.update(w_info.model_names)
 
         return list(model_names)
 
     def get_worker_address(self, model_name: str):
+        with self.lock:
+            return self._select_worker(model_name)
+
+    def _select_worker(self, model_name: str):
         if self.dispatch_method == DispatchMethod.LOTTERY:
             worker_names = []
             worker_speeds = []
@@ -159,60 +215,102 @@ class Controller:
             for w_name, w_info in self.worker_info.items():
                 if model_name in w_info.model_names:
                     worker_names.append(w_name)
-                    worker_qlen.append(w_info.queue_length / w_info.speed)
+                    worker_qlen.append(w_info.load())
             if len(worker_names) == 0:
                 return ""
             min_index = np.argmin(worker_qlen)
             w_name = worker_names[min_index]
-            self.worker_info[w_name].queue_length += 1
             logger.info(f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}")
             return w_name
+        elif self.dispatch_method == DispatchMethod.POWER_OF_TWO:
+            # the less loaded of two random workers, avoids sending every request
+            # to the same worker between two updates of the loads
+            worker_names = [w_name for w_name, w_info in self.worker_info.items()
+                            if model_name in w_info.model_names]
+            if len(worker_names) == 0:
+                return ""
+            if len(worker_names) > 2:
+                worker_names = [worker_names[i] for i in np.random.choice(len(worker_names), 2, replace=False)]
+            return min(worker_names, key=lambda w_name: self.worker_info[w_name].load())
         else:
             raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
 
     def receive_heart_beat(self, worker_name: str, queue_length: int):
-        if worker_name not in self.worker_info:
+        with self.lock:
+            w_info = self.worker_info.get(worker_name)
+            if w_info is not None:
+                w_info.queue_length = queue_length
+                w_info.last_heart_beat = time.time()
+        if w_info is None:
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
-        self.worker_info[worker_name].queue_length = queue_length
-        self.worker_info[worker_name].last_heart_beat = time.time()
         logger.info(f"Receive heart beat. {worker_name}")
         return True
 
     def remove_stable_workers_by_expiration(self):
         expire = time.time() - CONTROLLER_HEART_BEAT_EXPIRATION
-        to_delete = []
-        for worker_name, w_info in self.worker_info.items():
-            if w_info.check_heart_beat and w_info.last_heart_beat < expire:
-                to_delete.append(worker_name)
-
-        for worker_name in to_delete:
-            self.remove_worker(worker_name)
-
-    def worker_api_generate_stream(self, params):
-        worker_addr = self.get_worker_address(params["model"])
-        if not worker_addr:
+        with self.lock:
+            to_delete = [worker_name for worker_name, w_info in self.worker_info.items()
+                         if w_info.check_heart_beat and w_info.last_heart_beat < expire]
+            for worker_name in to_delete:
+                del self.worker_info[worker_name]
+
+    def get_client(self, worker_name: str):
+        for w_name in list(self.clients):
+            # the clients of removed workers are closed once their streams are finished
+            if w_name not in self.worker_info and self.client_streams[w_name] == 0:
+                asyncio.ensure_future(self.clients.pop(w_name).aclose())
+        if worker_name not in self.clients:
+            self.clients[worker_name] = httpx.AsyncClient(
+                base_url=worker_name, timeout=5, limits=httpx.Limits(max_keepalive_connections=64))
+        return self.clients[worker_name]
+
+    async def worker_api_generate_stream(self, params, start_time):
+        requests_total.inc()
+        with self.lock:
+            worker_addr = self.get_worker_address(params["model"])
+            w_info = self.worker_info.get(worker_addr) if worker_addr else None
+            if w_info is not None:
+                w_info.in_flight += 1
+        if w_info is None:
             logger.info(f"no worker: {params['model']}")
+            errors_total.inc()
             ret = {
                 "text": server_error_msg,
                 "error_code": 2,
             }
             yield json.dumps(ret).encode() + b"\0"
+            return
 
+        first_chunk = True
+        self.client_streams[worker_addr] += 1
         try:
-            response = requests.post(worker_addr + "/worker_generate_stream",
-                json=params, stream=True, timeout=5)
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-                if chunk:
-                    yield chunk + b"\0"
-        except requests.exceptions.RequestException as e:
-            logger.info(f"worker timeout: {worker_addr}")
+            # params, including stream_version, and chunks of either version are forwarded as is
+            async with self.get_client(worker_addr).stream(
+                    "POST", "/worker_generate_stream", json=params) as response:
+                buffer = b""
+                async for data in response.aiter_bytes():
+                    *chunks, buffer = (buffer + data).split(b"\0")
+                    for chunk in chunks:
+                        if chunk:
+                            if first_chunk:
+                                time_to_first_chunk.observe(time.perf_counter() - start_time)
+                                first_chunk = False
+                            yield chunk + b"\0"
+            stream_duration.observe(time.perf_counter() - start_time)
+        except httpx.HTTPError as e:
+            logger.info(f"worker timeout: {worker_addr}, {e}")
+            errors_total.inc()
             ret = {
                 "text": server_error_msg,
                 "error_code": 3,
             }
             yield json.dumps(ret).encode() + b"\0"
+        finally:
+            # also when the client disconnects
+            w_info.in_flight -= 1
+            self.client_streams[worker_addr] -= 1
 
 
     # Let the controller act as a worker to achieve hierarchical
@@ -222,7 +320,7 @@ class Controller:
         speed = 0
         queue_length = 0
 
-        for w_name in self.worker_info:
+        for w_name, _ in self.worker_info_snapshot():
             worker_status = self.get_worker_status(w_name)
             if worker_status is not None:
                 model_names.update(worker_status["model_names"])
@@ -242,14 +340,15 @@ app = FastAPI()
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
-    controller.register_worker(
-        data["worker_name"], data["check_heart_beat"],
+    # requests to the workers are blocking, run in a thread not to block the event loop
+    await run_in_threadpool(
+        controller.register_worker, data["worker_name"], data["check_heart_beat"],
         data.get("worker_status", None))
 
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    models = await run_in_threadpool(controller.refresh_all_workers)
 
 
 @app.post("/list_models")
@@ -275,14 +374,20 @@ async def receive_heart_beat(request: Request):
 
 @app.post("/worker_generate_stream")
 async def worker_api_generate_stream(request: Request):
+    start_time = time.perf_counter()
     params = await request.json()
-    generator = controller.worker_api_generate_stream(params)
+    generator = controller.worker_api_generate_stream(params, start_time)
     return StreamingResponse(generator)
 
 
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await run_in_threadpool(controller.worker_api_get_status)
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
@@ -290,7 +395,7 @@ if __name__ == "__main__":
     parser.add_argument("--host", type=str, default="localhost")
     parser.add_argument("--port", type=int, default=21001)
     parser.add_argument("--dispatch-method", type=str, choices=[
-        "lottery", "shortest_queue"], default="shortest_queue")
+        "lottery", "shortest_queue", "power_of_two"], default="shortest_queue")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -0,0 +1,163 @@
+"""
+Load test of the controller proxy (/worker_generate_stream of the controller)
+with local stand-in workers, which stream fake tokens with fixed delays
+instead of running a model. Half of the workers are --slow-factor times
+slower, while advertising the same speed, so that the dispatch has to rely
+on the loads to balance them.
+
+python -m llava.serve.controller_load_test --num-workers 4 --num-requests 400 --concurrency 64
+"""
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import time
+
+import httpx
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+import llava.utils
+
+# keep the log of the stand-in registrations and proxied requests out of the working
+# directory: build_logger only adds a file handler when none was created yet
+llava.utils.handler = logging.NullHandler()
+import llava.serve.controller as controller_module
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def build_stand_in_worker(model_name, concurrency, prefill_time, token_time, num_tokens):
+    app = FastAPI()
+    semaphore = asyncio.Semaphore(concurrency)
+    queue = {"length": 0}
+
+    @app.post("/worker_generate_stream")
+    async def generate_stream(request: Request):
+        await request.json()
+
+        async def generator():
+            queue["length"] += 1
+            try:
+                async with semaphore:
+                    await asyncio.sleep(prefill_time)
+                    for seq in range(num_tokens):
+                        chunk = {"version": 2, "seq": seq, "delta": " token", "error_code": 0}
+                        yield json.dumps(chunk).encode() + b"\0"
+                        await asyncio.sleep(token_time)
+                    chunk = {"version": 2, "seq": num_tokens, "delta": "", "finished": True, "error_code": 0}
+                    yield json.dumps(chunk).encode() + b"\0"
+            finally:
+                queue["length"] -= 1
+
+        return StreamingResponse(generator())
+
+    @app.post("/worker_get_status")
+    async def get_status(request: Request):
+        return {"model_names": [model_name], "speed": 1, "queue_length": queue["length"]}
+
+    return app
+
+
+async def start_server(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+async def send_request(client, model_name, latencies):
+    start = time.perf_counter()
+    first_token = None
+    pload = {"model": model_name, "prompt": "Hello", "stream_version": 2}
+    async with client.stream("POST", "/worker_generate_stream", json=pload) as response:
+        async for data in response.aiter_bytes():
+            if first_token is None and data:
+                first_token = time.perf_counter() - start
+    latencies.append((first_token, time.perf_counter() - start))
+
+
+async def run_load(controller_url, args):
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=controller_url, timeout=60, limits=limits) as client:
+
+        async def bounded():
+            async with semaphore:
+                await send_request(client, args.model_name, latencies)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[bounded() for _ in range(args.num_requests)])
+        elapsed = time.perf_counter() - start
+    ttft = np.array([x[0] for x in latencies]) * 1000
+    total = np.array([x[1] for x in latencies]) * 1000
+    return {
+        "ttft_p50_ms": float(np.percentile(ttft, 50)),
+        "ttft_p99_ms": float(np.percentile(ttft, 99)),
+        "latency_p50_ms": float(np.percentile(total, 50)),
+        "latency_p99_ms": float(np.percentile(total, 99)),
+        "requests_per_s": args.num_requests / elapsed,
+    }
+
+
+async def main(args):
+    workers = []
+    for i in range(args.num_workers):
+        slow = args.slow_factor if i % 2 == 1 else 1
+        port = free_port()
+        app = build_stand_in_worker(args.model_name, args.worker_concurrency,
+                                    args.prefill_ms / 1000 * slow, args.token_ms / 1000 * slow, args.num_tokens)
+        workers.append((f"http://127.0.0.1:{port}", await start_server(app, port)))
+
+    results = {}
+    for method in args.dispatch_methods:
+        # the handlers of the controller app use the module level controller
+        controller = controller_module.Controller(method)
+        controller_module.controller = controller
+        for worker_addr, _ in workers:
+            controller.register_worker(
+                worker_addr, False, {"model_names": [args.model_name], "speed": 1, "queue_length": 0})
+        port = free_port()
+        server, task = await start_server(controller_module.app, port)
+        results[method] = await run_load(f"http://127.0.0.1:{port}", args)
+        print(method, ", ".join(f"{k}={v:.1f}" for k, v in results[method].items()))
+        server.should_exit = True
+        await task
+        for client in controller.clients.values():
+            await client.aclose()
+
+    for _, (server, task) in workers:
+        server.should_exit = True
+        await task
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--worker-concurrency", type=int, default=5,
+                        help="like --limit-model-concurrency of the model worker")
+    parser.add_argument("--slow-factor", type=float, default=2.0)
+    parser.add_argument("--prefill-ms", type=float, default=50)
+    parser.add_argument("--token-ms", type=float, default=5)
+    parser.add_argument("--num-tokens", type=int, default=32)
+    parser.add_argument("--num-requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--dispatch-methods", type=str, nargs="+",
+                        default=["lottery", "shortest_queue", "power_of_two"])
+    parser.add_argument("--model-name", type=str, default="stand-in")
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -2,6 +2,7 @@ import argparse
 import datetime
 import json
 import os
+import threading
 import time
 
 import gradio as gr
@@ -9,16 +10,25 @@ import requests
 import random
 from llava.conversation import (default_conversation, conv_templates,
                                    SeparatorStyle)
-from llava.constants import LOGDIR
+from llava.constants import LOGDIR, STREAM_VERSION
 from llava.utils import (build_logger, server_error_msg,
-    violates_moderation, moderation_msg)
+    violates_moderation, moderation_msg, StreamDecoder)
+from llava.mm_utils import image_ref
 import hashlib
+from collections import OrderedDict
 
 
 logger = build_logger("gradio_web_server", "gradio_web_server.log")
 
 headers = {"User-Agent": "InternVL-Chat Client"}
 
+# refs of the images already sent to each worker, which keeps them in its ImageStore
+max_sent_image_refs = 10000
+worker_sent_image_refs = {}
+# gradio runs the handlers of concurrent requests in threads
+sent_image_refs_lock = threading.Lock()
+worker_has_image_store = {}
+
 no_change_btn = gr.Button.update()
 enable_btn = gr.Button.update(interactive=True)
 disable_btn = gr.Button.update(interactive=False)
@@ -76,6 +86,60 @@ function() {
 """
 
 
+def encode_images(worker_addr, images, refs, resend=()):
+    """Sends the refs of the images the worker has already received instead of the images."""
+    if worker_addr not in worker_has_image_store:
+        try:
+            ret = requests.post(worker_addr + "/worker_get_status", headers=headers, timeout=5)
+            worker_has_image_store[worker_addr] = bool(ret.json().get("image_store", False))
+        except requests.exceptions.RequestException:
+            return images
+    if not worker_has_image_store[worker_addr]:
+        return images
+    with sent_image_refs_lock:
+        sent = worker_sent_image_refs.get(worker_addr, {})
+        return [ref if ref in sent and ref not in resend else image for image, ref in zip(images, refs)]
+
+
+def mark_images_sent(worker_addr, refs):
+    if not worker_has_image_store.get(worker_addr, False):
+        return
+    with sent_image_refs_lock:
+        sent = worker_sent_image_refs.setdefault(worker_addr, OrderedDict())
+        for ref in refs:
+            sent[ref] = True
+            sent.move_to_end(ref)
+        while len(sent) > max_sent_image_refs:
+            sent.popitem(last=False)
+
+
+def stream_worker(worker_addr, pload, images):
+    """Yields the chunks of /worker_generate_stream, sending the images again once
+    if the worker no longer has some of them (evicted, or restarted)."""
+    refs = [image_ref(image) for image in images]
+    pload["images"] = encode_images(worker_addr, images, refs)
+    resent = False
+    marked = False
+    while True:
+        response = requests.post(worker_addr + "/worker_generate_stream",
+            headers=headers, json=pload, stream=True, timeout=10)
+        missing = None
+        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+            if chunk:
+                data = json.loads(chunk.decode())
+                if data["error_code"] == 4 and not resent:
+                    missing = set(data["missing_images"])
+                    break
+                if data["error_code"] == 0 and not marked:
+                    mark_images_sent(worker_addr, refs)
+                    marked = True
+                yield data
+        if missing is None:
+            return
+        resent = True
+        pload["images"] = encode_images(worker_addr, images, refs, missing)
+
+
 def load_demo(url_params, request: gr.Request):
     logger.info(f"load_demo. ip: {request.client.host}. params: {url_params}")
 
@@ -259,34 +323,32 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, max_inpu
         "top_p": float(top_p),
         "max_new_tokens": max_new_tokens,
         "max_input_tiles": max_input_tiles,
+        "stream_version": STREAM_VERSION,
         "stop": state.sep if state.sep_style in [SeparatorStyle.SINGLE, SeparatorStyle.MPT] else state.sep2,
         "images": f'List of {len(state.get_images())} images: {all_image_hash}',
         "org_images": f'List of {len(state.get_images(return_org=True))} images: {all_image_hash}',
     }
     logger.info(f"==== request ====\n{pload}")
 
-    pload['images'] = state.get_images()
-    pload['org_images'] = state.get_images(return_org=True)
+    images = state.get_images()
 
     state.messages[-1][-1] = "▌"
     yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
 
     try:
         # Stream output
-        response = requests.post(worker_addr + "/worker_generate_stream",
-            headers=headers, json=pload, stream=True, timeout=10)
-        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-            if chunk:
-                data = json.loads(chunk.decode())
-                if data["error_code"] == 0:
-                    output = data["text"][len(prompt):].strip()
-                    state.messages[-1][-1] = output + "▌"
-                    yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
-                else:
-                    output = data["text"] + f" (error_code: {data['error_code']})"
-                    state.messages[-1][-1] = output
-                    yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
-                    return
+        # older workers ignore stream_version and send the whole text in every chunk
+        decoder = StreamDecoder(prompt)
+        for data in stream_worker(worker_addr, pload, images):
+            if data["error_code"] == 0:
+                output = decoder.update(data).strip()
+                state.messages[-1][-1] = output + "▌"
+                yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
+            else:
+                output = data["text"] + f" (error_code: {data['error_code']})"
+                state.messages[-1][-1] = output
+                yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
+                return
     except requests.exceptions.RequestException as e:
         state.messages[-1][-1] = server_error_msg
         yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
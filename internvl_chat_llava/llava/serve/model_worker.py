@@ -9,7 +9,7 @@ import threading
 import uuid
 
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 import requests
 import torch
 import uvicorn
@@ -17,10 +17,11 @@ from functools import partial
 
 from llava.constants import WORKER_HEART_BEAT_INTERVAL
 from llava.utils import (build_logger, server_error_msg,
-    pretty_print_semaphore)
+    pretty_print_semaphore, encode_stream)
 from llava.model.builder import load_pretrained_model
-from llava.mm_utils import process_images, load_image_from_base64, tokenizer_image_token, KeywordsStoppingCriteria
+from llava.mm_utils import process_images, tokenizer_image_token, KeywordsStoppingCriteria, ImageStore, MissingImagesError
 from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
+from llava.serve.metrics import REGISTRY, GenerationMetrics, Gauge, ModuleTimer, TimedStreamer, register_memory_gauges
 from transformers import TextIteratorStreamer
 from threading import Thread
 
@@ -45,7 +46,7 @@ class ModelWorker:
     def __init__(self, controller_addr, worker_addr,
                  worker_id, no_register,
                  model_path, model_base, model_name,
-                 load_8bit, load_4bit, device):
+                 load_8bit, load_4bit, device, image_store_size=1024):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
@@ -65,6 +66,14 @@ class ModelWorker:
         self.tokenizer, self.model, self.image_processor, self.context_len = load_pretrained_model(
             model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device)
         self.is_multimodal = 'llava' in self.model_name.lower() or 'intern' in self.model_name.lower()
+        self.image_store = ImageStore(image_store_size * 2 ** 20)
+        self.metrics = GenerationMetrics()
+        Gauge("worker_queue_length", "Requests running or waiting for the model semaphore", self.get_queue_length)
+        register_memory_gauges("worker")
+        if self.is_multimodal:
+            self.vision_timer = ModuleTimer(self.model.get_vision_tower(), self.metrics.vision)
+        else:
+            self.vision_timer = None
 
         if not no_register:
             self.register_to_controller()
@@ -117,10 +126,12 @@ class ModelWorker:
             "model_names": [self.model_name],
             "speed": 1,
             "queue_length": self.get_queue_length(),
+            # requests may reference the images of earlier requests, see ImageStore
+            "image_store": True,
         }
 
     @torch.inference_mode()
-    def generate_stream(self, params):
+    def generate_stream(self, params, start_time):
         tokenizer, model, image_processor = self.tokenizer, self.model, self.image_processor
 
         prompt = params["prompt"]
@@ -132,13 +143,17 @@ class ModelWorker:
                 if len(images) != prompt.count(DEFAULT_IMAGE_TOKEN):
                     raise ValueError("Number of images does not match number of <image> tokens in prompt")
 
-                images = [load_image_from_base64(image) for image in images]
+                preprocess_start = time.perf_counter()
+                images = self.image_store.load(images)
                 images = process_images(images, image_processor, model.config)
 
                 if type(images) is list:
                     images = [image.to(self.model.device, dtype=torch.float16) for image in images]
                 else:
                     images = images.to(self.model.device, dtype=torch.float16)
+                self.metrics.image_preprocess.observe(time.perf_counter() - preprocess_start)
+                # a [3, H, W] image is one tile, anyres images are [num_patches, 3, H, W]
+                self.metrics.tiles.observe(sum(image.shape[:-3].numel() for image in images))
 
                 replace_token = DEFAULT_IMAGE_TOKEN
                 if getattr(self.model.config, 'mm_use_im_start_end', False):
@@ -158,6 +173,7 @@ class ModelWorker:
         max_context_length = getattr(model.config, 'max_position_embeddings', 2048)
         max_new_tokens = min(int(params.get("max_new_tokens", 256)), 1024)
         stop_str = params.get("stop", None)
+        stream_version = int(params.get("stream_version", 1))
         do_sample = True if temperature > 0.001 else False
 
         input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).to(self.device)
@@ -168,7 +184,8 @@ class ModelWorker:
         max_new_tokens = min(max_new_tokens, max_context_length - input_ids.shape[-1] - num_image_tokens)
 
         if max_new_tokens < 1:
-            yield json.dumps({"text": ori_prompt + "Exceeds max token length. Please start a new conversation, thanks.", "error_code": 0}).encode() + b"\0"
+            yield from encode_stream(["Exceeds max token length. Please start a new conversation, thanks."],
+                                     ori_prompt, stream_version=stream_version)
             return
 
         thread = Thread(target=model.generate, kwargs=dict(
@@ -177,24 +194,28 @@ class ModelWorker:
             temperature=temperature,
             top_p=top_p,
             max_new_tokens=max_new_tokens,
-            streamer=streamer,
+            streamer=TimedStreamer(streamer, self.metrics, start_time),
             stopping_criteria=[stopping_criteria],
             use_cache=True,
             **image_args
         ))
         thread.start()
 
-        generated_text = ori_prompt
-        for new_text in streamer:
-            generated_text += new_text
-            if generated_text.endswith(stop_str):
-                generated_text = generated_text[:-len(stop_str)]
-            yield json.dumps({"text": generated_text, "error_code": 0}).encode() + b"\0"
+        yield from encode_stream(streamer, ori_prompt, stop_str, stream_version)
 
-    def generate_stream_gate(self, params):
+    def generate_stream_gate(self, params, start_time):
+        self.metrics.requests.inc()
         try:
-            for x in self.generate_stream(params):
+            for x in self.generate_stream(params, start_time):
                 yield x
+        except MissingImagesError as e:
+            # the client sends these images again
+            ret = {
+                "text": server_error_msg,
+                "error_code": 4,
+                "missing_images": e.refs,
+            }
+            yield json.dumps(ret).encode() + b"\0"
         except ValueError as e:
             print("Caught ValueError:", e)
             ret = {
@@ -230,14 +251,16 @@ def release_model_semaphore(fn=None):
 @app.post("/worker_generate_stream")
 async def generate_stream(request: Request):
     global model_semaphore, global_counter
+    start_time = time.perf_counter()
     global_counter += 1
     params = await request.json()
 
     if model_semaphore is None:
         model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
     await model_semaphore.acquire()
+    worker.metrics.queue_wait.observe(time.perf_counter() - start_time)
     worker.send_heart_beat()
-    generator = worker.generate_stream_gate(params)
+    generator = worker.generate_stream_gate(params, start_time)
     background_tasks = BackgroundTasks()
     background_tasks.add_task(partial(release_model_semaphore, fn=worker.send_heart_beat))
     return StreamingResponse(generator, background=background_tasks)
@@ -248,6 +271,13 @@ async def get_status(request: Request):
     return worker.get_status()
 
 
+@app.get("/metrics")
+async def metrics():
+    if worker.vision_timer is not None:
+        worker.vision_timer.collect()
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, default="localhost")
@@ -266,6 +296,7 @@ if __name__ == "__main__":
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument("--load-8bit", action="store_true")
     parser.add_argument("--load-4bit", action="store_true")
+    parser.add_argument("--image-store-size", type=int, default=1024, help="MB of decoded images kept for later requests")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -281,5 +312,6 @@ if __name__ == "__main__":
                          args.model_name,
                          args.load_8bit,
                          args.load_4bit,
-                         args.device)
+                         args.device,
+                         args.image_store_size)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -3,7 +3,9 @@ import json
 
 import requests
 
+from llava.constants import STREAM_VERSION
 from llava.conversation import default_conversation
+from llava.utils import StreamDecoder
 
 
 def main():
@@ -36,15 +38,20 @@ def main():
         "max_new_tokens": args.max_new_tokens,
         "temperature": 0.7,
         "stop": conv.sep,
+        "stream_version": STREAM_VERSION,
     }
     response = requests.post(worker_addr + "/worker_generate_stream", headers=headers,
             json=pload, stream=True)
 
     print(prompt.replace(conv.sep, "\n"), end="")
+    decoder = StreamDecoder(prompt)
     for chunk in response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b"\0"):
         if chunk:
             data = json.loads(chunk.decode("utf-8"))
-            output = data["text"].split(conv.sep)[-1]
+            if data["error_code"] != 0:
+                print(data["text"], end="")
+                break
+            output = decoder.update(data).split(conv.sep)[-1]
             print(output, end="\r")
     print("")
 
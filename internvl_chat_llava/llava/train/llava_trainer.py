@@ -1,4 +1,7 @@
 import os
+import hashlib
+import multiprocessing
+import numpy as np
 import torch
 
 from torch.utils.data import Sampler
@@ -30,6 +33,62 @@ def get_mm_adapter_state_maybe_zero_3(named_params, keys_to_match):
     return to_return
 
 
+_word_count_samples = None
+
+
+def _count_words(bounds):
+    start, end = bounds
+    words = np.empty(end - start, dtype=np.int64)
+    has_image = np.empty(end - start, dtype=bool)
+    for i, sample in enumerate(_word_count_samples[start:end]):
+        words[i] = sum(len(conv['value'].split()) for conv in sample['conversations'])
+        has_image[i] = 'image' in sample
+    return words, has_image
+
+
+def get_word_counts(list_data_dict, annotation_path=None, cache_dir=None, num_workers=None):
+    """
+    Word counts of the conversations of the samples and whether they have an image. Computed in
+    parallel (fork workers) and, with `cache_dir`, saved to a sidecar file which is reused while
+    the annotation file is unchanged.
+    """
+    global _word_count_samples
+    cache_path = None
+    if cache_dir is not None and annotation_path is not None:
+        path_hash = hashlib.sha1(os.path.abspath(annotation_path).encode()).hexdigest()[:8]
+        cache_path = os.path.join(cache_dir, f"{os.path.basename(annotation_path)}-{path_hash}.lengths.npz")
+        mtime = os.path.getmtime(annotation_path)
+        if os.path.exists(cache_path):
+            cache = np.load(cache_path)
+            if len(cache['words']) == len(list_data_dict) and cache['mtime'] == mtime:
+                return cache['words'], cache['has_image']
+
+    if num_workers is None:
+        # the ranks of a node compute their lengths at the same time
+        num_workers = max(1, (os.cpu_count() or 1) // int(os.environ.get("LOCAL_WORLD_SIZE", 1)))
+    chunk_size = 50000
+    bounds = [(i, min(i + chunk_size, len(list_data_dict))) for i in range(0, len(list_data_dict), chunk_size)]
+    _word_count_samples = list_data_dict
+    try:
+        if num_workers > 1 and len(bounds) > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context("fork").Pool(min(num_workers, len(bounds))) as pool:
+                results = pool.map(_count_words, bounds)
+        else:
+            results = [_count_words(b) for b in bounds]
+    finally:
+        _word_count_samples = None
+    words = np.concatenate([r[0] for r in results]) if results else np.zeros(0, dtype=np.int64)
+    has_image = np.concatenate([r[1] for r in results]) if results else np.zeros(0, dtype=bool)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written under a temporary name, the ranks may save it concurrently
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, words=words, has_image=has_image, mtime=mtime)
+        os.replace(tmp_path, cache_path)
+    return words, has_image
+
+
 def split_to_even_chunks(indices, lengths, num_chunks):
     """
     Split a list of indices into `chunks` chunks of roughly equal lengths.
@@ -52,53 +111,75 @@ def split_to_even_chunks(indices, lengths, num_chunks):
     return chunks
 
 
-def get_modality_length_grouped_indices(lengths, batch_size, world_size, generator=None):
-    # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    assert all(l != 0 for l in lengths), "Should not have zero length."
-    mm_indices, mm_lengths = zip(*[(i, l) for i, l in enumerate(lengths) if l > 0])
-    lang_indices, lang_lengths = zip(*[(i, -l) for i, l in enumerate(lengths) if l < 0])
+def get_modality_length_grouped_indices(lengths, batch_size, world_size, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    lengths = np.asarray(lengths)
+    assert (lengths != 0).all(), "Should not have zero length."
+    mm_indices = np.nonzero(lengths > 0)[0]
+    lang_indices = np.nonzero(lengths < 0)[0]
 
     assert len(mm_indices) > 0, "Should have at least one multimodal sample."
     assert len(lang_indices) > 0, "Should have at least one language sample."
 
-    mm_shuffle = [mm_indices[i] for i in get_length_grouped_indices(mm_lengths, batch_size, world_size, generator=None)]
-    lang_shuffle = [lang_indices[i] for i in get_length_grouped_indices(lang_lengths, batch_size, world_size, generator=None)]
+    mm_shuffle = mm_indices[get_length_grouped_indices(lengths[mm_indices], batch_size, world_size, rng=rng)]
+    lang_shuffle = lang_indices[get_length_grouped_indices(-lengths[lang_indices], batch_size, world_size, rng=rng)]
     megabatch_size = world_size * batch_size
-    mm_megabatches = [mm_shuffle[i : i + megabatch_size] for i in range(0, len(mm_shuffle), megabatch_size)]
-    lang_megabatches = [lang_shuffle[i : i + megabatch_size] for i in range(0, len(lang_shuffle), megabatch_size)]
 
-    last_mm = mm_megabatches[-1]
-    last_lang = lang_megabatches[-1]
-    additional_batch = last_mm + last_lang
-    megabatches = mm_megabatches[:-1] + lang_megabatches[:-1]
-    megabatch_indices = torch.randperm(len(megabatches), generator=generator)
-    megabatches = [megabatches[i] for i in megabatch_indices]
+    # the last megabatch of each modality, full or not, is left out of the shuffle
+    mm_end = (len(mm_shuffle) - 1) // megabatch_size * megabatch_size
+    lang_end = (len(lang_shuffle) - 1) // megabatch_size * megabatch_size
+    megabatches = np.concatenate([mm_shuffle[:mm_end], lang_shuffle[:lang_end]]).reshape(-1, megabatch_size)
+    megabatches = megabatches[rng.permutation(len(megabatches))]
+    additional_batch = np.concatenate([mm_shuffle[mm_end:], lang_shuffle[lang_end:]])
 
     if len(additional_batch) >= megabatch_size:
-        megabatches = [additional_batch[:megabatch_size]] + megabatches
-        additional_batch = additional_batch[megabatch_size:]
-
-    if len(additional_batch) > 0:
-        megabatches.append(additional_batch)
-
-    return [i for megabatch in megabatches for i in megabatch]
+        return np.concatenate([additional_batch[:megabatch_size], megabatches.reshape(-1), additional_batch[megabatch_size:]])
+    return np.concatenate([megabatches.reshape(-1), additional_batch])
 
 
-def get_length_grouped_indices(lengths, batch_size, world_size, generator=None, merge=True):
-    # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    indices = torch.randperm(len(lengths), generator=generator)
+def get_length_grouped_indices(lengths, batch_size, world_size, rng=None, merge=True):
+    """
+    Shuffles the indices, sorts each megabatch of `world_size * batch_size` indices by decreasing length
+    and splits it into `world_size` batches of roughly equal total lengths, like `split_to_even_chunks`
+    but for all the megabatches at once.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    lengths = np.asarray(lengths)
+    indices = rng.permutation(len(lengths))
     megabatch_size = world_size * batch_size
-    megabatches = [indices[i : i + megabatch_size].tolist() for i in range(0, len(lengths), megabatch_size)]
-    megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
-    megabatches = [split_to_even_chunks(megabatch, lengths, world_size) for megabatch in megabatches]
-
-    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+    num_full = len(indices) // megabatch_size
+
+    megabatches = indices[:num_full * megabatch_size].reshape(num_full, megabatch_size)
+    order = np.argsort(-lengths[megabatches], axis=1, kind="stable")
+    megabatches = np.take_along_axis(megabatches, order, axis=1)
+
+    # greedy assignment of the indices, longest first, to the shortest chunk which is not full
+    full = np.iinfo(np.int64).max
+    chunk_lengths = np.zeros((num_full, world_size), dtype=np.int64)
+    chunk_sizes = np.zeros((num_full, world_size), dtype=np.int64)
+    rows = np.arange(num_full)
+    positions = np.empty_like(megabatches)
+    for j in range(megabatch_size):
+        chunk = chunk_lengths.argmin(axis=1)
+        positions[:, j] = chunk * batch_size + chunk_sizes[rows, chunk]
+        chunk_sizes[rows, chunk] += 1
+        chunk_lengths[rows, chunk] = np.where(
+            chunk_sizes[rows, chunk] == batch_size, full, chunk_lengths[rows, chunk] + lengths[megabatches[:, j]])
+    grouped = np.empty_like(megabatches)
+    np.put_along_axis(grouped, positions, megabatches, axis=1)
+
+    # the last, partial, megabatch
+    last = sorted(indices[num_full * megabatch_size:].tolist(), key=lambda i: lengths[i], reverse=True)
+    last = [i for batch in split_to_even_chunks(last, lengths, world_size) for i in batch] if last else []
+    return np.concatenate([grouped.reshape(-1), np.asarray(last, dtype=indices.dtype)])
 
 
 class LengthGroupedSampler(Sampler):
     r"""
     Sampler that samples indices in a way that groups together features of the dataset of roughly the same length while
-    keeping a bit of randomness.
+    keeping a bit of randomness. The order only depends on the seed and the epoch, so it is the same on every rank.
     """
 
     def __init__(
@@ -106,7 +187,7 @@ class LengthGroupedSampler(Sampler):
         batch_size: int,
         world_size: int,
         lengths: Optional[List[int]] = None,
-        generator=None,
+        seed: int = 0,
         group_by_modality: bool = False,
     ):
         if lengths is None:
@@ -114,19 +195,26 @@ class LengthGroupedSampler(Sampler):
 
         self.batch_size = batch_size
         self.world_size = world_size
-        self.lengths = lengths
-        self.generator = generator
+        self.lengths = np.asarray(lengths)
+        self.seed = seed
+        self.epoch = 0
         self.group_by_modality = group_by_modality
 
     def __len__(self):
         return len(self.lengths)
 
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
     def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        # the next epoch gets another order if set_epoch is not called
+        self.epoch += 1
         if self.group_by_modality:
-            indices = get_modality_length_grouped_indices(self.lengths, self.batch_size, self.world_size, generator=self.generator)
+            indices = get_modality_length_grouped_indices(self.lengths, self.batch_size, self.world_size, rng=rng)
         else:
-            indices = get_length_grouped_indices(self.lengths, self.batch_size, self.world_size, generator=self.generator)
-        return iter(indices)
+            indices = get_length_grouped_indices(self.lengths, self.batch_size, self.world_size, rng=rng)
+        return iter(indices.tolist())
 
 
 class LLaVATrainer(Trainer):
@@ -142,6 +230,7 @@ class LLaVATrainer(Trainer):
                 self.args.train_batch_size,
                 world_size=self.args.world_size,
                 lengths=lengths,
+                seed=self.args.data_seed if self.args.data_seed is not None else self.args.seed,
                 group_by_modality=True,
             )
         else:
@@ -22,6 +22,7 @@ import logging
 import pathlib
 from typing import Dict, Optional, Sequence, List
 
+import numpy as np
 import torch
 import random
 
@@ -29,7 +30,7 @@ import transformers
 
 from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 from torch.utils.data import Dataset
-from llava.train.llava_trainer import LLaVATrainer
+from llava.train.llava_trainer import LLaVATrainer, get_word_counts
 
 from llava import conversation as conversation_lib
 from llava.model import *
@@ -71,6 +72,8 @@ class DataArguments:
     image_folder: Optional[str] = field(default=None)
     image_aspect_ratio: str = 'square'
     image_grid_pinpoints: Optional[str] = field(default=None)
+    lengths_cache_dir: Optional[str] = field(default=None,
+                                             metadata={"help": "Directory where the sample lengths are saved for the next runs."})
 
 
 @dataclass
@@ -651,26 +654,27 @@ class LazySupervisedDataset(Dataset):
         self.tokenizer = tokenizer
         self.list_data_dict = list_data_dict
         self.data_args = data_args
+        self.annotation_path = data_path
+        self._word_counts = None
 
     def __len__(self):
         return len(self.list_data_dict)
 
+    def word_counts(self):
+        if self._word_counts is None:
+            self._word_counts = get_word_counts(self.list_data_dict, self.annotation_path,
+                                                getattr(self.data_args, 'lengths_cache_dir', None))
+        return self._word_counts
+
     @property
     def lengths(self):
-        length_list = []
-        for sample in self.list_data_dict:
-            img_tokens = 128 if 'image' in sample else 0
-            length_list.append(sum(len(conv['value'].split()) for conv in sample['conversations']) + img_tokens)
-        return length_list
+        words, has_image = self.word_counts()
+        return words + 128 * has_image
 
     @property
     def modality_lengths(self):
-        length_list = []
-        for sample in self.list_data_dict:
-            cur_len = sum(len(conv['value'].split()) for conv in sample['conversations'])
-            cur_len = cur_len if 'image' in sample else -cur_len
-            length_list.append(cur_len)
-        return length_list
+        words, has_image = self.word_counts()
+        return np.where(has_image, words, -words)
 
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
         flag = False
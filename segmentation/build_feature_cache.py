@@ -0,0 +1,175 @@
+# --------------------------------------------------------
+# InternVL
+# Copyright (c) 2023 OpenGVLab
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+"""Precompute the frozen backbone features of a ``*_cached.py`` config.
+
+The images of ``cfg.data.train`` are preprocessed with the deterministic
+``cfg.feature_cache.pipeline``, cut into sliding-window crops and passed
+through the backbone; the ``out_indices`` features are written with the crop
+labels to ``cfg.feature_cache.cache_dir`` (see ``mmseg_custom/datasets/feature_cache.py``).
+
+Work is sharded over the processes of a distributed launch, e.g.
+``python -m torch.distributed.launch --nproc_per_node=8 build_feature_cache.py CONFIG --launcher pytorch``,
+or over independent jobs with ``--shard-id`` and ``--num-shards``.
+"""
+import argparse
+import copy
+import os
+import time
+
+import mmcv
+import mmcv_custom  # noqa: F401,F403
+import mmseg_custom  # noqa: F401,F403
+import numpy as np
+import torch
+from mmcv.runner import get_dist_info, init_dist
+from mmcv.utils import Config, DictAction
+from mmseg.datasets import build_dataset
+from mmseg.models import build_backbone
+from mmseg_custom.datasets import FeatureCacheWriter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Precompute frozen backbone features')
+    parser.add_argument('config', help='cached training config file path')
+    parser.add_argument(
+        '--cache-dir', help='overrides cfg.feature_cache.cache_dir')
+    parser.add_argument(
+        '--batch-size', type=int, default=8, help='number of crops per forward')
+    parser.add_argument(
+        '--workers', type=int, default=4, help='number of data loading workers')
+    parser.add_argument(
+        '--shard-id', type=int, default=0,
+        help='index of this job (only applicable to non-distributed runs)')
+    parser.add_argument(
+        '--num-shards', type=int, default=1,
+        help='number of jobs (only applicable to non-distributed runs)')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    parser.add_argument(
+        '--launcher',
+        choices=['none', 'pytorch', 'slurm', 'mpi'],
+        default='none',
+        help='job launcher')
+    parser.add_argument('--local_rank', type=int, default=0)
+    args = parser.parse_args()
+    if 'LOCAL_RANK' not in os.environ:
+        os.environ['LOCAL_RANK'] = str(args.local_rank)
+    return args
+
+
+def slide_crops(img, seg, crop_size, stride):
+    """Cut an image and its segmentation map into the windows of slide inference.
+
+    Windows are padded to ``crop_size`` (0 for the image, 255 for the map)
+    when the image is smaller.
+    """
+    h_crop, w_crop = crop_size
+    h_stride, w_stride = stride
+    h_img, w_img = seg.shape
+    h_grids = max(h_img - h_crop + h_stride - 1, 0) // h_stride + 1
+    w_grids = max(w_img - w_crop + w_stride - 1, 0) // w_stride + 1
+    for h_idx in range(h_grids):
+        for w_idx in range(w_grids):
+            y1 = h_idx * h_stride
+            x1 = w_idx * w_stride
+            y2 = min(y1 + h_crop, h_img)
+            x2 = min(x1 + w_crop, w_img)
+            y1 = max(y2 - h_crop, 0)
+            x1 = max(x2 - w_crop, 0)
+            crop_img = np.zeros((h_crop, w_crop, img.shape[2]), dtype=np.float32)
+            crop_seg = np.full((h_crop, w_crop), 255, dtype=np.uint8)
+            crop_img[:y2 - y1, :x2 - x1] = img[y1:y2, x1:x2]
+            crop_seg[:y2 - y1, :x2 - x1] = seg[y1:y2, x1:x2]
+            yield crop_img, crop_seg, [y1, y2, x1, x2]
+
+
+def _collate(batch):
+    return batch[0]
+
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    cache_cfg = cfg.feature_cache
+    cache_dir = args.cache_dir or cache_cfg.cache_dir
+
+    if args.launcher == 'none':
+        shard_id, num_shards = args.shard_id, args.num_shards
+    else:
+        init_dist(args.launcher, **cfg.dist_params)
+        shard_id, num_shards = get_dist_info()
+    mmcv.mkdir_or_exist(cache_dir)
+
+    dataset_cfg = copy.deepcopy(cache_cfg.dataset)
+    dataset_cfg.pipeline = cache_cfg.pipeline
+    dataset = build_dataset(dataset_cfg)
+    indices = list(range(shard_id, len(dataset), num_shards))
+    data_loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, indices),
+        batch_size=1,
+        num_workers=args.workers,
+        collate_fn=_collate)
+
+    backbone_cfg = copy.deepcopy(cfg.model.backbone)
+    backbone_cfg.from_cached_features = False
+    backbone = build_backbone(backbone_cfg).cuda().eval()
+
+    writer = FeatureCacheWriter(
+        cache_dir, shard_id, dataset.CLASSES, dataset.PALETTE,
+        img_norm_cfg=cache_cfg.get('img_norm_cfg'))
+    crop_size = cache_cfg.crop_size
+    stride = cache_cfg.get('stride', crop_size)
+    flips = [False, True] if cache_cfg.get('flip', False) else [False]
+
+    pending = []
+
+    def flush():
+        imgs = torch.from_numpy(np.stack([item[0] for item in pending]))
+        imgs = imgs.permute(0, 3, 1, 2).cuda(non_blocking=True)
+        with torch.no_grad():
+            features = torch.cat(backbone.forward_features(imgs), dim=1)
+        features = features.cpu()
+        for feature, (_, seg, info) in zip(features, pending):
+            writer.write(feature, seg, **info)
+        pending.clear()
+
+    start = time.time()
+    num_crops = 0
+    prog_bar = mmcv.ProgressBar(len(indices))
+    for results in data_loader:
+        img = results['img']
+        seg = results['gt_semantic_seg']
+        for flip in flips:
+            if flip:
+                img = img[:, ::-1]
+                seg = seg[:, ::-1]
+            for crop_img, crop_seg, crop in slide_crops(img, seg, crop_size, stride):
+                info = dict(filename=results['filename'],
+                            ori_filename=results['ori_filename'],
+                            crop=crop, flip=flip)
+                pending.append((crop_img, crop_seg, info))
+                num_crops += 1
+                if len(pending) == args.batch_size:
+                    flush()
+        prog_bar.update()
+    if pending:
+        flush()
+    writer.close()
+    elapsed = time.time() - start
+    print(f'\nshard {shard_id}: {num_crops} crops of {len(indices)} images '
+          f'in {elapsed:.1f}s ({num_crops / elapsed:.2f} crops/s)')
+
+
+if __name__ == '__main__':
+    main()
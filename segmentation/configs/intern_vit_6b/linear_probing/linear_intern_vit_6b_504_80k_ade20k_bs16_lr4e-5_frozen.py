@@ -34,6 +34,7 @@ model = dict(
         layerscale_force_fp32=False,
         freeze_vit=True,
         out_indices=[44],
+        prune_unused_blocks=True,
         pretrained=pretrained),
     decode_head=dict(
         _delete_=True,
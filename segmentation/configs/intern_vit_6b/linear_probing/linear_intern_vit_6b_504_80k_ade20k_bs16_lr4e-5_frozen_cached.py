@@ -0,0 +1,47 @@
+# --------------------------------------------------------
+# InternVL
+# Copyright (c) 2023 OpenGVLab
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+# Trains the head of linear_intern_vit_6b_504_80k_ade20k_bs16_lr4e-5_frozen.py from precomputed backbone features:
+#   1. python build_feature_cache.py configs/intern_vit_6b/linear_probing/linear_intern_vit_6b_504_80k_ade20k_bs16_lr4e-5_frozen_cached.py
+#      (or with torch.distributed.launch and --launcher pytorch to shard over GPUs)
+#   2. train this config with --no-validate (the cache has no validation set)
+#   3. evaluate the checkpoint with linear_intern_vit_6b_504_80k_ade20k_bs16_lr4e-5_frozen.py, whose backbone computes the features
+# Cached crops are the deterministic sliding windows of the test-time resize
+# (plus their flips), instead of the random scale/crop/photometric augmentations.
+# The cache of the ~81k crops takes ~670 GB (1 out_index x 8.3 MB per crop).
+_base_ = ['./linear_intern_vit_6b_504_80k_ade20k_bs16_lr4e-5_frozen.py']
+img_norm_cfg = dict(
+    mean=[123.675, 116.28, 103.53], std=[58.395, 57.12, 57.375], to_rgb=True)
+crop_size = (504, 504)
+feature_cache = dict(
+    cache_dir='data/ade/feature_cache/linear_intern_vit_6b_504_80k_ade20k_bs16_lr4e-5_frozen',
+    dataset=dict(
+        type='ADE20KDataset',
+        data_root='data/ade/ADEChallengeData2016',
+        img_dir='images/training',
+        ann_dir='annotations/training'),
+    pipeline=[
+        dict(type='LoadImageFromFile'),
+        dict(type='LoadAnnotations', reduce_zero_label=True),
+        dict(type='Resize', img_scale=(2016, 504), keep_ratio=True),
+        dict(type='Normalize', **img_norm_cfg),
+    ],
+    img_norm_cfg=img_norm_cfg,
+    crop_size=crop_size,
+    stride=(322, 322),
+    flip=True)
+model = dict(
+    backbone=dict(from_cached_features=True))
+train_pipeline = [
+    dict(type='LoadCachedFeatures'),
+    dict(type='DefaultFormatBundle'),
+    dict(type='Collect', keys=['img', 'gt_semantic_seg']),
+]
+data = dict(
+    train=dict(
+        _delete_=True,
+        type='FeatureCacheDataset',
+        cache_dir=feature_cache['cache_dir'],
+        pipeline=train_pipeline))
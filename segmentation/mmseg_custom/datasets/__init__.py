@@ -4,6 +4,11 @@
 # Licensed under The MIT License [see LICENSE for details]
 # --------------------------------------------------------
 from .ade import ADE20KDataset
+from .feature_cache import (FeatureCache, FeatureCacheDataset,
+                            FeatureCacheWriter, LoadCachedFeatures)
 from .pipelines import *  # noqa: F401,F403
 
-__all__ = ['ADE20KDataset']
+__all__ = [
+    'ADE20KDataset', 'FeatureCache', 'FeatureCacheDataset', 'FeatureCacheWriter',
+    'LoadCachedFeatures'
+]
@@ -0,0 +1,207 @@
+# --------------------------------------------------------
+# InternVL
+# Copyright (c) 2023 OpenGVLab
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+"""Cache of frozen backbone features.
+
+With ``freeze_vit=True``, the backbone outputs only depend on the input crop,
+so for a deterministic preprocessing they can be computed once by
+``build_feature_cache.py`` and the heads trained directly from them (with
+``from_cached_features=True`` in the backbone config).
+
+A cache directory holds one group of files per writer (GPU or process):
+``shard_XXXXX.json`` (metas), ``shard_XXXXX_features.bin`` (N x C x h x w, the
+``out_indices`` features concatenated along channels) and ``shard_XXXXX_labels.bin``
+(uint8, N x H x W).
+
+Features are stored exactly as the backbone computes them: numpy has no
+bfloat16, so the bits of the bfloat16 values are stored as int16, read back as
+such and reinterpreted as bfloat16 by the backbone (``from_cached_features``).
+
+The cache is large: a 504 x 504 crop of InternViT-6B (36 x 36 patches of 3200
+channels) takes 8.3 MB per out_index. The 2 sliding windows of most ADE20K
+training images and their flips, i.e. ~81k crops, take ~670 GB with one
+out_index (linear probing) and ~2.7 TB with four (UperNet head tuning).
+"""
+import glob
+import json
+import os.path as osp
+
+import numpy as np
+import torch
+from mmseg.datasets.builder import DATASETS, PIPELINES
+from mmseg.datasets.pipelines import Compose
+from torch.utils.data import Dataset
+
+
+class FeatureCacheWriter(object):
+    """Append (features, label) pairs of crops to a shard of a feature cache.
+
+    Args:
+        cache_dir (str): Directory of the feature cache.
+        shard_id (int): Index of the shard, one per writer.
+        classes (tuple[str]): Classes of the dataset.
+        palette (list[list[int]]): Palette of the dataset.
+        img_norm_cfg (dict): Normalization applied before the backbone.
+    """
+
+    def __init__(self, cache_dir, shard_id, classes, palette, img_norm_cfg=None):
+        prefix = osp.join(cache_dir, f'shard_{shard_id:05d}')
+        self.meta_file = prefix + '.json'
+        self.features_file = prefix + '_features.bin'
+        self.labels_file = prefix + '_labels.bin'
+        self._features = open(self.features_file, 'wb')
+        self._labels = open(self.labels_file, 'wb')
+        self.meta = dict(
+            classes=list(classes),
+            palette=[list(map(int, color)) for color in palette],
+            img_norm_cfg=img_norm_cfg,
+            feature_dtype='bfloat16',
+            feature_shape=None,
+            label_shape=None,
+            samples=[])
+
+    def write(self, features, label, **info):
+        """Write one crop.
+
+        Args:
+            features (torch.Tensor): C x h x w backbone features, stored in bfloat16.
+            label (np.ndarray): H x W segmentation map, 255 for ignored pixels.
+            info: Json-serializable information about the crop (filename, crop box, flip).
+        """
+        features = features.detach().to('cpu', torch.bfloat16).contiguous().view(torch.int16).numpy()
+        label = np.ascontiguousarray(label, dtype=np.uint8)
+        if self.meta['feature_shape'] is None:
+            self.meta['feature_shape'] = list(features.shape)
+            self.meta['label_shape'] = list(label.shape)
+        assert list(features.shape) == self.meta['feature_shape'], \
+            f'feature shape {features.shape} != {self.meta["feature_shape"]}'
+        assert list(label.shape) == self.meta['label_shape'], \
+            f'label shape {label.shape} != {self.meta["label_shape"]}'
+        self._features.write(features.tobytes())
+        self._labels.write(label.tobytes())
+        self.meta['samples'].append(info)
+
+    def close(self):
+        self._features.close()
+        self._labels.close()
+        # the meta file is written last, it marks the shard as complete
+        with open(self.meta_file, 'w') as f:
+            json.dump(self.meta, f)
+
+
+class FeatureCache(object):
+    """Read-only view on all the complete shards of a feature cache.
+
+    Files are memory-mapped lazily, so that each dataloader worker opens its
+    own maps after being forked.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        meta_files = sorted(glob.glob(osp.join(cache_dir, 'shard_*.json')))
+        assert len(meta_files) > 0, f'no feature cache found in {cache_dir}'
+        self.shards = []
+        self.index = []
+        for meta_file in meta_files:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if len(meta['samples']) == 0:
+                continue
+            assert meta.get('feature_dtype') == 'bfloat16', \
+                f'{meta_file} has float16 features, rebuild the cache with build_feature_cache.py'
+            self.shards.append((meta_file[:-len('.json')], meta))
+            self.index.extend((len(self.shards) - 1, i) for i in range(len(meta['samples'])))
+        self.meta = self.shards[0][1]
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _map(self, shard):
+        if shard not in self._maps:
+            prefix, meta = self.shards[shard]
+            num_samples = len(meta['samples'])
+            # bits of bfloat16 values
+            features = np.memmap(prefix + '_features.bin', dtype=np.int16, mode='r',
+                                 shape=(num_samples, *meta['feature_shape']))
+            labels = np.memmap(prefix + '_labels.bin', dtype=np.uint8, mode='r',
+                               shape=(num_samples, *meta['label_shape']))
+            self._maps[shard] = (features, labels)
+        return self._maps[shard]
+
+    def __getitem__(self, idx):
+        shard, i = self.index[idx]
+        features, labels = self._map(shard)
+        info = self.shards[shard][1]['samples'][i]
+        return np.array(features[i]), np.array(labels[i]), info
+
+    def __getstate__(self):
+        # memory maps are not shared between processes
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+
+@PIPELINES.register_module()
+class LoadCachedFeatures(object):
+    """Load the cached backbone features and segmentation map of a crop.
+
+    Added keys are "img" (h x w x C features, as the int16 bits of their bfloat16
+    values, so that ``DefaultFormatBundle`` can be used as usual), "gt_semantic_seg" and the meta keys used by
+    ``Collect``.
+    """
+
+    def __call__(self, results):
+        cache = results['feature_cache']
+        features, label, info = cache[results['cache_index']]
+        img = features.transpose(1, 2, 0)
+        results['filename'] = info.get('filename')
+        results['ori_filename'] = info.get('ori_filename')
+        results['img'] = img
+        results['img_shape'] = label.shape + (3,)
+        results['ori_shape'] = label.shape + (3,)
+        results['pad_shape'] = label.shape + (3,)
+        results['scale_factor'] = np.ones(4, dtype=np.float32)
+        results['flip'] = info.get('flip', False)
+        results['flip_direction'] = 'horizontal' if results['flip'] else None
+        results['img_norm_cfg'] = cache.meta.get('img_norm_cfg')
+        results['gt_semantic_seg'] = label
+        results['seg_fields'] = ['gt_semantic_seg']
+        return results
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
+
+@DATASETS.register_module()
+class FeatureCacheDataset(Dataset):
+    """Training dataset over a feature cache written by ``build_feature_cache.py``.
+
+    Only training is supported: the cached crops have no full-image
+    annotations to evaluate on, so validation and testing use the original
+    dataset and a backbone computing the features.
+
+    Args:
+        cache_dir (str): Directory of the feature cache.
+        pipeline (list[dict]): Processing pipeline, starting with ``LoadCachedFeatures``.
+        test_mode (bool): Unused, for compatibility with the mmseg datasets.
+    """
+
+    def __init__(self, cache_dir, pipeline, test_mode=False):
+        self.cache = FeatureCache(cache_dir)
+        self.pipeline = Compose(pipeline)
+        self.test_mode = test_mode
+        self.CLASSES = tuple(self.cache.meta['classes'])
+        self.PALETTE = self.cache.meta['palette']
+        self.ignore_index = 255
+        self.reduce_zero_label = False
+        self.label_map = None
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, idx):
+        results = dict(feature_cache=self.cache, cache_index=idx)
+        return self.pipeline(results)
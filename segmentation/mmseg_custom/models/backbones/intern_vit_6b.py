@@ -271,7 +271,8 @@ class InternViT6B(BaseModule):
     def __init__(self, in_chans=3, patch_size=14, img_size=224, pretrain_size=224, qkv_bias=False, drop_path_rate=0.0,
                  embed_dim=3200, num_heads=25, mlp_ratio=4, init_values=0.1, qk_normalization=True, depth=48,
                  use_flash_attn=True, with_cp=True, layerscale_force_fp32=False, out_indices=[7, 11, 15, 23],
-                 freeze_vit=False, with_fpn=False, with_final_norm=False, pretrained=None):
+                 freeze_vit=False, with_fpn=False, with_final_norm=False, pretrained=None,
+                 prune_unused_blocks=False, from_cached_features=False):
 
         super().__init__()
 
@@ -283,6 +284,9 @@ class InternViT6B(BaseModule):
         self.patch_size = patch_size
         self.out_indices = out_indices
         self.with_fpn = with_fpn
+        # with from_cached_features, the inputs are the outputs of out_indices precomputed by
+        # build_feature_cache.py (concatenated along channels), and the ViT itself is not built
+        self.from_cached_features = from_cached_features
 
         use_flash_attn = use_flash_attn and has_flash_attn
         if use_flash_attn and not has_flash_attn:
@@ -293,29 +297,34 @@ class InternViT6B(BaseModule):
 
         norm_layer_for_blocks = partial(RMSNorm, eps=1e-6)
         self.norm_layer_for_blocks = norm_layer_for_blocks
-        self.patch_embed = PatchEmbed(img_size, patch_size, in_chans, embed_dim)
-        num_patches = self.patch_embed.num_patches
-        self.num_patches = num_patches
-        self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
-        self.pos_drop = nn.Identity()
-        self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
-
-        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]
-
-        self.blocks = nn.ModuleList([
-            Block(embed_dim, num_heads, mlp_ratio, qkv_bias=qkv_bias,
-                  norm_layer=norm_layer_for_blocks,
-                  drop_path=dpr[i], init_values=init_values, attn_drop=0.,
-                  use_flash_attn=use_flash_attn,
-                  with_cp=with_cp,
-                  qk_normalization=qk_normalization,
-                  layerscale_force_fp32=layerscale_force_fp32)
-            for i in range(depth)])
-
-        self.init_weights(pretrained)
-
-        if freeze_vit:
-            _freeze_params(self)
+        if not from_cached_features:
+            self.patch_embed = PatchEmbed(img_size, patch_size, in_chans, embed_dim)
+            num_patches = self.patch_embed.num_patches
+            self.num_patches = num_patches
+            self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+            self.pos_drop = nn.Identity()
+            self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
+
+            dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]
+
+            # blocks after the last of out_indices do not contribute to the outputs,
+            # they are skipped in forward, and not even built with prune_unused_blocks
+            self.num_used_blocks = max(out_indices) + 1
+            num_blocks = self.num_used_blocks if prune_unused_blocks else depth
+            self.blocks = nn.ModuleList([
+                Block(embed_dim, num_heads, mlp_ratio, qkv_bias=qkv_bias,
+                      norm_layer=norm_layer_for_blocks,
+                      drop_path=dpr[i], init_values=init_values, attn_drop=0.,
+                      use_flash_attn=use_flash_attn,
+                      with_cp=with_cp,
+                      qk_normalization=qk_normalization,
+                      layerscale_force_fp32=layerscale_force_fp32)
+                for i in range(num_blocks)])
+
+            self.init_weights(pretrained)
+
+            if freeze_vit:
+                _freeze_params(self)
 
         if with_fpn:
             self.up1 = nn.Sequential(*[
@@ -375,6 +384,9 @@ class InternViT6B(BaseModule):
             checkpoint = torch.load(pretrained, map_location='cpu')
             if 'module' in checkpoint:
                 checkpoint = checkpoint['module']
+            # drop the weights of pruned blocks
+            checkpoint = {k: v for k, v in checkpoint.items()
+                          if not k.startswith('blocks.') or int(k.split('.')[1]) < len(self.blocks)}
 
             # resize pos_embed
             pos_embed = checkpoint['pos_embed']
@@ -390,22 +402,36 @@ class InternViT6B(BaseModule):
 
     @property
     def dtype(self):
+        if self.from_cached_features:
+            return torch.bfloat16
         return self.patch_embed.proj.weight.dtype
 
     def forward(self, x):
+        if self.from_cached_features:
+            # the cache stores the bits of the bfloat16 features as int16
+            x = x.view(torch.bfloat16) if x.dtype == torch.int16 else x.type(self.dtype)
+            outs = list(x.split(self.embed_dim, dim=1))
+        else:
+            outs = self.forward_features(x)
+        return self.forward_fpn(outs)
+
+    def forward_features(self, x):
         x, H, W = self.patch_embed(x.type(self.dtype))
         batch_size, seq_len, _ = x.size()
         cls_tokens = self.cls_token.expand(batch_size, -1, -1)
         x = torch.cat((cls_tokens, x), dim=1)
         x = self.pos_drop(x + self.pos_embed)
         outs = list()
-        for idx, blk in enumerate(self.blocks):
+        for idx, blk in enumerate(self.blocks[:self.num_used_blocks]):
             x = blk(x)
             if idx in self.out_indices:
                 out = x[:, 1:, :]  # remove cls token
                 b, n, c = out.shape
                 out = out.reshape(b, H, W, c).permute(0, 3, 1, 2)
                 outs.append(out)
+        return outs
+
+    def forward_fpn(self, outs):
         if not self.with_fpn:
             return [item.contiguous().to(torch.float32) for item in outs]
         else:
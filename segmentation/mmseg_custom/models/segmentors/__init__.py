@@ -0,0 +1,9 @@
+# --------------------------------------------------------
+# InternVL
+# Copyright (c) 2023 OpenGVLab
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+from .encoder_decoder import EncoderDecoder
+
+__all__ = ['EncoderDecoder']
@@ -0,0 +1,91 @@
+# --------------------------------------------------------
+# InternVL
+# Copyright (c) 2023 OpenGVLab
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+import torch
+from mmseg.models.builder import SEGMENTORS
+from mmseg.models.segmentors import EncoderDecoder as _EncoderDecoder
+from mmseg.ops import resize
+
+
+@SEGMENTORS.register_module(force=True)
+class EncoderDecoder(_EncoderDecoder):
+    """Encoder Decoder segmentors with batched sliding-window inference.
+
+    The windows of ``mode='slide'`` are stacked (together with the images of
+    the batch) and forwarded ``test_cfg.batch_size`` windows at a time instead
+    of one window per forward, the logits are accumulated in place, and the
+    count map is computed once per image size.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(EncoderDecoder, self).__init__(*args, **kwargs)
+        self._count_mats = {}
+
+    def _slide_windows(self, h_img, w_img):
+        h_stride, w_stride = self.test_cfg.stride
+        h_crop, w_crop = self.test_cfg.crop_size
+        h_grids = max(h_img - h_crop + h_stride - 1, 0) // h_stride + 1
+        w_grids = max(w_img - w_crop + w_stride - 1, 0) // w_stride + 1
+        windows = []
+        for h_idx in range(h_grids):
+            for w_idx in range(w_grids):
+                y1 = h_idx * h_stride
+                x1 = w_idx * w_stride
+                y2 = min(y1 + h_crop, h_img)
+                x2 = min(x1 + w_crop, w_img)
+                y1 = max(y2 - h_crop, 0)
+                x1 = max(x2 - w_crop, 0)
+                windows.append((y1, y2, x1, x2))
+        return windows
+
+    def _count_mat(self, windows, h_img, w_img, device):
+        key = (h_img, w_img, device)
+        if key not in self._count_mats:
+            count_mat = torch.zeros((1, 1, h_img, w_img), device=device)
+            for y1, y2, x1, x2 in windows:
+                count_mat[:, :, y1:y2, x1:x2] += 1
+            assert (count_mat == 0).sum() == 0
+            self._count_mats[key] = count_mat
+        return self._count_mats[key]
+
+    def slide_inference(self, img, img_meta, rescale):
+        """Inference by sliding-window with overlap.
+
+        If h_crop > h_img or w_crop > w_img, the small patch will be used to
+        decode without padding.
+        """
+        window_batch_size = self.test_cfg.get('batch_size', 4)
+        batch_size, _, h_img, w_img = img.size()
+        windows = self._slide_windows(h_img, w_img)
+        preds = img.new_zeros((batch_size, self.num_classes, h_img, w_img))
+
+        # windows are only smaller than crop_size at the borders of small
+        # images, each window size is batched separately
+        groups = {}
+        for window in windows:
+            y1, y2, x1, x2 = window
+            groups.setdefault((y2 - y1, x2 - x1), []).append(window)
+        for group in groups.values():
+            for start in range(0, len(group), window_batch_size):
+                chunk = group[start:start + window_batch_size]
+                crop_imgs = torch.cat(
+                    [img[:, :, y1:y2, x1:x2] for y1, y2, x1, x2 in chunk])
+                crop_seg_logits = self.encode_decode(crop_imgs, img_meta)
+                crop_seg_logits = crop_seg_logits.split(batch_size)
+                for (y1, y2, x1, x2), crop_seg_logit in zip(chunk, crop_seg_logits):
+                    preds[:, :, y1:y2, x1:x2] += crop_seg_logit
+
+        preds = preds / self._count_mat(windows, h_img, w_img, img.device)
+        if rescale:
+            # remove padding area
+            resize_shape = img_meta[0]['img_shape'][:2]
+            preds = preds[:, :, :resize_shape[0], :resize_shape[1]]
+            preds = resize(
+                preds,
+                size=img_meta[0]['ori_shape'][:2],
+                mode='bilinear',
+                align_corners=self.align_corners,
+                warning=False)
+        return preds
@@ -89,6 +89,12 @@ def parse_args():
         choices=['none', 'pytorch', 'slurm', 'mpi'],
         default='none',
         help='job launcher')
+    parser.add_argument(
+        '--slide-batch-size',
+        type=int,
+        default=None,
+        help='number of windows per forward in slide inference, overrides '
+        'the batch_size of test_cfg')
     parser.add_argument(
         '--opacity',
         type=float,
@@ -140,6 +146,8 @@ def main():
         cfg.data.test.pipeline[1].flip = True
     cfg.model.pretrained = None
     cfg.data.test.test_mode = True
+    if args.slide_batch_size is not None:
+        cfg.model.test_cfg.batch_size = args.slide_batch_size
 
     # init distributed env first, since logger depends on the dist info.
     if args.launcher == 'none':
@@ -227,6 +235,7 @@ def main():
     else:
         tmpdir = None
 
+    start = time.time()
     if not distributed:
         model = MMDataParallel(model, device_ids=[0])
         results = single_gpu_test(
@@ -253,9 +262,12 @@ def main():
             pre_eval=args.eval is not None and not eval_on_format_results,
             format_only=args.format_only or eval_on_format_results,
             format_args=eval_kwargs)
+    elapsed = time.time() - start
 
     rank, _ = get_dist_info()
     if rank == 0:
+        print(f'\ninference of {len(dataset)} images: {elapsed:.1f}s, '
+              f'{len(dataset) / elapsed:.2f} images/s')
         if args.out:
             warnings.warn(
                 'The behavior of ``args.out`` has been changed since MMSeg '